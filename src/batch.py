@@ -0,0 +1,153 @@
+"""
+Batch mode: covers of many songs with the stages of main.cover_stages pipelined, so that the separation
+of one song overlaps the conversion of the previous one and the mixing of the one before.
+"""
+import json
+import os
+import queue
+import threading
+import time
+import traceback
+
+
+class StageStats:
+    """What one stage thread did over a batch, in seconds"""
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.failed = 0
+        self.busy = 0.0
+        # waiting for the next stage to take its output, time spent here means the next stage is the bottleneck
+        self.blocked = 0.0
+
+    def utilization(self, wall_time):
+        return self.busy / wall_time if wall_time > 0 else 0.0
+
+    def to_dict(self, wall_time):
+        return {'items': self.items, 'failed': self.failed, 'busy': self.busy, 'blocked': self.blocked, 'utilization': self.utilization(wall_time)}
+
+
+def run_pipelined(states, stages, queue_size=1):
+    """
+    Run every state dict through stages, each stage on its own thread with bounded queues in between, so the
+    ONNX separation, the RVC conversion and the ffmpeg/pydub mixing of different songs run at the same time.
+    A song that fails at one stage skips the rest and the others carry on.
+
+    Args:
+        states: (list) Initial state dicts, see main.cover_download
+        stages: (list) (name, function) pairs, each function takes and returns a state dict, or a list of state
+                dicts that the later stages then process separately, e.g. one per voice model of a separated song
+        queue_size: (int) Songs waiting between two stages, which bounds how far the early stages run ahead
+
+    Returns:
+        tuple: (final states in input order, fanned out states in the order they were returned, with 'timings'
+                per stage and 'error' for failed songs, {stage name: StageStats}, wall time)
+    """
+    stats = {name: StageStats(name) for name, _ in stages}
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    done = queue.Queue()
+    done_marker = object()
+
+    def put(q, item, stage_stats):
+        start = time.perf_counter()
+        q.put(item)
+        stage_stats.blocked += time.perf_counter() - start
+
+    def work(i, name, fn):
+        stage_stats = stats[name]
+        output = queues[i + 1] if i + 1 < len(stages) else done
+        while True:
+            item = queues[i].get()
+            if item is done_marker:
+                output.put(done_marker)
+                return
+            index, state = item
+            outputs = [state]
+            if 'error' not in state:
+                start = time.perf_counter()
+                try:
+                    outputs = fn(state)
+                    if not isinstance(outputs, list):
+                        outputs = [outputs]
+                except Exception as e:
+                    traceback.print_exc()
+                    state['error'] = f'{name}: {e}'
+                    stage_stats.failed += 1
+                    outputs = [state]
+                elapsed = time.perf_counter() - start
+                for output_state in outputs:
+                    output_state.setdefault('timings', {})[name] = elapsed
+                stage_stats.busy += elapsed
+                stage_stats.items += 1
+            if len(outputs) == 1:
+                put(output, (index, outputs[0]), stage_stats)
+            else:
+                for fanned, output_state in enumerate(outputs):
+                    put(output, (index + (fanned,), output_state), stage_stats)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=work, args=(i, name, fn), name=f'batch-{name}', daemon=True) for i, (name, fn) in enumerate(stages)]
+    for thread in threads:
+        thread.start()
+
+    results = {}
+
+    def feed():
+        for index, state in enumerate(states):
+            queues[0].put(((index,), state))
+        queues[0].put(done_marker)
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    while True:
+        item = done.get()
+        if item is done_marker:
+            break
+        index, state = item
+        results[index] = state
+    for thread in threads + [feeder]:
+        thread.join()
+    return [results[index] for index in sorted(results)], stats, time.perf_counter() - start
+
+
+def print_utilization(stats, wall_time):
+    print(f'[~] Stage utilization over {wall_time:.1f}s:')
+    print(f'    {"stage":<12}{"songs":>7}{"failed":>8}{"busy (s)":>10}{"blocked (s)":>13}{"utilization":>13}')
+    for stage_stats in stats.values():
+        print(f'    {stage_stats.name:<12}{stage_stats.items:>7}{stage_stats.failed:>8}{stage_stats.busy:>10.1f}{stage_stats.blocked:>13.1f}'
+              f'{stage_stats.utilization(wall_time):>13.0%}')
+
+
+def write_summary(summary_path, states, stats, wall_time, skipped=None):
+    """
+    Write a JSON summary of a batch: the stage utilization, then each song with its cover or error and its stage timings
+
+    Args:
+        skipped: (list) {'song_input', 'reason'} dicts of inputs left out of the batch, e.g. duplicates
+    """
+    songs = []
+    for state in states:
+        params = state['params']
+        timings = state.get('timings', {})
+        songs.append({
+            'song_input': params['song_input'],
+            'song_id': state.get('song_id'),
+            'voice_model': params['voice_model'],
+            'result': state.get('result'),
+            'error': state.get('error'),
+            'timings': timings,
+            'total_time': sum(timings.values()),
+        })
+    summary = {
+        'wall_time': wall_time,
+        'songs_done': sum(song['error'] is None for song in songs),
+        'songs_failed': sum(song['error'] is not None for song in songs),
+        'stages': {name: stage_stats.to_dict(wall_time) for name, stage_stats in stats.items()},
+        'songs': songs,
+        'skipped': skipped or [],
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(summary_path)), exist_ok=True)
+    with open(summary_path, 'w', encoding='utf8') as outfile:
+        json.dump(summary, outfile, indent=2)
+    return summary
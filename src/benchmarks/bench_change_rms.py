@@ -0,0 +1,90 @@
+"""
+Check change_rms against the librosa and torch implementation it replaced, and compare their time and peak memory
+
+    python src/benchmarks/bench_change_rms.py --minutes 4
+
+Exits with a non-zero status if the outputs differ by more than the float32 tolerance.
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import librosa
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.join(BASE_DIR, 'src'))
+
+from vc_infer_pipeline import change_rms
+
+sr1 = 16000
+sr2 = 40000
+# relative to the peak of the output
+tolerance = 1e-5
+
+
+def torch_change_rms(data1, sr1, data2, sr2, rate):
+    """The implementation change_rms replaced, kept as the reference"""
+    rms1 = librosa.feature.rms(y=data1, frame_length=sr1 // 2 * 2, hop_length=sr1 // 2)
+    rms2 = librosa.feature.rms(y=data2, frame_length=sr2 // 2 * 2, hop_length=sr2 // 2)
+    rms1 = torch.from_numpy(rms1)
+    rms1 = F.interpolate(rms1.unsqueeze(0), size=data2.shape[0], mode="linear").squeeze()
+    rms2 = torch.from_numpy(rms2)
+    rms2 = F.interpolate(rms2.unsqueeze(0), size=data2.shape[0], mode="linear").squeeze()
+    rms2 = torch.max(rms2, torch.zeros_like(rms2) + 1e-6)
+    data2 *= (torch.pow(rms1, torch.tensor(1 - rate)) * torch.pow(rms2, torch.tensor(rate - 1))).numpy()
+    return data2
+
+
+def make_audio(seconds, sr, seed):
+    """Noise with a slow loudness envelope and a silent stretch, like separated vocals"""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * sr)) / sr
+    envelope = 0.05 + np.abs(np.sin(2 * np.pi * 0.2 * t))
+    envelope[(t > seconds / 3) & (t < seconds / 3 + 2)] = 0
+    return (rng.standard_normal(t.shape[0]) * envelope * 0.1).astype(np.float32)
+
+
+def measure(fn, data1, data2, rate):
+    """Output, best time of 3 runs and the peak of numpy allocations besides the output"""
+    timings = []
+    for _ in range(3):
+        out = data2.copy()
+        start = time.perf_counter()
+        fn(data1, sr1, out, sr2, rate)
+        timings.append(time.perf_counter() - start)
+    out_copy = data2.copy()
+    tracemalloc.start()
+    fn(data1, sr1, out_copy, sr2, rate)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return out, min(timings), peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Parity check and benchmark of change_rms.')
+    parser.add_argument('-min', '--minutes', type=float, default=4, help='Minutes of audio')
+    parser.add_argument('-rate', '--rms-mix-rate', type=float, default=0.25, help='Rate passed to change_rms')
+    args = parser.parse_args()
+
+    seconds = args.minutes * 60
+    data1 = make_audio(seconds, sr1, 0).astype(np.float64)
+    data2 = make_audio(seconds, sr2, 1)
+    reference, reference_time, reference_peak = measure(torch_change_rms, data1, data2, args.rms_mix_rate)
+    out, out_time, out_peak = measure(change_rms, data1, data2, args.rms_mix_rate)
+
+    max_diff = np.abs(out - reference).max() / np.abs(reference).max()
+    print(f'{data2.shape[0]} output samples, max diff {max_diff:.2e} of the peak')
+    # tracemalloc doesn't see torch's allocator, so the reference's full-length tensors are not counted
+    print(f'{"implementation":<16}{"time (ms)":>11}{"peak numpy (MB)":>18}')
+    print(f'{"librosa+torch":<16}{reference_time * 1000:>11.1f}{reference_peak / 2 ** 20:>18.1f}')
+    print(f'{"blockwise":<16}{out_time * 1000:>11.1f}{out_peak / 2 ** 20:>18.1f}')
+    sys.exit(0 if max_diff <= tolerance else 1)
+
+
+if __name__ == '__main__':
+    main()
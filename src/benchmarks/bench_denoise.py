@@ -0,0 +1,63 @@
+"""
+Compare the MDX denoise strategies against the original two pass average, for speed and output quality
+
+    python src/benchmarks/bench_denoise.py -m mdxnet_models/UVR-MDX-NET-Voc_FT.onnx -i song.wav
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import librosa
+import numpy as np
+import torch
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.join(BASE_DIR, 'src'))
+
+from mdx import denoise_strategies, get_mdx_device, load_mdx, separate_wave
+
+mdxnet_models_dir = os.path.join(BASE_DIR, 'mdxnet_models')
+
+
+def sdr(reference, estimate):
+    """Signal to distortion ratio of estimate against reference in dB"""
+    noise = np.sum((reference - estimate) ** 2)
+    return float('inf') if noise == 0 else 10 * np.log10(np.sum(reference ** 2) / noise)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the MDX denoise strategies against the two pass average.')
+    parser.add_argument('-m', '--model', type=str, default=os.path.join(mdxnet_models_dir, 'UVR-MDX-NET-Voc_FT.onnx'), help='Path of the MDX-Net ONNX model')
+    parser.add_argument('-i', '--input', type=str, required=True, help='Audio file to separate')
+    parser.add_argument('-d', '--duration', type=float, default=30, help='Seconds of audio to use from the start of the file')
+    parser.add_argument('-bs', '--batch-size', type=int, default=0, help='Number of chunks per ONNX call, 0 for automatic')
+    args = parser.parse_args()
+
+    with open(os.path.join(mdxnet_models_dir, 'model_data.json')) as infile:
+        model_params = json.load(infile)
+
+    device, m_threads = get_mdx_device()
+    wave, _ = librosa.load(args.input, mono=False, sr=44100, duration=args.duration)
+
+    results = {}
+    outputs = {}
+    for strategy in denoise_strategies + [None]:
+        mdx_sess, _ = load_mdx(model_params, args.model, device, args.batch_size, strategy)
+        start = time.perf_counter()
+        outputs[strategy], _ = separate_wave(mdx_sess, wave, m_threads)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        results[strategy] = time.perf_counter() - start
+        del mdx_sess
+
+    reference = outputs['average']
+    print(f'{"strategy":<10}{"time (s)":>10}{"speedup":>10}{"SDR vs average (dB)":>22}{"max abs diff":>15}')
+    for strategy, elapsed in results.items():
+        print(f'{str(strategy):<10}{elapsed:>10.2f}{results["average"] / elapsed:>10.2f}'
+              f'{sdr(reference, outputs[strategy]):>22.2f}{np.abs(reference - outputs[strategy]).max():>15.2e}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,459 @@
+"""
+End-to-end benchmark of song_cover_pipeline on synthetic songs, with random-weight stand-ins for every model, offline on CPU
+
+    python src/benchmarks/bench_pipeline.py --seconds 30 120 --runs 3 --save baseline.json
+    python src/benchmarks/bench_pipeline.py --seconds 30 120 --runs 3 --baseline baseline.json
+
+Nothing is downloaded. The songs are generated (chords, drums, and a formant-filtered vocal melody with backing vocals),
+the MDX separators are small convolutional ONNX models with the dims of the real ones, HuBERT is a random HuBERT base
+shaped network, and RMVPE and the voice model are the real E2E and SynthesizerTrnMs768NSFsid architectures with random
+weights. The stems and converted vocals are meaningless, but every stage does the work it does on a real song.
+
+Each stage is timed with the pipeline profiler. With --baseline, exits with a non-zero status if a stage or the
+whole cover got slower than in the saved results by more than the tolerance.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import soundfile as sf
+import torch
+from scipy import signal
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.join(BASE_DIR, 'src'))
+
+from caches import f0_cache, feature_cache, stem_cache
+from execution import execution_profile, rmvpe_backends, rvc_backends
+from infer_pack.models import SynthesizerTrnMs768NSFsid
+from model_registry import model_registry
+from profiling import profiler
+from rmvpe import E2E, RMVPE
+from rvc_onnx import get_export_kwargs
+
+sr = 44100
+configs_dir = os.path.join(BASE_DIR, 'src', 'configs')
+voice_model = 'BenchVoice'
+# stand-in file name and the production model its dims are taken from, by the hash model_data.json knows it by
+separation_models = {
+    'UVR-MDX-NET-Voc_FT.onnx': '77d07b2667ddf05b9e3175941b4454a0',
+    'UVR_MDXNET_KARA_2.onnx': '1d64a6d2c30f709b8c9b4ce1366d96ee',
+    'Reverb_HQ_By_FoxJoy.onnx': 'cd5b2989ad863f116c855db1dfe24e39',
+}
+# first three formants of sung vowels, in Hz
+vowels = [(730, 1090, 2440), (270, 2290, 3010), (300, 870, 2240), (530, 1840, 2480), (570, 840, 2410)]
+# don't flag stages that got slower by less than this many seconds, they are within run to run noise
+min_regression_seconds = 0.05
+
+
+def make_song(seconds, seed=0, bpm=120):
+    """
+    Stereo 44.1 kHz song: a chord progression panned across the stereo field, kick and hi-hat, a lead vocal
+    in the center (a sawtooth with vibrato through vowel formant filters) and quieter backing vocals a third above.
+    The vocals rest one bar in every five, so the conversion has silences to split at.
+
+    Returns:
+        np.ndarray: (samples, 2) float32
+    """
+    rng = np.random.default_rng(seed)
+    n = int(seconds * sr)
+    beat = int(60 / bpm * sr)
+    bar = 4 * beat
+    t = np.arange(n) / sr
+    left = np.zeros(n)
+    right = np.zeros(n)
+
+    # chords, one per bar, each note a few harmonics decaying over every beat
+    roots = [0, 5, 7, 3]
+    beat_envelope = np.exp(-3 * (np.arange(n) % beat) / beat)
+    for i, start in enumerate(range(0, n, bar)):
+        stop = min(start + bar, n)
+        for j, interval in enumerate((0, 4, 7)):
+            freq = 110 * 2 ** ((roots[i % len(roots)] + interval) / 12)
+            tone = sum(np.sin(2 * np.pi * freq * k * t[start:stop]) / k ** 1.5 for k in range(1, 6))
+            pan = 0.2 + 0.3 * j
+            left[start:stop] += (1 - pan) * 0.15 * tone * beat_envelope[start:stop]
+            right[start:stop] += pan * 0.15 * tone * beat_envelope[start:stop]
+
+    # kick on every beat, high-passed noise hi-hats on the off-beats
+    kick_t = np.arange(beat // 2) / sr
+    kick = np.sin(2 * np.pi * 55 * kick_t * np.exp(-kick_t * 8)) * np.exp(-kick_t * 25)
+    hat_sos = signal.butter(4, 7000, 'highpass', fs=sr, output='sos')
+    hat = signal.sosfilt(hat_sos, rng.standard_normal(beat // 4)) * np.exp(-np.arange(beat // 4) / sr * 60)
+    for start in range(0, n, beat):
+        length = min(kick.shape[0], n - start)
+        left[start:start + length] += 0.5 * kick[:length]
+        right[start:start + length] += 0.5 * kick[:length]
+        hat_start = start + beat // 2
+        length = max(0, min(hat.shape[0], n - hat_start))
+        left[hat_start:hat_start + length] += 0.1 * hat[:length]
+        right[hat_start:hat_start + length] += 0.08 * hat[:length]
+
+    # a random walk over the scale, one note per beat, for the lead and backing vocals
+    scale = [0, 2, 4, 5, 7, 9, 11, 12]
+    degree = 2
+    notes = []
+    for start in range(0, n, beat):
+        degree = int(np.clip(degree + rng.integers(-2, 3), 0, len(scale) - 1))
+        notes.append((start, min(start + beat, n), 220 * 2 ** (scale[degree] / 12), vowels[rng.integers(len(vowels))]))
+    lead = make_vocals(notes, n, bar, vibrato_seed=rng.integers(2 ** 31))
+    backing = make_vocals([(start, stop, f0 * 2 ** (4 / 12), vowel) for start, stop, f0, vowel in notes], n, bar, vibrato_seed=rng.integers(2 ** 31))
+    left += 0.5 * lead + 0.12 * backing
+    right += 0.5 * lead + 0.08 * backing
+
+    song = np.stack([left, right], axis=1)
+    return (0.9 * song / np.abs(song).max()).astype(np.float32)
+
+
+def make_vocals(notes, n, bar, vibrato_seed=0):
+    """A glottal-like sawtooth following the (start, stop, f0, formants) notes, silent every fifth bar"""
+    rng = np.random.default_rng(vibrato_seed)
+    f0 = np.zeros(n)
+    for start, stop, freq, _ in notes:
+        f0[start:stop] = freq
+    t = np.arange(n) / sr
+    f0 *= 2 ** (0.3 / 12 * np.sin(2 * np.pi * 5.5 * t + rng.uniform(0, 2 * np.pi)))
+    phase = np.cumsum(f0) / sr
+    source = 2 * (phase % 1) - 1 + 0.02 * rng.standard_normal(n)
+
+    vocals = np.zeros(n)
+    fade = int(0.02 * sr)
+    for start, stop, _, formants in notes:
+        if (start // bar) % 5 == 4:
+            continue
+        note = sum(signal.lfilter(*signal.iirpeak(formant, 8, fs=sr), source[start:stop]) for formant in formants)
+        envelope = np.ones(stop - start)
+        ramp = min(fade, (stop - start) // 2)
+        envelope[:ramp] = np.linspace(0, 1, ramp)
+        envelope[stop - start - ramp:] = np.linspace(1, 0, ramp)
+        vocals[start:stop] = note * envelope
+    return vocals / max(np.abs(vocals).max(), 1e-6)
+
+
+class StandInSeparator(torch.nn.Module):
+    """Masks the (batch, 4, dim_f, dim_t) spectrogram input of an MDX model with a few 3x3 convolutions"""
+
+    def __init__(self, channels=32, layers=4):
+        super().__init__()
+        convs = [torch.nn.Conv2d(4, channels, 3, padding=1)]
+        convs += [torch.nn.Conv2d(channels, channels, 3, padding=1) for _ in range(layers - 2)]
+        convs.append(torch.nn.Conv2d(channels, 4, 3, padding=1))
+        self.convs = torch.nn.ModuleList(convs)
+
+    def forward(self, x):
+        mask = x
+        for conv in self.convs[:-1]:
+            mask = torch.nn.functional.gelu(conv(mask))
+        return x * torch.sigmoid(self.convs[-1](mask))
+
+
+class StandInHubert(torch.nn.Module):
+    """
+    HuBERT base shaped network: the wav2vec 2.0 convolutional feature extractor (one 768-dim frame per 320 samples),
+    the convolutional positional embedding and 12 transformer layers, exposing extract_features and final_proj
+    like the fairseq model. Its layers aren't under encoder.layers, which vc_infer_pipeline only needs with the
+    feature cache enabled.
+    """
+
+    def __init__(self, num_layers=12):
+        super().__init__()
+        conv_layers = [(10, 5)] + [(3, 2)] * 4 + [(2, 2)] * 2
+        modules = []
+        in_channels = 1
+        for i, (kernel_size, stride) in enumerate(conv_layers):
+            modules.append(torch.nn.Conv1d(in_channels, 512, kernel_size, stride, bias=False))
+            if i == 0:
+                modules.append(torch.nn.GroupNorm(512, 512))
+            modules.append(torch.nn.GELU())
+            in_channels = 512
+        self.feature_extractor = torch.nn.Sequential(*modules)
+        self.layer_norm = torch.nn.LayerNorm(512)
+        self.post_extract_proj = torch.nn.Linear(512, 768)
+        self.pos_conv = torch.nn.Conv1d(768, 768, 128, padding=64, groups=16)
+        self.layers = torch.nn.ModuleList([
+            torch.nn.TransformerEncoderLayer(768, 12, 3072, dropout=0, activation='gelu', batch_first=True) for _ in range(num_layers)
+        ])
+        self.final_proj = torch.nn.Linear(768, 256)
+
+    def extract_features(self, source, padding_mask=None, output_layer=None):
+        x = self.feature_extractor(source.unsqueeze(1)).transpose(1, 2)
+        x = self.post_extract_proj(self.layer_norm(x))
+        x = x + torch.nn.functional.gelu(self.pos_conv(x.transpose(1, 2))[:, :, :-1]).transpose(1, 2)
+        for layer in self.layers[:output_layer]:
+            x = layer(x)
+        return x, padding_mask
+
+
+def make_mdx_models(mdxnet_models_dir, channels, layers):
+    """Export the stand-in separators and write their model_data.json, with the dims of the production models"""
+    with open(os.path.join(BASE_DIR, 'mdxnet_models', 'model_data.json')) as infile:
+        production_params = json.load(infile)
+    from mdx import MDX
+
+    model_params = {}
+    for filename, production_hash in separation_models.items():
+        params = production_params[production_hash]
+        model_path = os.path.join(mdxnet_models_dir, filename)
+        with torch.no_grad():
+            torch.onnx.export(
+                StandInSeparator(channels, layers).eval(),
+                torch.randn(1, 4, params['mdx_dim_f_set'], 2 ** params['mdx_dim_t_set']),
+                model_path,
+                input_names=['input'],
+                output_names=['output'],
+                dynamic_axes={'input': [0], 'output': [0]},
+                opset_version=17,
+                **get_export_kwargs(),
+            )
+        model_params[MDX.get_hash(model_path)] = params
+    with open(os.path.join(mdxnet_models_dir, 'model_data.json'), 'w') as outfile:
+        json.dump(model_params, outfile, indent=2)
+
+
+def make_voice_model(model_dir, config_name, index_vectors, seed):
+    """
+    Save a random SynthesizerTrnMs768NSFsid built from a src/configs file as a v2 voice model,
+    with a faiss index of random features next to it unless index_vectors is 0
+    """
+    with open(os.path.join(configs_dir, f'{config_name}.json')) as infile:
+        hps = json.load(infile)
+    data, model = hps['data'], hps['model']
+    # the order RVC training saves the synthesizer arguments in
+    config = [
+        data['filter_length'] // 2 + 1, hps['train']['segment_size'] // data['hop_length'], model['inter_channels'],
+        model['hidden_channels'], model['filter_channels'], model['n_heads'], model['n_layers'], model['kernel_size'],
+        model['p_dropout'], model['resblock'], model['resblock_kernel_sizes'], model['resblock_dilation_sizes'],
+        model['upsample_rates'], model['upsample_initial_channel'], model['upsample_kernel_sizes'], model['spk_embed_dim'],
+        model['gin_channels'], data['sampling_rate'],
+    ]
+    net_g = SynthesizerTrnMs768NSFsid(*config, is_half=False)
+    # released models don't carry the posterior encoder, which only training uses
+    weight = {name: value for name, value in net_g.state_dict().items() if not name.startswith('enc_q')}
+    torch.save({'weight': weight, 'config': config, 'f0': 1, 'version': 'v2', 'info': f'random weights, seed {seed}'},
+               os.path.join(model_dir, f'{voice_model}.pth'))
+
+    if index_vectors:
+        import faiss
+
+        vectors = np.random.default_rng(seed).standard_normal((index_vectors, 768)).astype(np.float32)
+        n_ivf = min(int(16 * np.sqrt(index_vectors)), index_vectors // 39)
+        index = faiss.index_factory(768, f'IVF{n_ivf},Flat')
+        index.train(vectors)
+        index.add(vectors)
+        faiss.write_index(index, os.path.join(model_dir, f'added_IVF{n_ivf}_Flat_nprobe_1_{voice_model}_v2.index'))
+
+
+def make_models(workdir, args):
+    """
+    Create the stand-in models under workdir, laid out like the mdxnet_models and rvc_models folders
+
+    Returns:
+        tuple: (mdxnet_models_dir, rvc_models_dir)
+    """
+    mdxnet_models_dir = os.path.join(workdir, 'mdxnet_models')
+    rvc_models_dir = os.path.join(workdir, 'rvc_models')
+    os.makedirs(mdxnet_models_dir, exist_ok=True)
+    os.makedirs(os.path.join(rvc_models_dir, voice_model), exist_ok=True)
+
+    torch.manual_seed(args.seed)
+    make_mdx_models(mdxnet_models_dir, args.mdx_channels, args.mdx_layers)
+    torch.save(E2E(4, 1, (2, 2)).state_dict(), os.path.join(rvc_models_dir, 'rmvpe.pt'))
+    torch.save(StandInHubert().state_dict(), os.path.join(rvc_models_dir, 'hubert_base.pt'))
+    make_voice_model(os.path.join(rvc_models_dir, voice_model), args.config, args.index_vectors, args.seed)
+    return mdxnet_models_dir, rvc_models_dir
+
+
+def register_models(rvc_models_dir):
+    """
+    Put the stand-in HuBERT and RMVPE in the model registry under the keys voice_change and VC.get_f0 look them
+    up by, since fairseq can't load the one and the other is always read from the repository's rvc_models folder
+    """
+    import vc_infer_pipeline
+
+    device = execution_profile.device
+    is_half = execution_profile.is_half
+
+    def load_hubert():
+        hubert = StandInHubert()
+        hubert.load_state_dict(torch.load(os.path.join(rvc_models_dir, 'hubert_base.pt'), map_location='cpu'))
+        return hubert.to(device).eval()
+
+    model_registry.get(('hubert', device, is_half, os.path.join(rvc_models_dir, 'hubert_base.pt')), load_hubert)
+    rmvpe_key_path = os.path.join(vc_infer_pipeline.BASE_DIR, 'rvc_models', 'rmvpe.pt')
+    backend = execution_profile.rmvpe_backend
+    model_registry.get(('rmvpe', device, is_half, backend, rmvpe_key_path),
+                       lambda: RMVPE(os.path.join(rvc_models_dir, 'rmvpe.pt'), is_half=is_half, device=device, backend=backend))
+
+
+def run_cover(main, song_path, output_dir, args):
+    """
+    Make one cover into a fresh output_dir with the profiler on
+
+    Returns:
+        dict: Profiler totals per stage, plus 'total' for the whole song_cover_pipeline call
+    """
+    main.output_dir = output_dir
+    torch.manual_seed(args.seed)
+    profiler.reset()
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    main.song_cover_pipeline(song_path, voice_model, 0, False, pitch_change_all=args.pitch_change_all, index_rate=args.index_rate,
+                             output_format=args.output_format, separation_graph=not args.stream_separation,
+                             stream_separation=args.stream_separation, progress=None)
+    stages = profiler.summarize()
+    stages['total'] = {
+        'runs': 1,
+        'wall_time': time.perf_counter() - start,
+        'cpu_time': time.process_time() - cpu_start,
+        'peak_rss': max((stage['peak_rss'] for stage in stages.values()), default=0),
+        'peak_device_memory': max((stage['peak_device_memory'] for stage in stages.values()), default=0),
+    }
+    return stages
+
+
+def median_stages(runs):
+    """Median wall and CPU time of each stage over runs, with the highest memory peaks"""
+    stages = {}
+    for name in runs[0]:
+        values = [run[name] for run in runs if name in run]
+        stages[name] = {
+            'runs': values[0]['runs'],
+            'wall_time': float(np.median([value['wall_time'] for value in values])),
+            'cpu_time': float(np.median([value['cpu_time'] for value in values])),
+            'peak_rss': max(value['peak_rss'] for value in values),
+            'peak_device_memory': max(value['peak_device_memory'] for value in values),
+        }
+    return stages
+
+
+def print_stages(seconds, stages):
+    total = stages['total']['wall_time']
+    print(f'[~] {seconds:g}s song: {total:.2f}s per cover, {total / seconds:.3f}x real time')
+    print(f'    {"stage":<14}{"calls":>7}{"wall (s)":>10}{"cpu (s)":>10}{"share":>8}{"peak rss (MB)":>15}')
+    for name, stage in stages.items():
+        print(f'    {name:<14}{stage["runs"]:>7}{stage["wall_time"]:>10.3f}{stage["cpu_time"]:>10.3f}'
+              f'{stage["wall_time"] / total:>8.0%}{stage["peak_rss"] / 2 ** 20:>15.0f}')
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print the stages that got slower than in baseline by more than tolerance
+
+    Returns:
+        bool: Whether any stage regressed
+    """
+    regressed = False
+    print(f'[~] Compared to the baseline, tolerance {tolerance:.0%}:')
+    print(f'    {"song":>6}  {"stage":<14}{"baseline (s)":>14}{"now (s)":>10}{"change":>9}')
+    for seconds, stages in results.items():
+        for name, stage in stages.items():
+            before = baseline.get(seconds, {}).get(name)
+            if before is None:
+                continue
+            now, was = stage['wall_time'], before['wall_time']
+            change = now / was - 1 if was > 0 else 0.0
+            failed = change > tolerance and now - was > min_regression_seconds
+            regressed |= failed
+            print(f'    {seconds + "s":>6}  {name:<14}{was:>14.3f}{now:>10.3f}{change:>+9.0%}{"  SLOWER" if failed else ""}')
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time every stage of the cover pipeline on synthetic songs with random-weight models.')
+    parser.add_argument('-s', '--seconds', type=float, nargs='+', default=[30], help='Lengths of the synthetic songs to cover, in seconds')
+    parser.add_argument('-r', '--runs', type=int, default=3, help='Timed covers per song, the median is reported')
+    parser.add_argument('-w', '--warmup', type=int, default=1, help='Untimed covers first, which load the models and export ONNX files')
+    parser.add_argument('-seed', '--seed', type=int, default=0, help='Seed of the songs and the random weights')
+    parser.add_argument('-config', '--config', type=str, default='48k_v2', help='src/configs file the voice model is built from')
+    parser.add_argument('--index-vectors', type=int, default=20000, help='Random features in the voice model index, 0 for no index')
+    parser.add_argument('-ir', '--index-rate', type=float, default=0.5, help='Feature retrieval ratio')
+    parser.add_argument('--mdx-channels', type=int, default=32, help='Channels of the stand-in separator convolutions')
+    parser.add_argument('--mdx-layers', type=int, default=4, help='Convolutions in the stand-in separators')
+    parser.add_argument('-pall', '--pitch-change-all', type=int, default=1, help='Overall pitch change, non-zero so the pitch_shift stage runs')
+    parser.add_argument('-oformat', '--output-format', type=str, default='mp3', help='Format of the cover')
+    parser.add_argument('--stream-separation', action='store_true', help='Separate with run_mdx through files rather than the in-memory graph')
+    parser.add_argument('-threads', '--threads', type=int, default=0, help='Intra-op threads, 0 for one per physical core')
+    parser.add_argument('-rvcbackend', '--rvc-backend', type=str, choices=rvc_backends, default='torch', help='Runtime of the voice model')
+    parser.add_argument('-rmvpebackend', '--rmvpe-backend', type=str, choices=rmvpe_backends, default='torch', help='Runtime of the RMVPE pitch model')
+    parser.add_argument('-psegs', '--parallel-segments', type=int, default=1, help='Segments of a song converted at the same time')
+    parser.add_argument('--workdir', type=str, default=None, help='Where to put the songs, models and covers, a temporary folder removed afterwards by default')
+    parser.add_argument('--save', type=str, default=None, help='Write the median stage timings to this JSON file, to use as a baseline later')
+    parser.add_argument('--baseline', type=str, default=None, help='JSON file written by --save to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Slowdown of a stage over the baseline that counts as a regression')
+    args = parser.parse_args()
+
+    execution_profile.configure('cpu', 'fp32', args.threads, rvc_backend=args.rvc_backend, rmvpe_backend=args.rmvpe_backend,
+                                max_parallel_segments=args.parallel_segments)
+    # every run has to do the work again rather than find it cached
+    stem_cache.set_max_size(0)
+    f0_cache.set_max_size(0)
+    feature_cache.set_max_size(0)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='aicovergen_bench_')
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        start = time.perf_counter()
+        mdxnet_models_dir, rvc_models_dir = make_models(workdir, args)
+        songs = {}
+        for seconds in args.seconds:
+            songs[f'{seconds:g}'] = os.path.join(workdir, 'songs', f'synthetic_{seconds:g}s_seed{args.seed}.wav')
+            os.makedirs(os.path.dirname(songs[f'{seconds:g}']), exist_ok=True)
+            sf.write(songs[f'{seconds:g}'], make_song(seconds, args.seed), sr)
+        print(f'[~] Songs and stand-in models created in {time.perf_counter() - start:.1f}s under {workdir}, '
+              f'{execution_profile.num_threads} threads')
+
+        import main as pipeline
+
+        pipeline.mdxnet_models_dir = mdxnet_models_dir
+        pipeline.rvc_models_dir = rvc_models_dir
+        register_models(rvc_models_dir)
+        profiler.enable()
+
+        results = {}
+        for seconds, song_path in songs.items():
+            runs = []
+            for i in range(args.warmup + args.runs):
+                output_dir = os.path.join(workdir, 'song_output', f'{seconds}s_{i}')
+                stages = run_cover(pipeline, song_path, output_dir, args)
+                shutil.rmtree(output_dir, ignore_errors=True)
+                if i >= args.warmup:
+                    runs.append(stages)
+            results[seconds] = median_stages(runs)
+            print_stages(float(seconds), results[seconds])
+        profiler.disable()
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.save:
+        import onnxruntime
+
+        metadata = {
+            'settings': {name: value for name, value in vars(args).items() if name not in ('save', 'baseline', 'workdir')},
+            'threads': execution_profile.num_threads,
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'torch': torch.__version__,
+            'onnxruntime': onnxruntime.__version__,
+        }
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, 'w', encoding='utf8') as outfile:
+            json.dump({'metadata': metadata, 'results': results}, outfile, indent=2)
+        print(f'[+] Results written to {args.save}')
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf8') as infile:
+            baseline = json.load(infile)['results']
+        sys.exit(1 if compare(results, baseline, args.tolerance) else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Check the ONNX and int8 RMVPE backends and the chunked mode against eager PyTorch on synthetic tones, and time them
+
+    python src/benchmarks/bench_rmvpe.py -m rvc_models/rmvpe.pt --threads 16
+
+Exits with a non-zero status if a backend drifts from infer_from_audio of the torch backend by more than its tolerance.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.join(BASE_DIR, 'src'))
+
+from execution import execution_profile, rmvpe_backends
+from rmvpe import RMVPE
+
+sr = 16000
+hop = 160
+# max median cents error on frames voiced by both backends, and min fraction of frames with the same voicing
+tolerances = {'onnx': (1, 0.999), 'onnx-int8': (25, 0.97), 'chunked': (5, 0.99)}
+
+
+def make_tones(seconds, tone_seconds=0.5, seed=0):
+    """
+    Harmonic tones with a random pitch between 80 and 800 Hz, separated by short silences
+
+    Returns:
+        tuple: (audio, true f0 per RMVPE frame with 0 for silence)
+    """
+    rng = np.random.default_rng(seed)
+    audio = []
+    f0 = []
+    while sum(len(part) for part in audio) < seconds * sr:
+        pitch = 80 * 10 ** rng.uniform(0, 1)
+        t = np.arange(int(tone_seconds * sr)) / sr
+        tone = sum(np.sin(2 * np.pi * pitch * k * t) / k for k in range(1, 6))
+        tone *= np.hanning(len(t)) ** 0.2
+        silence = np.zeros(int(0.1 * sr))
+        audio += [tone, silence]
+        f0 += [np.full(len(t) // hop, pitch), np.zeros(len(silence) // hop)]
+    audio = np.concatenate(audio)
+    audio = (0.3 * audio / np.abs(audio).max()).astype(np.float32)
+    return audio, np.concatenate(f0)
+
+
+def cents(a, b):
+    return 1200 * np.abs(np.log2(a / b))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Parity check and benchmark of the RMVPE backends.')
+    parser.add_argument('-m', '--model', type=str, default=os.path.join(BASE_DIR, 'rvc_models', 'rmvpe.pt'), help='Path of rmvpe.pt')
+    parser.add_argument('-s', '--seconds', type=float, default=30, help='Seconds of synthetic tones')
+    parser.add_argument('-r', '--runs', type=int, default=3, help='Timed runs per backend')
+    parser.add_argument('-c', '--chunk-frames', type=int, default=1024, help='Window size of the chunked mode, in frames')
+    parser.add_argument('-threads', '--threads', type=int, default=0, help='Intra-op threads, 0 for one per physical core')
+    args = parser.parse_args()
+
+    execution_profile.configure('cpu', 'fp32', args.threads)
+    audio, true_f0 = make_tones(args.seconds)
+
+    # name: (backend, chunk frames)
+    variants = {backend: (backend, 0) for backend in rmvpe_backends}
+    variants['chunked'] = ('torch', args.chunk_frames)
+    f0s = {}
+    timings = {}
+    for name, (backend, chunk_frames) in variants.items():
+        rmvpe = RMVPE(args.model, is_half=False, device='cpu', backend=backend)
+        f0s[name] = rmvpe.infer_from_audio(audio, chunk_frames=chunk_frames)
+        start = time.perf_counter()
+        for _ in range(args.runs):
+            rmvpe.infer_from_audio(audio, chunk_frames=chunk_frames)
+        timings[name] = (time.perf_counter() - start) / args.runs
+
+    reference = f0s['torch']
+    n = min(len(reference), len(true_f0))
+    voiced = (reference[:n] > 0) & (true_f0[:n] > 0)
+    print(f'torch vs true pitch: median {np.median(cents(reference[:n][voiced], true_f0[:n][voiced])):.1f} cents on {voiced.mean():.1%} of frames')
+
+    failed = False
+    print(f'{"backend":<11}{"time (s)":>10}{"speedup":>10}{"median cents":>14}{"max cents":>11}{"same voicing":>14}')
+    for backend in variants:
+        f0 = f0s[backend]
+        both_voiced = (f0 > 0) & (reference > 0)
+        errors = cents(f0[both_voiced], reference[both_voiced]) if both_voiced.any() else np.zeros(1)
+        same_voicing = np.mean((f0 > 0) == (reference > 0))
+        result = ''
+        if backend in tolerances:
+            max_median, min_voicing = tolerances[backend]
+            passed = np.median(errors) <= max_median and same_voicing >= min_voicing
+            failed |= not passed
+            result = '  ok' if passed else '  FAIL'
+        print(f'{backend:<11}{timings[backend]:>10.3f}{timings["torch"] / timings[backend]:>10.2f}'
+              f'{np.median(errors):>14.2f}{errors.max():>11.2f}{same_voicing:>14.1%}{result}')
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
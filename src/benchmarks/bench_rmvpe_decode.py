@@ -0,0 +1,95 @@
+"""
+Micro-benchmark of RMVPE salience decoding: the original per-frame loop against the vectorized numpy and torch decoders
+
+    python src/benchmarks/bench_rmvpe_decode.py --minutes 5
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.join(BASE_DIR, 'src'))
+
+from rmvpe import RMVPE
+
+# RMVPE hop of 160 samples at 16 kHz
+frames_per_minute = 6000
+
+
+def loop_local_average_cents(cents_mapping, salience, thred=0.05):
+    """The per-frame implementation to_local_average_cents replaced, kept as the reference"""
+    center = np.argmax(salience, axis=1)
+    salience = np.pad(salience, ((0, 0), (4, 4)))
+    center += 4
+    todo_salience = []
+    todo_cents_mapping = []
+    starts = center - 4
+    ends = center + 5
+    for idx in range(salience.shape[0]):
+        todo_salience.append(salience[:, starts[idx]: ends[idx]][idx])
+        todo_cents_mapping.append(cents_mapping[starts[idx]: ends[idx]])
+    todo_salience = np.array(todo_salience)
+    todo_cents_mapping = np.array(todo_cents_mapping)
+    devided = np.sum(todo_salience * todo_cents_mapping, 1) / np.sum(todo_salience, 1)
+    devided[np.max(salience, axis=1) <= thred] = 0
+    return devided
+
+
+def best_time(fn, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def make_salience(frames, seed=0):
+    """Salience shaped like RMVPE output: a gaussian peak per frame, with a quarter of the frames unvoiced"""
+    rng = np.random.default_rng(seed)
+    peaks = rng.integers(0, 360, frames)
+    bins = np.arange(360)
+    salience = np.exp(-0.5 * ((bins[None] - peaks[:, None]) / 1.5) ** 2) * rng.uniform(0.5, 1, (frames, 1))
+    salience[rng.random(frames) < 0.25] *= 0.01
+    return salience.astype(np.float32)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the RMVPE salience decoders.')
+    parser.add_argument('-min', '--minutes', type=float, default=5, help='Minutes of audio the salience stands for')
+    parser.add_argument('-r', '--runs', type=int, default=5, help='Timed runs, the best one is reported')
+    args = parser.parse_args()
+
+    # only the decoder is needed, not the network
+    rmvpe = RMVPE.__new__(RMVPE)
+    rmvpe.cents_mapping = np.pad(20 * np.arange(360) + 1997.3794084376191, (4, 4))
+    rmvpe.cents_mapping_torch = {}
+
+    salience = make_salience(int(args.minutes * frames_per_minute))
+    reference = loop_local_average_cents(rmvpe.cents_mapping, salience, 0.03)
+
+    decoders = {
+        'loop': lambda: loop_local_average_cents(rmvpe.cents_mapping, salience, 0.03),
+        'numpy': lambda: rmvpe.to_local_average_cents(salience, 0.03),
+        'torch cpu': lambda: rmvpe.to_local_average_cents_torch(torch.from_numpy(salience), 0.03).numpy(),
+    }
+    if torch.cuda.is_available():
+        salience_gpu = torch.from_numpy(salience).cuda()
+        decoders['torch cuda'] = lambda: rmvpe.to_local_average_cents_torch(salience_gpu, 0.03).cpu().numpy()
+
+    print(f'{len(salience)} frames')
+    loop_time = None
+    print(f'{"decoder":<12}{"time (ms)":>11}{"speedup":>10}{"max abs diff (cents)":>22}')
+    for name, decode in decoders.items():
+        max_diff = np.abs(decode() - reference).max()
+        elapsed = best_time(decode, args.runs)
+        loop_time = loop_time or elapsed
+        print(f'{name:<12}{elapsed * 1000:>11.2f}{loop_time / elapsed:>10.1f}{max_diff:>22.2e}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Check get_split_points against the shifted-copies loop VC.pipeline used before, and time both
+
+    python src/benchmarks/bench_split_points.py --minutes 5
+
+Exits with a non-zero status if any split point differs from the loop's.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from scipy import signal
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.join(BASE_DIR, 'src'))
+
+from vc_infer_pipeline import ah, bh, get_split_points
+
+sr = 16000
+# VC defaults for the fp32 config: window, x_center and x_query
+window = 160
+x_center = 38
+x_query = 6
+
+
+def loop_split_points(audio, window, t_center, t_query):
+    """The implementation get_split_points replaced, kept as the reference"""
+    audio_pad = np.pad(audio, (window // 2, window // 2), mode="reflect")
+    audio_sum = np.zeros_like(audio)
+    for i in range(window):
+        audio_sum += audio_pad[i: i - window]
+    opt_ts = []
+    for t in range(t_center, audio.shape[0], t_center):
+        query = np.abs(audio_sum[t - t_query: t + t_query])
+        opt_ts.append(t - t_query + np.where(query == query.min())[0][0])
+    return opt_ts
+
+
+def make_vocals(seconds, seed=0):
+    """Noise bursts with a syllable-like envelope and digital silence between phrases, high-passed like in VC.pipeline"""
+    rng = np.random.default_rng(seed)
+    n = int(seconds * sr)
+    t = np.arange(n) / sr
+    envelope = np.abs(np.sin(2 * np.pi * 3 * t)) * (np.sin(2 * np.pi * 0.1 * t) > -0.5)
+    audio = rng.standard_normal(n) * envelope * 0.1
+    return signal.filtfilt(bh, ah, audio)
+
+
+def best_time(fn, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Parity check and benchmark of the VC split point search.')
+    parser.add_argument('-min', '--minutes', type=float, default=5, help='Minutes of synthetic vocals')
+    parser.add_argument('-r', '--runs', type=int, default=3, help='Timed runs, the best one is reported')
+    args = parser.parse_args()
+
+    audio = make_vocals(args.minutes * 60)
+    t_center = sr * x_center
+    t_query = sr * x_query
+    reference = loop_split_points(audio, window, t_center, t_query)
+    split_points = get_split_points(audio, window, t_center, t_query)
+    mismatches = sum(a != b for a, b in zip(reference, split_points)) + abs(len(reference) - len(split_points))
+
+    loop_time = best_time(lambda: loop_split_points(audio, window, t_center, t_query), args.runs)
+    vectorized_time = best_time(lambda: get_split_points(audio, window, t_center, t_query), args.runs)
+    print(f'{len(audio)} samples, {len(reference)} split points, {mismatches} mismatches')
+    print(f'loop {loop_time * 1000:.1f} ms, vectorized {vectorized_time * 1000:.1f} ms, {loop_time / vectorized_time:.1f}x faster')
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
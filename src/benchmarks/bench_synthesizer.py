@@ -0,0 +1,79 @@
+"""
+Compare eager PyTorch and ONNX Runtime for the RVC synthesizer (net_g.infer) on the current execution profile
+
+    python src/benchmarks/bench_synthesizer.py -m rvc_models/MyVoice/MyVoice.pth --device cpu --threads 4 8 16
+
+The ONNX backend measured only 1.05-1.33x faster than torch on CPU, which is why it is opt-in. Run this with the
+thread counts of the target host to see whether it is worth enabling there.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.join(BASE_DIR, 'src'))
+
+from execution import execution_profile
+from rvc import Config, get_vc
+from rvc_onnx import OnnxSynthesizer, get_onnx_model
+
+
+def time_infer(net_g, inputs, runs):
+    """Median seconds per call over runs, after one warm-up call"""
+    timings = []
+    for i in range(runs + 1):
+        start = time.perf_counter()
+        with torch.no_grad(), execution_profile.autocast():
+            audio = net_g.infer(*inputs)[0]
+        if execution_profile.is_cuda:
+            torch.cuda.synchronize()
+        if i:
+            timings.append(time.perf_counter() - start)
+    return float(np.median(timings)), audio
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the torch and ONNX Runtime RVC synthesizer backends.')
+    parser.add_argument('-m', '--model', type=str, required=True, help='Path of a pitch-guided .pth voice model')
+    parser.add_argument('-s', '--seconds', type=float, nargs='+', default=[5, 20, 40], help='Segment lengths to time, in seconds of audio')
+    parser.add_argument('-r', '--runs', type=int, default=5, help='Timed runs per segment length')
+    parser.add_argument('-device', '--device', type=str, default='cpu', help='Torch device')
+    parser.add_argument('-threads', '--threads', type=int, nargs='+', default=[0], help='Intra-op thread counts to compare, 0 for one per physical core')
+    args = parser.parse_args()
+
+    execution_profile.configure(args.device, 'fp32', args.threads[0])
+    device = execution_profile.device
+    cpt, version, net_g, tgt_sr, _ = get_vc(device, False, Config(device, False), args.model)
+    if cpt.get('f0', 1) != 1:
+        raise ValueError('Only pitch-guided models can be exported to ONNX.')
+
+    start = time.perf_counter()
+    onnx_path = get_onnx_model(args.model)
+    print(f'ONNX export: {time.perf_counter() - start:.2f}s')
+
+    # HuBERT features are 50 frames per second, doubled before the synthesizer
+    print(f'{"threads":>8}{"seconds":>9}{"torch (s)":>12}{"onnx (s)":>12}{"speedup":>10}{"RMS ratio":>11}')
+    for threads in args.threads:
+        execution_profile.configure(args.device, 'fp32', threads)
+        # the session options carry the thread count, so each count gets its own session
+        onnx_net_g = OnnxSynthesizer(onnx_path, inter_channels=cpt['config'][2])
+        for seconds in args.seconds:
+            frames = int(seconds * 100)
+            phone = torch.randn(1, frames, 256 if version == 'v1' else 768, device=device)
+            pitchf = torch.full((1, frames), 220.0, device=device)
+            pitch = torch.full((1, frames), 100, dtype=torch.long, device=device)
+            inputs = (phone, torch.tensor([frames], device=device).long(), pitch, pitchf, torch.tensor([0], device=device).long())
+
+            torch_time, torch_audio = time_infer(net_g, inputs, args.runs)
+            onnx_time, onnx_audio = time_infer(onnx_net_g, inputs, args.runs)
+            # both backends draw their own noise, so compare loudness rather than samples
+            rms_ratio = onnx_audio.float().pow(2).mean().sqrt() / torch_audio.float().cpu().pow(2).mean().sqrt()
+            print(f'{execution_profile.num_threads:>8}{seconds:>9.1f}{torch_time:>12.3f}{onnx_time:>12.3f}{torch_time / onnx_time:>10.2f}'
+                  f'{rms_ratio.item():>11.3f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,325 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from contextlib import suppress
+
+import numpy as np
+import soundfile as sf
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+cache_dir = os.path.join(BASE_DIR, 'cache')
+
+
+def get_key(*parts):
+    """
+    Hash JSON-serializable parts into a cache key
+    """
+    return hashlib.blake2b(json.dumps(parts, sort_keys=True).encode(), digest_size=16).hexdigest()
+
+
+def get_file_hash(filename, block_size=2 ** 20):
+    """
+    Hash the bytes of a file, e.g. a model checkpoint, for cache keys that must change when the file does
+    """
+    file_hash = hashlib.blake2b(digest_size=16)
+    with open(filename, 'rb') as f:
+        while block := f.read(block_size):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def get_audio_fingerprint(filename, sr=44100, block_size=44100 * 30):
+    """
+    Hash the decoded PCM of an audio file, so that the same audio under another name or container gives the same key.
+    Samples are rounded to 16 bits first to ignore decoder float noise.
+    """
+    audio_hash = hashlib.blake2b(digest_size=16)
+    try:
+        with sf.SoundFile(filename) as f:
+            audio_hash.update(f'{f.samplerate}:{f.channels}'.encode())
+            for block in f.blocks(blocksize=block_size, dtype='float32', always_2d=True):
+                audio_hash.update(np.round(block * 32767).astype(np.int16).tobytes())
+    except RuntimeError:
+        # formats soundfile can't decode go through librosa/audioread
+        import librosa
+
+        wave, _ = librosa.load(filename, mono=False, sr=sr)
+        audio_hash = hashlib.blake2b(digest_size=16)
+        audio_hash.update(f'librosa:{sr}'.encode())
+        audio_hash.update(np.round(wave * 32767).astype(np.int16).tobytes())
+    return audio_hash.hexdigest()
+
+
+def replace_file(path, write_fn):
+    """
+    Atomically create or replace path: write_fn(tmp_path) writes a temporary file in the same directory,
+    which is then renamed over path so readers never see a partial file
+    """
+    tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    try:
+        write_fn(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class FileLock:
+    """
+    Lock shared by every process and thread using the same cache directory.
+    Uses an exclusively created lock file, so it works on any OS and filesystem.
+    """
+
+    def __init__(self, path, timeout=120, stale_after=600):
+        self.path = path
+        self.timeout = timeout
+        self.stale_after = stale_after
+
+    def __enter__(self):
+        deadline = time.time() + self.timeout
+        while True:
+            try:
+                os.close(os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return self
+            except FileExistsError:
+                # a worker that died while holding the lock leaves the file behind
+                try:
+                    if time.time() - os.path.getmtime(self.path) > self.stale_after:
+                        os.remove(self.path)
+                        continue
+                except FileNotFoundError:
+                    continue
+                if time.time() > deadline:
+                    raise TimeoutError(f'Timed out waiting for {self.path}')
+                time.sleep(0.05)
+
+    def __exit__(self, *exc):
+        with suppress(FileNotFoundError):
+            os.remove(self.path)
+
+
+class StemCache:
+    """
+    Content-addressed cache of separated stems shared by every song and worker.
+
+    Each entry is a directory of stem WAV files named after the cache key. manifest.json records
+    the size, the last access time and the stems of every entry. Least recently used entries are
+    evicted once the cache grows over max_size_gb.
+    """
+
+    def __init__(self, root=os.path.join(cache_dir, 'stems'), max_size_gb=20):
+        self.root = root
+        self.max_size = int(max_size_gb * 1024 ** 3)
+        self.manifest_path = os.path.join(root, 'manifest.json')
+        self.lock = FileLock(os.path.join(root, '.lock'))
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def set_max_size(self, max_size_gb):
+        self.max_size = int(max_size_gb * 1024 ** 3)
+
+    def _read_manifest(self):
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _write_manifest(self, manifest):
+        def write(tmp_path):
+            with open(tmp_path, 'w') as f:
+                json.dump(manifest, f)
+
+        replace_file(self.manifest_path, write)
+
+    def restore(self, key, stem_paths):
+        """
+        Copy cached stems to the given paths
+
+        Args:
+            key: (str) Cache key
+            stem_paths: (dict) Stem name to destination path, every stem must be cached for a hit
+
+        Returns:
+            bool: True on a cache hit
+        """
+        if not self.enabled or not os.path.exists(self.manifest_path):
+            return False
+
+        with self.lock:
+            manifest = self._read_manifest()
+            entry = manifest.get(key)
+            if entry is None or not set(stem_paths).issubset(entry['stems']):
+                return False
+
+            entry_dir = os.path.join(self.root, key)
+            try:
+                for name, path in stem_paths.items():
+                    # copies, not hard links, so that rewriting a song's stems can't change the cached ones
+                    shutil.copyfile(os.path.join(entry_dir, entry['stems'][name]), path)
+            except FileNotFoundError:
+                # entry removed from disk behind the manifest's back
+                del manifest[key]
+                self._write_manifest(manifest)
+                return False
+
+            entry['last_access'] = time.time()
+            self._write_manifest(manifest)
+        return True
+
+    def store(self, key, stem_paths):
+        """
+        Add stems to the cache
+
+        Args:
+            key: (str) Cache key
+            stem_paths: (dict) Stem name to the path of its file
+        """
+        if not self.enabled:
+            return
+        os.makedirs(self.root, exist_ok=True)
+
+        # files are copied outside of the lock into a private directory, then published with a rename
+        tmp_dir = os.path.join(self.root, f'.{key}.{uuid.uuid4().hex}.tmp')
+        os.makedirs(tmp_dir)
+        stems = {}
+        for name, path in stem_paths.items():
+            stems[name] = f'{name}.wav'
+            shutil.copyfile(path, os.path.join(tmp_dir, stems[name]))
+        size = sum(os.path.getsize(os.path.join(tmp_dir, filename)) for filename in stems.values())
+
+        with self.lock:
+            manifest = self._read_manifest()
+            entry_dir = os.path.join(self.root, key)
+            if key in manifest and os.path.isdir(entry_dir):
+                # another worker already published this entry, add any stems it didn't have
+                for filename in stems.values():
+                    os.replace(os.path.join(tmp_dir, filename), os.path.join(entry_dir, filename))
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                stems = {**manifest[key]['stems'], **stems}
+                size = sum(os.path.getsize(os.path.join(entry_dir, filename)) for filename in stems.values())
+            else:
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                os.replace(tmp_dir, entry_dir)
+            manifest[key] = {'size': size, 'last_access': time.time(), 'stems': stems}
+            self._evict(manifest, keep=key)
+            self._write_manifest(manifest)
+
+    def _evict(self, manifest, keep=None):
+        total_size = sum(entry['size'] for entry in manifest.values())
+        for key in sorted(manifest, key=lambda k: manifest[k]['last_access']):
+            if total_size <= self.max_size:
+                break
+            if key == keep:
+                continue
+            total_size -= manifest[key]['size']
+            shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
+            del manifest[key]
+
+
+def get_array_hash(array):
+    return hashlib.blake2b(np.ascontiguousarray(array).tobytes(), digest_size=16).hexdigest()
+
+
+class ArrayCache:
+    """
+    On-disk cache of small groups of numpy arrays, one .npz file per key.
+
+    Files are written atomically and touched when read, so least recently used files
+    (oldest modification time) are deleted first once the cache grows over max_size_gb.
+    The size of the cache is walked on the first save, then kept as a running total, and
+    walked again only when that total goes over the limit, to evict down to evict_to of it.
+    """
+
+    def __init__(self, root, max_size_gb=1, evict_to=0.9):
+        self.root = root
+        self.max_size = int(max_size_gb * 1024 ** 3)
+        self.evict_to = evict_to
+        # bytes on disk as of the last walk plus what this process saved since, None until the first save
+        self.total_size = None
+        self.size_lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def set_max_size(self, max_size_gb):
+        self.max_size = int(max_size_gb * 1024 ** 3)
+
+    def get_path(self, key):
+        return os.path.join(self.root, key[:2], f'{key}.npz')
+
+    def load(self, key):
+        """
+        Returns:
+            dict: Array name to array, or None on a cache miss
+        """
+        if not self.enabled:
+            return None
+        path = self.get_path(key)
+        try:
+            with np.load(path) as data:
+                arrays = {name: data[name] for name in data.files}
+            os.utime(path)
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        return arrays
+
+    def save(self, key, **arrays):
+        if not self.enabled:
+            return
+        path = self.get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        def write(tmp_path):
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, **arrays)
+
+        try:
+            replaced_size = os.path.getsize(path)
+        except OSError:
+            replaced_size = 0
+        replace_file(path, write)
+        size = os.path.getsize(path)
+
+        with self.size_lock:
+            if self.total_size is None:
+                self.total_size = sum(size for _, size, _ in self._list_files())
+            else:
+                self.total_size += size - replaced_size
+            if self.total_size > self.max_size:
+                self._evict()
+
+    def _list_files(self):
+        files = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.endswith('.npz'):
+                    with suppress(FileNotFoundError):
+                        stat = os.stat(os.path.join(dirpath, filename))
+                        files.append((stat.st_mtime, stat.st_size, os.path.join(dirpath, filename)))
+        return files
+
+    def _evict(self):
+        # walked again rather than trusted, other processes may share the directory
+        files = self._list_files()
+        total_size = sum(size for _, size, _ in files)
+        if total_size > self.max_size:
+            for _, size, path in sorted(files):
+                if total_size <= self.max_size * self.evict_to:
+                    break
+                with suppress(FileNotFoundError):
+                    os.remove(path)
+                total_size -= size
+        self.total_size = total_size
+
+
+stem_cache = StemCache()
+f0_cache = ArrayCache(os.path.join(cache_dir, 'f0'), max_size_gb=1)
+feature_cache = ArrayCache(os.path.join(cache_dir, 'features'), max_size_gb=4)
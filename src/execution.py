@@ -0,0 +1,154 @@
+import os
+from contextlib import nullcontext
+
+import torch
+
+precisions = ['fp32', 'fp16', 'bf16']
+# torch runs the voice models eagerly, onnx runs their cached ONNX export with ONNX Runtime,
+# only marginally faster on CPU (1.05-1.33x measured), so torch stays the default
+rvc_backends = ['torch', 'onnx']
+# torch runs RMVPE eagerly, onnx runs its ONNX export and onnx-int8 a dynamically quantized copy of it
+rmvpe_backends = ['torch', 'onnx', 'onnx-int8']
+
+
+def get_default_device():
+    if torch.cuda.is_available():
+        return 'cuda:0'
+    if torch.backends.mps.is_available():
+        return 'mps'
+    return 'cpu'
+
+
+def get_physical_cores():
+    try:
+        # cores available to this process, which respects taskset/cgroup pinning on render nodes
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    # hyper-threads share the FPU, torch and ONNX Runtime get more from one thread per core
+    return max(1, cores // 2) if cores >= 8 else cores
+
+
+class ExecutionProfile:
+    """
+    Where and how the pipeline runs: the torch device, the numeric precision, the torch and
+    ONNX Runtime thread counts and the chunk sizes of the separation and conversion stages.
+
+    fp16 only runs on CUDA, on other devices it falls back to fp32. bf16 keeps the weights in
+    float32 and autocasts matmuls and convolutions, which is fast on CPUs with AVX512-BF16/AMX.
+
+    torch's thread counts are only changed by configure, so creating a profile, such as the module-level
+    default, leaves them as the embedding application set them.
+    """
+
+    # MDX chunks per ONNX call on CPU, larger batches thrash the cache without adding parallelism
+    CPU_MDX_BATCH_SIZE = 2
+
+    def __init__(self, device=None, precision=None, intra_op_threads=0, inter_op_threads=0, rvc_backend='torch', rmvpe_backend='torch',
+                 rmvpe_chunk_frames=0, max_parallel_segments=1):
+        self.device = None
+        self.precision = None
+        self.intra_op_threads = 0
+        self.inter_op_threads = 0
+        self.rvc_backend = 'torch'
+        self.rmvpe_backend = 'torch'
+        self.rmvpe_chunk_frames = 0
+        self.max_parallel_segments = 1
+        self.configure(device, precision, intra_op_threads, inter_op_threads, rvc_backend, rmvpe_backend, rmvpe_chunk_frames,
+                       max_parallel_segments, set_threads=False)
+
+    def configure(self, device=None, precision=None, intra_op_threads=0, inter_op_threads=0, rvc_backend='torch', rmvpe_backend='torch',
+                  rmvpe_chunk_frames=0, max_parallel_segments=1, set_threads=True):
+        """
+        Args:
+            device: (str) torch device, None picks cuda:0, then mps, then cpu
+            precision: (str) One of fp32, fp16 or bf16, None picks fp16 on CUDA and fp32 elsewhere
+            intra_op_threads: (int) Threads used inside one operator, 0 uses one per physical core
+            inter_op_threads: (int) Threads running independent operators, 0 lets torch and ONNX Runtime decide
+            rvc_backend: (str) Runtime of the voice models, torch or onnx
+            rmvpe_backend: (str) Runtime of the RMVPE pitch model, torch, onnx or onnx-int8
+            rmvpe_chunk_frames: (int) Run RMVPE on batched overlapping windows of this many frames, 0 for one pass over the song
+            max_parallel_segments: (int) Vocal segments converted at once, each one holds its features and audio in memory
+            set_threads: (bool) Apply the thread counts to torch, process-wide
+        """
+        self.device = device or get_default_device()
+        if precision is None:
+            precision = 'fp16' if self.is_cuda else 'fp32'
+        if precision not in precisions:
+            raise ValueError(f'Unknown precision {precision}, use one of {", ".join(precisions)}')
+        if precision == 'fp16' and not self.is_cuda:
+            print(f'[~] fp16 is not supported on {self.device}, using fp32 instead')
+            precision = 'fp32'
+        if rvc_backend not in rvc_backends:
+            raise ValueError(f'Unknown RVC backend {rvc_backend}, use one of {", ".join(rvc_backends)}')
+        if rmvpe_backend not in rmvpe_backends:
+            raise ValueError(f'Unknown RMVPE backend {rmvpe_backend}, use one of {", ".join(rmvpe_backends)}')
+        self.precision = precision
+        self.rvc_backend = rvc_backend
+        self.rmvpe_backend = rmvpe_backend
+        self.rmvpe_chunk_frames = rmvpe_chunk_frames
+        self.max_parallel_segments = max(1, max_parallel_segments)
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        if set_threads:
+            self.apply_threads()
+
+    @property
+    def is_cuda(self):
+        return self.device.startswith('cuda')
+
+    @property
+    def is_half(self):
+        return self.precision == 'fp16'
+
+    @property
+    def num_threads(self):
+        return self.intra_op_threads or get_physical_cores()
+
+    @property
+    def mdx_processor(self):
+        """GPU index for MDX, -1 for the CPU. ONNX Runtime has no MPS provider, so MPS separates on the CPU"""
+        if not self.is_cuda:
+            return -1
+        return torch.device(self.device).index or 0
+
+    @property
+    def mdx_batch_size(self):
+        """Default MDX batch size, 0 sizes batches from the free GPU memory"""
+        return 0 if self.is_cuda else self.CPU_MDX_BATCH_SIZE
+
+    def apply_threads(self):
+        if self.is_cuda:
+            return
+        torch.set_num_threads(self.num_threads)
+        if self.inter_op_threads:
+            try:
+                torch.set_num_interop_threads(self.inter_op_threads)
+            except RuntimeError:
+                # can only be set before torch starts its first parallel work
+                pass
+
+    def autocast(self):
+        """Context for the torch forward passes, a bf16 autocast when bf16 is selected and a no-op otherwise"""
+        if self.precision == 'bf16':
+            return torch.autocast(device_type='cuda' if self.is_cuda else 'cpu', dtype=torch.bfloat16)
+        return nullcontext()
+
+    def get_ort_providers(self):
+        return ['CUDAExecutionProvider'] if self.mdx_processor >= 0 else ['CPUExecutionProvider']
+
+    def get_ort_session_options(self):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if self.mdx_processor < 0:
+            options.intra_op_num_threads = self.num_threads
+            options.inter_op_num_threads = self.inter_op_threads or 1
+            options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+            # spinning worker threads burn cores other stages could use between calls
+            options.add_session_config_entry('session.intra_op.allow_spinning', '0')
+        return options
+
+
+execution_profile = ExecutionProfile()
@@ -30,6 +30,13 @@ def kl_divergence(m_p, logs_p, m_q, logs_q):
     return kl
 
 
+def randn_like(x, generator=None):
+    """torch.randn_like drawing from generator when given, so that concurrent calls don't share the global RNG"""
+    if generator is None:
+        return torch.randn_like(x)
+    return torch.randn(x.shape, generator=generator, device=x.device, dtype=x.dtype)
+
+
 def rand_gumbel(shape):
     """Sample from the Gumbel distribution, protect from overflows."""
     uniform_samples = torch.rand(shape) * 0.99998 + 0.00001
@@ -573,7 +573,8 @@ class SynthesizerTrnMsNSFsidM(nn.Module):
         self.gin_channels = gin_channels
         # self.hop_length = hop_length#
         self.spk_embed_dim = spk_embed_dim
-        if self.gin_channels == 256:
+        # gin_channels is 256 for both versions, only the version tells the feature size apart
+        if kwargs.get("version", "v1") == "v1":
             self.enc_p = TextEncoder256(
                 inter_channels,
                 hidden_channels,
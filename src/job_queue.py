@@ -0,0 +1,369 @@
+"""
+Local job queue for AI covers, backed by SQLite so jobs survive restarts and can be submitted from other processes.
+
+Every job moves through the stages of main.cover_stages (download, separation, conversion, mixing), each one
+served by its own pool of worker threads with its own concurrency limit. A GPU-bound conversion then doesn't
+hold up the CPU-bound separation or mixing of other jobs, and each stage scales with its number of workers.
+
+Several processes can serve the same database. A claimed job holds a lease that its process renews while it runs,
+and only jobs whose lease ran out or whose process is gone are queued again.
+
+    python src/job_queue.py --conversion-workers 1 --separation-workers 2 --mixing-workers 4
+"""
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+
+from caches import cache_dir, get_key
+
+default_db_path = os.path.join(cache_dir, 'jobs.sqlite3')
+# workers per stage, conversion holds the GPU so it runs one job at a time by default
+default_concurrency = {'download': 2, 'separation': 1, 'conversion': 1, 'mixing': 2}
+# seconds a claimed job stays with its worker without a renewal, renewed every third of it
+default_lease_seconds = 60
+
+
+class JobFailed(Exception):
+    pass
+
+
+class JobQueue:
+    """
+    Persistent store of cover jobs. A job is queued, running, done or failed at one stage at a time, and
+    the state dict passed between stages is saved after each one, so a retry resumes at the failed stage.
+    """
+
+    def __init__(self, db_path=default_db_path):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        with self.connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                cache_key TEXT NOT NULL,
+                state TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                status TEXT NOT NULL,
+                priority INTEGER NOT NULL DEFAULT 0,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                result TEXT,
+                error TEXT,
+                worker TEXT,
+                lease REAL,
+                created REAL NOT NULL,
+                updated REAL NOT NULL)''')
+            # databases created before leases
+            columns = {row['name'] for row in db.execute('PRAGMA table_info(jobs)')}
+            for column, column_type in [('worker', 'TEXT'), ('lease', 'REAL')]:
+                if column not in columns:
+                    db.execute(f'ALTER TABLE jobs ADD COLUMN {column} {column_type}')
+            db.execute('CREATE INDEX IF NOT EXISTS jobs_next ON jobs (stage, status, priority DESC, id)')
+            db.execute('CREATE INDEX IF NOT EXISTS jobs_cache_key ON jobs (cache_key)')
+
+    def connect(self):
+        # a connection per call keeps threads and processes independent, SQLite does the locking
+        db = sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        return Connection(db)
+
+    def submit(self, state, cache_key, first_stage, priority=0):
+        """
+        Queue a job, unless a job with the same cache key is already queued, running or done with its
+        result still on disk, in which case that job's id is returned instead
+
+        Returns:
+            int: Job id
+        """
+        with self.connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            for job in db.execute("SELECT * FROM jobs WHERE cache_key = ? AND status != 'failed' ORDER BY id DESC", (cache_key,)):
+                if job['status'] != 'done' or (job['result'] and os.path.exists(job['result'])):
+                    if job['status'] == 'queued' and priority > job['priority']:
+                        db.execute('UPDATE jobs SET priority = ? WHERE id = ?', (priority, job['id']))
+                    db.execute('COMMIT')
+                    return job['id']
+            now = time.time()
+            job_id = db.execute('INSERT INTO jobs (cache_key, state, stage, status, priority, created, updated) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                (cache_key, json.dumps(state), first_stage, 'queued', priority, now, now)).lastrowid
+            db.execute('COMMIT')
+            return job_id
+
+    def claim(self, stage, worker, lease_seconds=default_lease_seconds):
+        """
+        Mark the highest priority, oldest queued job of a stage as running for worker, with a lease of lease_seconds
+        to renew while it runs, and return it, or None
+        """
+        with self.connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            job = db.execute("SELECT * FROM jobs WHERE stage = ? AND status = 'queued' ORDER BY priority DESC, id LIMIT 1", (stage,)).fetchone()
+            if job is not None:
+                now = time.time()
+                db.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1, worker = ?, lease = ?, updated = ? WHERE id = ?",
+                           (worker, now + lease_seconds, now, job['id']))
+            db.execute('COMMIT')
+        if job is None:
+            return None
+        job = self.to_dict(job)
+        job['attempts'] += 1
+        return job
+
+    def advance(self, job_id, worker, state, next_stage):
+        """
+        Save the state a stage returned and queue the job for the next stage, or mark it done if there is none
+
+        Returns:
+            bool: False if the job was no longer running for worker, e.g. requeued after its lease ran out
+        """
+        with self.connect() as db:
+            if next_stage is None:
+                return db.execute("UPDATE jobs SET state = ?, status = 'done', result = ?, worker = NULL, lease = NULL, updated = ? "
+                                  "WHERE id = ? AND status = 'running' AND worker = ?",
+                                  (json.dumps(state), state.get('result'), time.time(), job_id, worker)).rowcount > 0
+            return db.execute("UPDATE jobs SET state = ?, stage = ?, status = 'queued', attempts = 0, worker = NULL, lease = NULL, updated = ? "
+                              "WHERE id = ? AND status = 'running' AND worker = ?",
+                              (json.dumps(state), next_stage, time.time(), job_id, worker)).rowcount > 0
+
+    def fail(self, job_id, worker, error, retry):
+        """Queue the job at the same stage again if retry, or mark it failed, unless it is no longer running for worker"""
+        with self.connect() as db:
+            return db.execute("UPDATE jobs SET status = ?, error = ?, worker = NULL, lease = NULL, updated = ? WHERE id = ? AND status = 'running' AND worker = ?",
+                              ('queued' if retry else 'failed', error, time.time(), job_id, worker)).rowcount > 0
+
+    def renew(self, worker, lease_seconds=default_lease_seconds):
+        """Extend the lease of the jobs running for worker"""
+        with self.connect() as db:
+            return db.execute("UPDATE jobs SET lease = ? WHERE status = 'running' AND worker = ?", (time.time() + lease_seconds, worker)).rowcount
+
+    def requeue_abandoned(self):
+        """
+        Queue again the running jobs whose lease ran out, or whose worker was a process of this host that has exited,
+        so jobs of a crashed or killed process resume without touching those other processes are running
+        """
+        with self.connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            now = time.time()
+            abandoned = [job['id'] for job in db.execute("SELECT id, worker, lease FROM jobs WHERE status = 'running'")
+                         if job['lease'] is None or job['lease'] < now or not is_worker_alive(job['worker'])]
+            db.executemany("UPDATE jobs SET status = 'queued', worker = NULL, lease = NULL, updated = ? WHERE id = ?", [(now, job_id) for job_id in abandoned])
+            db.execute('COMMIT')
+        return len(abandoned)
+
+    def get(self, job_id):
+        with self.connect() as db:
+            job = db.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return self.to_dict(job) if job is not None else None
+
+    def counts(self):
+        """Number of jobs per (stage, status)"""
+        with self.connect() as db:
+            return {(row['stage'], row['status']): row['n'] for row in db.execute('SELECT stage, status, COUNT(*) AS n FROM jobs GROUP BY stage, status')}
+
+    @staticmethod
+    def to_dict(job):
+        job = dict(job)
+        job['state'] = json.loads(job['state'])
+        return job
+
+
+def get_worker_id():
+    """Id of this process as a worker, host:pid then a random suffix in case the pid is reused"""
+    return f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+
+def is_worker_alive(worker):
+    """False only for workers of this host whose process has exited, workers of other hosts rely on their lease"""
+    try:
+        host, pid, _ = worker.rsplit(':', 2)
+        pid = int(pid)
+    except (AttributeError, ValueError):
+        return False
+    if host != socket.gethostname():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Connection:
+    """sqlite3 connection that is closed, not just committed, on leaving a with block"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        return self.db
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is not None and self.db.in_transaction:
+            self.db.execute('ROLLBACK')
+        self.db.close()
+
+
+class JobService:
+    """
+    Worker threads serving a JobQueue, a pool per stage. Models stay loaded in the shared model registry,
+    so every worker of a stage converts with the same resident HuBERT, RMVPE and voice models.
+
+    Args:
+        queue: (JobQueue) Where jobs are stored
+        stages: (list) (name, function) pairs run in order, each function takes and returns the job state dict
+        concurrency: (dict) Worker threads per stage name, stages not listed get one
+        max_attempts: (int) Runs of a stage before its job is marked failed
+        poll_interval: (float) Seconds between looks for jobs submitted by other processes
+        lease_seconds: (float) How long a job of a process that stopped renewing it waits before running elsewhere
+    """
+
+    def __init__(self, queue=None, stages=None, concurrency=None, max_attempts=3, poll_interval=1.0, lease_seconds=default_lease_seconds):
+        if stages is None:
+            from main import cover_stages as stages
+        self.queue = queue or JobQueue()
+        self.stages = stages
+        self.concurrency = {**default_concurrency, **(concurrency or {})}
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.worker = get_worker_id()
+        self.wakeup = threading.Condition()
+        self.stopping = threading.Event()
+        self.threads = []
+
+    def start(self):
+        self.stopping.clear()
+        self.requeue_abandoned()
+        thread = threading.Thread(target=self.keep_leases, name='leases', daemon=True)
+        thread.start()
+        self.threads.append(thread)
+        for i, (stage, fn) in enumerate(self.stages):
+            next_stage = self.stages[i + 1][0] if i + 1 < len(self.stages) else None
+            for n in range(max(1, self.concurrency.get(stage, 1))):
+                thread = threading.Thread(target=self.work, args=(stage, fn, next_stage), name=f'{stage}-{n}', daemon=True)
+                thread.start()
+                self.threads.append(thread)
+        return self
+
+    def stop(self):
+        """Let the workers finish their current job and exit"""
+        self.stopping.set()
+        with self.wakeup:
+            self.wakeup.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def requeue_abandoned(self):
+        requeued = self.queue.requeue_abandoned()
+        if requeued:
+            print(f'[~] Resuming {requeued} interrupted jobs')
+            self.notify()
+
+    def keep_leases(self):
+        """Renew the leases of this process's jobs, and take back those of processes that stopped renewing theirs"""
+        while not self.stopping.wait(self.lease_seconds / 3):
+            try:
+                self.queue.renew(self.worker, self.lease_seconds)
+                self.requeue_abandoned()
+            except sqlite3.Error:
+                traceback.print_exc()
+
+    def notify(self):
+        with self.wakeup:
+            self.wakeup.notify_all()
+
+    def work(self, stage, fn, next_stage):
+        while not self.stopping.is_set():
+            job = self.queue.claim(stage, self.worker, self.lease_seconds)
+            if job is None:
+                with self.wakeup:
+                    self.wakeup.wait(self.poll_interval)
+                continue
+            try:
+                state = fn(job['state'])
+            except Exception as e:
+                retry = job['attempts'] < self.max_attempts
+                print(f'[!] Job {job["id"]} failed at {stage} (attempt {job["attempts"]}/{self.max_attempts}): {e}')
+                traceback.print_exc()
+                owned = self.queue.fail(job['id'], self.worker, f'{stage}: {e}', retry)
+            else:
+                owned = self.queue.advance(job['id'], self.worker, state, next_stage)
+            if not owned:
+                print(f'[!] Job {job["id"]} was requeued while at {stage}, its lease ran out, dropping this run')
+            self.notify()
+
+    def submit(self, params, priority=0):
+        """
+        Queue a cover with song_cover_pipeline keyword arguments (song_input, voice_model, pitch_change, ...).
+        The same song, voice and settings submitted again get the id of the existing job, and its cover once done.
+
+        Returns:
+            int: Job id
+        """
+        from main import get_rvc_model, get_song_id
+
+        # reject bad inputs now rather than in a worker, and key local files by content rather than path
+        _, _, song_id = get_song_id(params['song_input'], False)
+        get_rvc_model(params['voice_model'], False)
+        cache_key = get_key(song_id, {name: value for name, value in params.items() if name != 'song_input'})
+        job_id = self.queue.submit({'params': params}, cache_key, self.stages[0][0], priority)
+        self.notify()
+        return job_id
+
+    def wait(self, job_id, timeout=None, on_update=None):
+        """
+        Block until a job is done
+
+        Args:
+            on_update: (callable) Called with the job dict whenever its stage or status changes
+
+        Returns:
+            str: Path of the cover
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        last = None
+        while True:
+            job = self.queue.get(job_id)
+            if on_update is not None and (job['stage'], job['status']) != last:
+                on_update(job)
+                last = job['stage'], job['status']
+            if job['status'] == 'done':
+                return job['result']
+            if job['status'] == 'failed':
+                raise JobFailed(f'Job {job_id} failed at {job["error"]}')
+            if deadline is not None and time.time() > deadline:
+                raise TimeoutError(f'Job {job_id} is still {job["status"]} at {job["stage"]}')
+            with self.wakeup:
+                self.wakeup.wait(self.poll_interval)
+
+
+if __name__ == '__main__':
+    from execution import execution_profile
+
+    parser = argparse.ArgumentParser(description='Run job queue workers until interrupted, for covers submitted by the web UI or other processes.')
+    parser.add_argument('-db', '--db-path', type=str, default=default_db_path, help='Path of the SQLite job database')
+    for stage, workers in default_concurrency.items():
+        parser.add_argument(f'--{stage}-workers', type=int, default=workers, help=f'Worker threads of the {stage} stage')
+    parser.add_argument('--max-attempts', type=int, default=3, help='Runs of a stage before its job is marked failed')
+    parser.add_argument('-device', '--device', type=str, default=None, help='Torch device to run on, e.g. cuda:0 or cpu')
+    args = parser.parse_args()
+
+    execution_profile.configure(args.device)
+    service = JobService(JobQueue(args.db_path), concurrency={stage: getattr(args, f'{stage}_workers') for stage in default_concurrency},
+                         max_attempts=args.max_attempts).start()
+    print(f'[~] Serving jobs from {args.db_path}, Ctrl+C to stop')
+    try:
+        while True:
+            time.sleep(10)
+            pending = [f'{stage} {status}: {n}' for (stage, status), n in sorted(service.queue.counts().items()) if status != 'done']
+            if pending:
+                print(f'[~] {", ".join(pending)}')
+    except KeyboardInterrupt:
+        service.stop()
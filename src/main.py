@@ -1,10 +1,15 @@
 import argparse
+import copy
 import gc
 import hashlib
 import json
 import os
 import shlex
 import subprocess
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import suppress
 from urllib.parse import urlparse, parse_qs
 
@@ -18,8 +23,13 @@ from pedalboard import Pedalboard, Reverb, Compressor, HighpassFilter
 from pedalboard.io import AudioFile
 from pydub import AudioSegment
 
-from mdx import run_mdx
-from rvc import Config, load_hubert, get_vc, rvc_infer
+from batch import print_utilization, run_pipelined, write_summary
+from caches import f0_cache, feature_cache, get_audio_fingerprint, get_key, replace_file, stem_cache
+from execution import execution_profile, precisions, rmvpe_backends, rvc_backends
+from mdx import MDX, get_denoise_strategy, run_mdx, run_mdx_graph
+from model_registry import model_registry
+from profiling import profiler
+from rvc import rvc_infer
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
@@ -27,6 +37,15 @@ mdxnet_models_dir = os.path.join(BASE_DIR, 'mdxnet_models')
 rvc_models_dir = os.path.join(BASE_DIR, 'rvc_models')
 output_dir = os.path.join(BASE_DIR, 'song_output')
 
+song_locks = defaultdict(threading.Lock)
+song_locks_guard = threading.Lock()
+
+separation_models = ['UVR-MDX-NET-Voc_FT.onnx', 'UVR_MDXNET_KARA_2.onnx', 'Reverb_HQ_By_FoxJoy.onnx']
+# in the order preprocess_song returns their paths
+stem_names = ['Vocals', 'Instrumental', 'Main', 'Backup', 'DeReverb']
+# files picked up from a directory in batch mode
+audio_extensions = {'.mp3', '.wav', '.flac', '.ogg', '.m4a', '.aac', '.opus', '.wma', '.webm'}
+
 
 def get_youtube_video_id(url, ignore_playlist=True):
     """
@@ -60,6 +79,52 @@ def get_youtube_video_id(url, ignore_playlist=True):
     return None
 
 
+def is_playlist(song_input):
+    """A YouTube playlist link, rather than a video, which may also be in a playlist"""
+    if urlparse(song_input).scheme != 'https':
+        return False
+    return get_youtube_video_id(song_input) is None and get_youtube_video_id(song_input, ignore_playlist=False) is not None
+
+
+def get_playlist_urls(playlist_url):
+    """Video URLs of a YouTube playlist, without downloading anything"""
+    ydl_opts = {'extract_flat': 'in_playlist', 'quiet': True, 'no_warnings': True, 'ignoreerrors': True}
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        playlist = ydl.extract_info(playlist_url, download=False)
+    return [f'https://www.youtube.com/watch?v={entry["id"]}' for entry in playlist.get('entries') or [] if entry]
+
+
+def get_directory_files(directory):
+    return [os.path.join(directory, file) for file in sorted(os.listdir(directory)) if os.path.splitext(file)[1].lower() in audio_extensions]
+
+
+def get_list_file_inputs(list_path):
+    """Songs of a text file with one YouTube link or audio file path per line, blank lines and # comments are skipped"""
+    with open(list_path, encoding='utf8') as infile:
+        lines = [line.strip() for line in infile]
+    return [line for line in lines if line and not line.startswith('#')]
+
+
+def get_batch_inputs(song_input):
+    """
+    Songs of a batch input, or None if song_input is a single song. Playlists within a text file are expanded too.
+
+    Args:
+        song_input: (str) A YouTube playlist URL, a .txt file of links and paths, or a directory of audio files
+    """
+    if is_playlist(song_input):
+        return get_playlist_urls(song_input)
+    path = song_input.strip('"')
+    if os.path.isdir(path):
+        return get_directory_files(path)
+    if os.path.isfile(path) and os.path.splitext(path)[1].lower() == '.txt':
+        song_inputs = []
+        for line in get_list_file_inputs(path):
+            song_inputs += get_playlist_urls(line) if is_playlist(line) else [line]
+        return song_inputs
+    return None
+
+
 def yt_download(link):
     ydl_opts = {
         'format': 'bestaudio',
@@ -123,10 +188,15 @@ def get_audio_paths(song_dir):
 
 
 def convert_to_stereo(audio_path):
-    wave, sr = librosa.load(audio_path, mono=False, sr=44100)
+    # read the header only when possible, decoding a long mix just to count channels costs a lot of memory
+    try:
+        is_mono = sf.info(audio_path).channels == 1
+    except RuntimeError:
+        wave, sr = librosa.load(audio_path, mono=False, sr=44100)
+        is_mono = type(wave[0]) != np.ndarray
 
     # check if mono
-    if type(wave[0]) != np.ndarray:
+    if is_mono:
         stereo_path = f'{os.path.splitext(audio_path)[0]}_stereo.wav'
         command = shlex.split(f'ffmpeg -y -loglevel error -i "{audio_path}" -ac 2 -f wav "{stereo_path}"')
         subprocess.run(command)
@@ -138,11 +208,13 @@ def convert_to_stereo(audio_path):
 def pitch_shift(audio_path, pitch_change):
     output_path = f'{os.path.splitext(audio_path)[0]}_p{pitch_change}.wav'
     if not os.path.exists(output_path):
-        y, sr = sf.read(audio_path)
-        tfm = sox.Transformer()
-        tfm.pitch(pitch_change)
-        y_shifted = tfm.build_array(input_array=y, sample_rate_in=sr)
-        sf.write(output_path, y_shifted, sr)
+        with profiler.stage('pitch_shift'):
+            y, sr = sf.read(audio_path)
+            tfm = sox.Transformer()
+            tfm.pitch(pitch_change)
+            y_shifted = tfm.build_array(input_array=y, sample_rate_in=sr)
+            # atomic, another cover of the same song may be reading it already
+            replace_file(output_path, lambda tmp_path: sf.write(tmp_path, y_shifted, sr, format='WAV'))
 
     return output_path
 
@@ -163,43 +235,115 @@ def display_progress(message, percent, is_webui, progress=None):
         print(message)
 
 
-def preprocess_song(song_input, mdx_model_params, song_id, is_webui, input_type, progress=None):
-    keep_orig = False
+def download_song(song_input, input_type, is_webui, progress=None):
+    """
+    Returns:
+        tuple: (orig_song_path, keep_orig), keep_orig is False for downloads, which are deleted once separated
+    """
     if input_type == 'yt':
         display_progress('[~] Downloading song...', 0, is_webui, progress)
         song_link = song_input.split('&')[0]
-        orig_song_path = yt_download(song_link)
-    elif input_type == 'local':
-        orig_song_path = song_input
-        keep_orig = True
-    else:
-        orig_song_path = None
+        with profiler.stage('download'):
+            return yt_download(song_link), False
+    if input_type == 'local':
+        return song_input, True
+    return None, False
+
+
+def preprocess_song(song_input, mdx_model_params, song_id, is_webui, input_type, progress=None, mdx_batch_size=0, separation_graph=True, keep_files=False, denoise='batched', stream=False, downloaded=None):
+    orig_song_path, keep_orig = downloaded or download_song(song_input, input_type, is_webui, progress)
 
     song_output_dir = os.path.join(output_dir, song_id)
     orig_song_path = convert_to_stereo(orig_song_path)
 
-    display_progress('[~] Separating Vocals from Instrumental...', 0.1, is_webui, progress)
-    vocals_path, instrumentals_path = run_mdx(mdx_model_params, song_output_dir, os.path.join(mdxnet_models_dir, 'UVR-MDX-NET-Voc_FT.onnx'), orig_song_path, denoise=True, keep_orig=keep_orig)
+    cache_key = None
+    if stem_cache.enabled:
+        display_progress('[~] Looking for already separated stems...', 0.05, is_webui, progress)
+        cache_key = get_stem_cache_key(orig_song_path, mdx_model_params, denoise)
+        stem_files = get_stem_files(orig_song_path, song_output_dir)
+        needed_stems = stem_names if keep_files else ['Instrumental', 'Backup', 'DeReverb']
+        if stem_cache.restore(cache_key, {name: stem_files[name] for name in needed_stems}):
+            if not keep_orig:
+                os.remove(orig_song_path)
+            return orig_song_path, *[stem_files[name] if name in needed_stems else None for name in stem_names]
+
+    # streaming bounds memory by going through files between models, the graph keeps whole stems in memory
+    if separation_graph and not stream:
+        paths = separate_song_graph(orig_song_path, mdx_model_params, song_output_dir, is_webui, keep_orig, keep_files, progress, mdx_batch_size, denoise)
+
+    else:
+        display_progress('[~] Separating Vocals from Instrumental...', 0.1, is_webui, progress)
+        vocals_path, instrumentals_path = run_mdx(mdx_model_params, song_output_dir, os.path.join(mdxnet_models_dir, 'UVR-MDX-NET-Voc_FT.onnx'), orig_song_path, denoise=denoise, keep_orig=keep_orig, batch_size=mdx_batch_size, stream=stream)
+
+        display_progress('[~] Separating Main Vocals from Backup Vocals...', 0.2, is_webui, progress)
+        backup_vocals_path, main_vocals_path = run_mdx(mdx_model_params, song_output_dir, os.path.join(mdxnet_models_dir, 'UVR_MDXNET_KARA_2.onnx'), vocals_path, suffix='Backup', invert_suffix='Main', denoise=denoise, batch_size=mdx_batch_size, stream=stream)
 
-    display_progress('[~] Separating Main Vocals from Backup Vocals...', 0.2, is_webui, progress)
-    backup_vocals_path, main_vocals_path = run_mdx(mdx_model_params, song_output_dir, os.path.join(mdxnet_models_dir, 'UVR_MDXNET_KARA_2.onnx'), vocals_path, suffix='Backup', invert_suffix='Main', denoise=True)
+        display_progress('[~] Applying DeReverb to Vocals...', 0.3, is_webui, progress)
+        _, main_vocals_dereverb_path = run_mdx(mdx_model_params, song_output_dir, os.path.join(mdxnet_models_dir, 'Reverb_HQ_By_FoxJoy.onnx'), main_vocals_path, invert_suffix='DeReverb', exclude_main=True, denoise=denoise, batch_size=mdx_batch_size, stream=stream)
 
-    display_progress('[~] Applying DeReverb to Vocals...', 0.3, is_webui, progress)
-    _, main_vocals_dereverb_path = run_mdx(mdx_model_params, song_output_dir, os.path.join(mdxnet_models_dir, 'Reverb_HQ_By_FoxJoy.onnx'), main_vocals_path, invert_suffix='DeReverb', exclude_main=True, denoise=True)
+        paths = orig_song_path, vocals_path, instrumentals_path, main_vocals_path, backup_vocals_path, main_vocals_dereverb_path
 
-    return orig_song_path, vocals_path, instrumentals_path, main_vocals_path, backup_vocals_path, main_vocals_dereverb_path
+    if cache_key is not None:
+        stem_cache.store(cache_key, {name: path for name, path in zip(stem_names, paths[1:]) if path is not None})
+
+    return paths
+
+
+def get_stem_files(orig_song_path, song_output_dir):
+    base_path = os.path.join(song_output_dir, os.path.splitext(os.path.basename(orig_song_path))[0])
+    return {
+        'Vocals': f'{base_path}_Vocals.wav',
+        'Instrumental': f'{base_path}_Instrumental.wav',
+        'Main': f'{base_path}_Vocals_Main.wav',
+        'Backup': f'{base_path}_Vocals_Backup.wav',
+        'DeReverb': f'{base_path}_Vocals_Main_DeReverb.wav',
+    }
+
+
+def get_stem_cache_key(orig_song_path, mdx_model_params, denoise):
+    """Key of a song's stems in the stem cache, from its decoded audio and the separation models and settings"""
+    models = []
+    for model_name in separation_models:
+        model_hash = MDX.get_hash(os.path.join(mdxnet_models_dir, model_name))
+        models.append([model_hash, mdx_model_params.get(model_hash)])
+    # batched gives the same output as average
+    denoise = get_denoise_strategy(denoise)
+    denoise = 'average' if denoise == 'batched' else denoise
+    return get_key(get_audio_fingerprint(orig_song_path), models, denoise)
+
+
+def separate_song_graph(orig_song_path, mdx_model_params, song_output_dir, is_webui, keep_orig, keep_files, progress=None, mdx_batch_size=0, denoise='batched'):
+    """Same separation as preprocess_song's run_mdx chain, but the song is decoded once and intermediate stems stay in memory"""
+    stages = [
+        {'model_path': os.path.join(mdxnet_models_dir, 'UVR-MDX-NET-Voc_FT.onnx'), 'input': None, 'denoise': denoise,
+         'message': '[~] Separating Vocals from Instrumental...', 'percent': 0.1},
+        {'model_path': os.path.join(mdxnet_models_dir, 'UVR_MDXNET_KARA_2.onnx'), 'input': 'Vocals', 'suffix': 'Backup', 'invert_suffix': 'Main', 'denoise': denoise,
+         'message': '[~] Separating Main Vocals from Backup Vocals...', 'percent': 0.2},
+        {'model_path': os.path.join(mdxnet_models_dir, 'Reverb_HQ_By_FoxJoy.onnx'), 'input': 'Main', 'invert_suffix': 'DeReverb', 'exclude_main': True, 'denoise': denoise,
+         'message': '[~] Applying DeReverb to Vocals...', 'percent': 0.3},
+    ]
+    # only the stems used for the final mix are needed on disk, the rest are intermediate
+    write_stems = {'Instrumental', 'Backup', 'DeReverb'}
+    if keep_files:
+        write_stems |= {'Vocals', 'Main'}
+
+    stem_paths = run_mdx_graph(mdx_model_params, song_output_dir, orig_song_path, stages, write_stems, keep_orig=keep_orig, batch_size=mdx_batch_size,
+                               on_stage=lambda stage: display_progress(stage['message'], stage['percent'], is_webui, progress))
+
+    return orig_song_path, stem_paths['Vocals'], stem_paths['Instrumental'], stem_paths['Main'], stem_paths['Backup'], stem_paths['DeReverb']
 
 
 def voice_change(voice_model, vocals_path, output_path, pitch_change, f0_method, index_rate, filter_radius, rms_mix_rate, protect, crepe_hop_length, is_webui):
     rvc_model_path, rvc_index_path = get_rvc_model(voice_model, is_webui)
-    device = 'cuda:0'
-    config = Config(device, True)
-    hubert_model = load_hubert(device, config.is_half, os.path.join(rvc_models_dir, 'hubert_base.pt'))
-    cpt, version, net_g, tgt_sr, vc = get_vc(device, config.is_half, config, rvc_model_path)
+    device = execution_profile.device
+    # models stay resident in the registry between songs, only evicted when over its memory budget
+    config = model_registry.get_config(device, execution_profile.is_half)
+    hubert_model = model_registry.get_hubert(device, config.is_half, os.path.join(rvc_models_dir, 'hubert_base.pt'))
+    cpt, version, net_g, tgt_sr, vc = model_registry.get_vc(device, config.is_half, config, rvc_model_path, execution_profile.rvc_backend)
 
     # convert main vocals
-    rvc_infer(rvc_index_path, index_rate, vocals_path, output_path, pitch_change, f0_method, cpt, version, net_g, filter_radius, tgt_sr, rms_mix_rate, protect, crepe_hop_length, vc, hubert_model)
-    del hubert_model, cpt
+    with profiler.stage('conversion', voice_model=voice_model):
+        rvc_infer(rvc_index_path, index_rate, vocals_path, output_path, pitch_change, f0_method, cpt, version, net_g, filter_radius, tgt_sr, rms_mix_rate, protect, crepe_hop_length, vc, hubert_model)
     gc.collect()
 
 
@@ -215,7 +359,7 @@ def add_audio_effects(audio_path, reverb_rm_size, reverb_wet, reverb_dry, reverb
          ]
     )
 
-    with AudioFile(audio_path) as f:
+    with AudioFile(audio_path) as f, profiler.stage('effects'):
         with AudioFile(output_path, 'w', f.samplerate, f.num_channels) as o:
             # Read one second of audio at a time, until the file is empty:
             while f.tell() < f.frames:
@@ -227,99 +371,356 @@ def add_audio_effects(audio_path, reverb_rm_size, reverb_wet, reverb_dry, reverb
 
 
 def combine_audio(audio_paths, output_path, main_gain, backup_gain, inst_gain, output_format):
-    main_vocal_audio = AudioSegment.from_wav(audio_paths[0]) - 4 + main_gain
-    backup_vocal_audio = AudioSegment.from_wav(audio_paths[1]) - 6 + backup_gain
-    instrumental_audio = AudioSegment.from_wav(audio_paths[2]) - 7 + inst_gain
-    main_vocal_audio.overlay(backup_vocal_audio).overlay(instrumental_audio).export(output_path, format=output_format)
+    with profiler.stage('mix'):
+        main_vocal_audio = AudioSegment.from_wav(audio_paths[0]) - 4 + main_gain
+        backup_vocal_audio = AudioSegment.from_wav(audio_paths[1]) - 6 + backup_gain
+        instrumental_audio = AudioSegment.from_wav(audio_paths[2]) - 7 + inst_gain
+        mixed_audio = main_vocal_audio.overlay(backup_vocal_audio).overlay(instrumental_audio)
+    with profiler.stage('encode', format=output_format):
+        mixed_audio.export(output_path, format=output_format)
+
+
+def get_song_id(song_input, is_webui):
+    # if youtube url
+    if urlparse(song_input).scheme == 'https':
+        input_type = 'yt'
+        song_id = get_youtube_video_id(song_input)
+        if song_id is None:
+            error_msg = 'Invalid YouTube url.'
+            raise_exception(error_msg, is_webui)
+
+    # local audio file
+    else:
+        input_type = 'local'
+        song_input = song_input.strip('\"')
+        if os.path.exists(song_input):
+            song_id = get_hash(song_input)
+        else:
+            error_msg = f'{song_input} does not exist.'
+            song_id = None
+            raise_exception(error_msg, is_webui)
+
+    return song_input, input_type, song_id
+
+
+def prepare_song(song_input, keep_files, is_webui, progress=None, mdx_batch_size=0, separation_graph=True, denoise='batched', stream_separation=False):
+    """
+    Download and separate a song, or reuse its stems from an earlier run
+
+    Returns:
+        tuple: (song_dir, orig_song_path, vocals_path, instrumentals_path, main_vocals_path, backup_vocals_path, main_vocals_dereverb_path)
+    """
+    mdx_model_params = load_mdx_model_params()
+
+    song_input, input_type, song_id = get_song_id(song_input, is_webui)
+    song_dir = os.path.join(output_dir, song_id)
+
+    paths = get_separated_paths(song_dir, keep_files)
+    if paths is None:
+        os.makedirs(song_dir, exist_ok=True)
+        paths = preprocess_song(song_input, mdx_model_params, song_id, is_webui, input_type, progress, mdx_batch_size, separation_graph, keep_files, denoise, stream_separation)
+
+    return (song_dir, *paths)
+
+
+def get_separated_paths(song_dir, keep_files):
+    """
+    Stems left in song_dir by an earlier run, in the order preprocess_song returns them,
+    or None if the song has to be separated (again)
+    """
+    if not os.path.exists(song_dir):
+        return None
+    paths = get_audio_paths(song_dir)
+
+    # if any of the audio files aren't available or keep intermediate files, rerun preprocess
+    if any(path is None for path in paths) or keep_files:
+        return None
+    orig_song_path, instrumentals_path, main_vocals_dereverb_path, backup_vocals_path = paths
+    return orig_song_path, None, instrumentals_path, None, backup_vocals_path, main_vocals_dereverb_path
+
+
+def load_mdx_model_params():
+    with open(os.path.join(mdxnet_models_dir, 'model_data.json')) as infile:
+        return json.load(infile)
+
+
+def get_ai_vocals_path(song_dir, orig_song_path, voice_model, pitch_change, index_rate, filter_radius, rms_mix_rate, protect, f0_method, crepe_hop_length):
+    return os.path.join(song_dir, f'{os.path.splitext(os.path.basename(orig_song_path))[0]}_{voice_model}_p{pitch_change}_i{index_rate}_fr{filter_radius}_rms{rms_mix_rate}_pro{protect}_{f0_method}{"" if f0_method != "mangio-crepe" else f"_{crepe_hop_length}"}.wav')
+
+
+def get_ai_cover_path(song_dir, orig_song_path, voice_model, output_format):
+    return os.path.join(song_dir, f'{os.path.splitext(os.path.basename(orig_song_path))[0]} ({voice_model} Ver).{output_format}')
+
+
+def mix_cover(ai_vocals_path, backup_vocals_path, instrumentals_path, ai_cover_path, main_gain, backup_gain, inst_gain, pitch_change_all,
+              reverb_rm_size, reverb_wet, reverb_dry, reverb_damping, output_format, is_webui, progress=None):
+    """
+    Add effects to the AI vocals and mix them with the backup vocals and instrumentals
+
+    Returns:
+        list: Intermediate files created while mixing
+    """
+    display_progress('[~] Applying audio effects to Vocals...', 0.8, is_webui, progress)
+    ai_vocals_mixed_path = add_audio_effects(ai_vocals_path, reverb_rm_size, reverb_wet, reverb_dry, reverb_damping)
+    intermediate_files = [ai_vocals_mixed_path]
+
+    if pitch_change_all != 0:
+        display_progress('[~] Applying overall pitch change', 0.85, is_webui, progress)
+        instrumentals_path = pitch_shift(instrumentals_path, pitch_change_all)
+        backup_vocals_path = pitch_shift(backup_vocals_path, pitch_change_all)
+        intermediate_files += [instrumentals_path, backup_vocals_path]
+
+    display_progress('[~] Combining AI Vocals and Instrumentals...', 0.9, is_webui, progress)
+    combine_audio([ai_vocals_mixed_path, backup_vocals_path, instrumentals_path], ai_cover_path, main_gain, backup_gain, inst_gain, output_format)
+    return intermediate_files
+
+
+def remove_intermediate_files(intermediate_files, is_webui, progress=None):
+    display_progress('[~] Removing intermediate audio files...', 0.95, is_webui, progress)
+    for file in intermediate_files:
+        if file and os.path.exists(file):
+            os.remove(file)
 
 
 def song_cover_pipeline(song_input, voice_model, pitch_change, keep_files,
                         is_webui=0, main_gain=0, backup_gain=0, inst_gain=0, index_rate=0.5, filter_radius=3,
                         rms_mix_rate=0.25, f0_method='rmvpe', crepe_hop_length=128, protect=0.33, pitch_change_all=0,
                         reverb_rm_size=0.15, reverb_wet=0.2, reverb_dry=0.8, reverb_damping=0.7, output_format='mp3',
-                        progress=gr.Progress()):
+                        mdx_batch_size=0, separation_graph=True, denoise='batched', stream_separation=False, progress=gr.Progress()):
     try:
         if not song_input or not voice_model:
             raise_exception('Ensure that the song input field and voice model field is filled.', is_webui)
 
         display_progress('[~] Starting AI Cover Generation Pipeline...', 0, is_webui, progress)
 
-        with open(os.path.join(mdxnet_models_dir, 'model_data.json')) as infile:
-            mdx_model_params = json.load(infile)
+        song_dir, orig_song_path, vocals_path, instrumentals_path, main_vocals_path, backup_vocals_path, main_vocals_dereverb_path = prepare_song(
+            song_input, keep_files, is_webui, progress, mdx_batch_size, separation_graph, denoise, stream_separation)
 
-        # if youtube url
-        if urlparse(song_input).scheme == 'https':
-            input_type = 'yt'
-            song_id = get_youtube_video_id(song_input)
-            if song_id is None:
-                error_msg = 'Invalid YouTube url.'
-                raise_exception(error_msg, is_webui)
+        pitch_change = pitch_change * 12 + pitch_change_all
+        ai_vocals_path = get_ai_vocals_path(song_dir, orig_song_path, voice_model, pitch_change, index_rate, filter_radius, rms_mix_rate, protect, f0_method, crepe_hop_length)
+        ai_cover_path = get_ai_cover_path(song_dir, orig_song_path, voice_model, output_format)
 
-        # local audio file
-        else:
-            input_type = 'local'
-            song_input = song_input.strip('\"')
-            if os.path.exists(song_input):
-                song_id = get_hash(song_input)
-            else:
-                error_msg = f'{song_input} does not exist.'
-                song_id = None
-                raise_exception(error_msg, is_webui)
+        if not os.path.exists(ai_vocals_path):
+            display_progress('[~] Converting voice using RVC...', 0.5, is_webui, progress)
+            voice_change(voice_model, main_vocals_dereverb_path, ai_vocals_path, pitch_change, f0_method, index_rate, filter_radius, rms_mix_rate, protect, crepe_hop_length, is_webui)
 
-        song_dir = os.path.join(output_dir, song_id)
+        intermediate_files = mix_cover(ai_vocals_path, backup_vocals_path, instrumentals_path, ai_cover_path, main_gain, backup_gain, inst_gain, pitch_change_all,
+                                       reverb_rm_size, reverb_wet, reverb_dry, reverb_damping, output_format, is_webui, progress)
 
-        if not os.path.exists(song_dir):
-            os.makedirs(song_dir)
-            orig_song_path, vocals_path, instrumentals_path, main_vocals_path, backup_vocals_path, main_vocals_dereverb_path = preprocess_song(song_input, mdx_model_params, song_id, is_webui, input_type, progress)
+        if not keep_files:
+            remove_intermediate_files([vocals_path, main_vocals_path] + intermediate_files, is_webui, progress)
 
-        else:
-            vocals_path, main_vocals_path = None, None
-            paths = get_audio_paths(song_dir)
+        return ai_cover_path
 
-            # if any of the audio files aren't available or keep intermediate files, rerun preprocess
-            if any(path is None for path in paths) or keep_files:
-                orig_song_path, vocals_path, instrumentals_path, main_vocals_path, backup_vocals_path, main_vocals_dereverb_path = preprocess_song(song_input, mdx_model_params, song_id, is_webui, input_type, progress)
-            else:
-                orig_song_path, instrumentals_path, main_vocals_dereverb_path, backup_vocals_path = paths
+    except Exception as e:
+        raise_exception(str(e), is_webui)
 
-        pitch_change = pitch_change * 12 + pitch_change_all
-        ai_vocals_path = os.path.join(song_dir, f'{os.path.splitext(os.path.basename(orig_song_path))[0]}_{voice_model}_p{pitch_change}_i{index_rate}_fr{filter_radius}_rms{rms_mix_rate}_pro{protect}_{f0_method}{"" if f0_method != "mangio-crepe" else f"_{crepe_hop_length}"}.wav')
-        ai_cover_path = os.path.join(song_dir, f'{os.path.splitext(os.path.basename(orig_song_path))[0]} ({voice_model} Ver).{output_format}')
 
-        if not os.path.exists(ai_vocals_path):
-            display_progress('[~] Converting voice using RVC...', 0.5, is_webui, progress)
-            voice_change(voice_model, main_vocals_dereverb_path, ai_vocals_path, pitch_change, f0_method, index_rate, filter_radius, rms_mix_rate, protect, crepe_hop_length, is_webui)
+def multi_voice_cover_pipeline(song_input, voice_models, pitch_change, keep_files,
+                               is_webui=0, main_gain=0, backup_gain=0, inst_gain=0, index_rate=0.5, filter_radius=3,
+                               rms_mix_rate=0.25, f0_method='rmvpe', crepe_hop_length=128, protect=0.33, pitch_change_all=0,
+                               reverb_rm_size=0.15, reverb_wet=0.2, reverb_dry=0.8, reverb_damping=0.7, output_format='mp3',
+                               mdx_batch_size=0, separation_graph=True, denoise='batched', stream_separation=False, mix_workers=1,
+                               progress=gr.Progress()):
+    """
+    Render one song with several voice models. The song is separated once, pitch and HuBERT features are
+    extracted for the first voice and read back from the f0/feature caches for the others, then each voice
+    is converted in turn while the previous covers are mixed on mix_workers background threads.
+
+    Returns:
+        list: Path of the cover for each voice model, in the same order
+    """
+    try:
+        if not song_input or not voice_models:
+            raise_exception('Ensure that the song input field and voice model field is filled.', is_webui)
+
+        # fail before separating if any model is missing
+        for voice_model in voice_models:
+            get_rvc_model(voice_model, is_webui)
+
+        if not f0_cache.enabled or not feature_cache.enabled:
+            print('[~] The f0 or feature cache is disabled, pitch and HuBERT features will be extracted again for every voice')
+
+        display_progress('[~] Starting AI Cover Generation Pipeline...', 0, is_webui, progress)
 
-        display_progress('[~] Applying audio effects to Vocals...', 0.8, is_webui, progress)
-        ai_vocals_mixed_path = add_audio_effects(ai_vocals_path, reverb_rm_size, reverb_wet, reverb_dry, reverb_damping)
+        song_dir, orig_song_path, vocals_path, instrumentals_path, main_vocals_path, backup_vocals_path, main_vocals_dereverb_path = prepare_song(
+            song_input, keep_files, is_webui, progress, mdx_batch_size, separation_graph, denoise, stream_separation)
 
         if pitch_change_all != 0:
-            display_progress('[~] Applying overall pitch change', 0.85, is_webui, progress)
-            instrumentals_path = pitch_shift(instrumentals_path, pitch_change_all)
-            backup_vocals_path = pitch_shift(backup_vocals_path, pitch_change_all)
+            # shift once up front, the mixes then find the shifted files instead of racing to write them
+            display_progress('[~] Applying overall pitch change', 0.45, is_webui, progress)
+            pitch_shift(instrumentals_path, pitch_change_all)
+            pitch_shift(backup_vocals_path, pitch_change_all)
 
-        display_progress('[~] Combining AI Vocals and Instrumentals...', 0.9, is_webui, progress)
-        combine_audio([ai_vocals_mixed_path, backup_vocals_path, instrumentals_path], ai_cover_path, main_gain, backup_gain, inst_gain, output_format)
+        pitch_change = pitch_change * 12 + pitch_change_all
+        ai_cover_paths = []
+        mixes = []
+        # conversion keeps the GPU busy while mixing, which is CPU only, runs alongside it
+        with ThreadPoolExecutor(max_workers=mix_workers) as mix_pool:
+            for i, voice_model in enumerate(voice_models):
+                ai_vocals_path = get_ai_vocals_path(song_dir, orig_song_path, voice_model, pitch_change, index_rate, filter_radius, rms_mix_rate, protect, f0_method, crepe_hop_length)
+                ai_cover_path = get_ai_cover_path(song_dir, orig_song_path, voice_model, output_format)
+
+                if not os.path.exists(ai_vocals_path):
+                    display_progress(f'[~] Converting voice using RVC ({voice_model}, {i + 1}/{len(voice_models)})...', 0.5, is_webui, progress)
+                    voice_change(voice_model, main_vocals_dereverb_path, ai_vocals_path, pitch_change, f0_method, index_rate, filter_radius, rms_mix_rate, protect, crepe_hop_length, is_webui)
+
+                mixes.append(mix_pool.submit(mix_cover, ai_vocals_path, backup_vocals_path, instrumentals_path, ai_cover_path, main_gain, backup_gain, inst_gain, pitch_change_all,
+                                             reverb_rm_size, reverb_wet, reverb_dry, reverb_damping, output_format, is_webui, progress))
+                ai_cover_paths.append(ai_cover_path)
+
+            intermediate_files = [vocals_path, main_vocals_path]
+            for mix in mixes:
+                intermediate_files += mix.result()
 
         if not keep_files:
-            display_progress('[~] Removing intermediate audio files...', 0.95, is_webui, progress)
-            intermediate_files = [vocals_path, main_vocals_path, ai_vocals_mixed_path]
-            if pitch_change_all != 0:
-                intermediate_files += [instrumentals_path, backup_vocals_path]
-            for file in intermediate_files:
-                if file and os.path.exists(file):
-                    os.remove(file)
+            remove_intermediate_files(list(dict.fromkeys(intermediate_files)), is_webui, progress)
 
-        return ai_cover_path
+        return ai_cover_paths
 
     except Exception as e:
         raise_exception(str(e), is_webui)
 
 
+def get_song_lock(song_dir):
+    """Lock held while a song's stems are written or mixed from, so concurrent covers of one song don't race"""
+    with song_locks_guard:
+        return song_locks[song_dir]
+
+
+def cover_download(state):
+    """
+    First stage of a cover run as separate steps, used by the job queue. Every stage takes and returns a
+    JSON-serializable state dict, starting as {'params': song_cover_pipeline keyword arguments}.
+    Downloads the song, unless its stems are already separated.
+    """
+    params = state['params']
+    song_input, input_type, song_id = get_song_id(params['song_input'], False)
+    song_dir = os.path.join(output_dir, song_id)
+    state.update(song_input=song_input, input_type=input_type, song_id=song_id, song_dir=song_dir, downloaded=None)
+    if get_separated_paths(song_dir, params.get('keep_files', False)) is None:
+        state['downloaded'] = download_song(song_input, input_type, False)
+    return state
+
+
+def cover_separate(state):
+    """Separates the downloaded song, or picks up stems from an earlier run"""
+    params = state['params']
+    song_dir = state['song_dir']
+    keep_files = params.get('keep_files', False)
+    with get_song_lock(song_dir):
+        # another job may have separated the song since this one was downloaded
+        paths = get_separated_paths(song_dir, keep_files)
+        if paths is None:
+            os.makedirs(song_dir, exist_ok=True)
+            paths = preprocess_song(state['song_input'], load_mdx_model_params(), state['song_id'], False, state['input_type'], None,
+                                    params.get('mdx_batch_size', 0), params.get('separation_graph', True), keep_files,
+                                    params.get('denoise', 'batched'), params.get('stream_separation', False), state['downloaded'])
+        elif state['downloaded'] and not state['downloaded'][1] and os.path.exists(state['downloaded'][0]):
+            os.remove(state['downloaded'][0])
+    state['stems'] = dict(zip(['Orig'] + stem_names, paths))
+    return state
+
+
+def cover_convert(state):
+    """Converts the main vocals with the voice model, unless the same conversion was done before"""
+    params = state['params']
+    pitch_change = params['pitch_change'] * 12 + params.get('pitch_change_all', 0)
+    conversion = {name: params.get(name, default) for name, default in
+                  [('index_rate', 0.5), ('filter_radius', 3), ('rms_mix_rate', 0.25), ('protect', 0.33), ('f0_method', 'rmvpe'), ('crepe_hop_length', 128)]}
+    ai_vocals_path = get_ai_vocals_path(state['song_dir'], state['stems']['Orig'], params['voice_model'], pitch_change, **conversion)
+    if not os.path.exists(ai_vocals_path):
+        voice_change(params['voice_model'], state['stems']['DeReverb'], ai_vocals_path, pitch_change, conversion['f0_method'], conversion['index_rate'],
+                     conversion['filter_radius'], conversion['rms_mix_rate'], conversion['protect'], conversion['crepe_hop_length'], False)
+    state['ai_vocals_path'] = ai_vocals_path
+    return state
+
+
+def cover_mix(state):
+    """Mixes the converted vocals into the cover, whose path is the result of the run"""
+    params = state['params']
+    stems = state['stems']
+    ai_cover_path = get_ai_cover_path(state['song_dir'], stems['Orig'], params['voice_model'], params.get('output_format', 'mp3'))
+    with get_song_lock(state['song_dir']):
+        intermediate_files = mix_cover(state['ai_vocals_path'], stems['Backup'], stems['Instrumental'], ai_cover_path, params.get('main_gain', 0),
+                                       params.get('backup_gain', 0), params.get('inst_gain', 0), params.get('pitch_change_all', 0),
+                                       params.get('reverb_rm_size', 0.15), params.get('reverb_wet', 0.2), params.get('reverb_dry', 0.8),
+                                       params.get('reverb_damping', 0.7), params.get('output_format', 'mp3'), False)
+        if not params.get('keep_files', False):
+            remove_intermediate_files([stems['Vocals'], stems['Main']] + intermediate_files, False)
+    state['result'] = ai_cover_path
+    return state
+
+
+def split_voices(state):
+    """Copies of a song's state, one per voice model of params['voice_models'], to convert and mix each separately"""
+    params = {name: value for name, value in state['params'].items() if name != 'voice_models'}
+    return [dict(copy.deepcopy(state), params=dict(params, voice_model=voice_model)) for voice_model in state['params']['voice_models']]
+
+
+def cover_separate_voices(state):
+    """Separation stage of a batch, which downloads and separates each song once for all of its voice models"""
+    return split_voices(cover_separate(state))
+
+
+# a cover run split into stages that can run on separate workers, see job_queue.py and batch.py
+cover_stages = [('download', cover_download), ('separation', cover_separate), ('conversion', cover_convert), ('mixing', cover_mix)]
+
+
+def dedupe_song_inputs(song_inputs):
+    """
+    Drop songs given more than once, by content hash for local files and by video id for YouTube links,
+    and inputs that don't exist
+
+    Returns:
+        tuple: (unique song inputs in order, {'song_input', 'reason'} dicts of the ones left out)
+    """
+    unique = {}
+    skipped = []
+    for song_input in song_inputs:
+        try:
+            _, _, song_id = get_song_id(song_input, False)
+        except Exception as e:
+            skipped.append({'song_input': song_input, 'reason': str(e)})
+            continue
+        if song_id in unique:
+            skipped.append({'song_input': song_input, 'reason': f'same song as {unique[song_id]}'})
+        else:
+            unique[song_id] = song_input
+    return list(unique.values()), skipped
+
+
+def batch_cover_pipeline(song_inputs, voice_models, pitch_change, keep_files, queue_size=1, **kwargs):
+    """
+    Covers of several songs with each voice model, with the download, separation, conversion and mixing
+    stages running on their own threads so that they work on different songs at the same time.
+    Each song is downloaded and separated once, then converted and mixed with every voice model.
+
+    Args:
+        queue_size: (int) Songs waiting between two stages
+        kwargs: Other song_cover_pipeline options, except is_webui and progress
+
+    Returns:
+        tuple: (final state of each song and voice, with the cover path as 'result' or an 'error',
+                {stage name: batch.StageStats}, wall time)
+    """
+    # fail before downloading anything if any model is missing
+    for voice_model in voice_models:
+        get_rvc_model(voice_model, False)
+
+    states = [{'params': dict(kwargs, song_input=song_input, voice_models=list(voice_models), pitch_change=pitch_change, keep_files=keep_files)}
+              for song_input in song_inputs]
+    stages = [('download', cover_download), ('separation', cover_separate_voices), ('conversion', cover_convert), ('mixing', cover_mix)]
+    states, stats, wall_time = run_pipelined(states, stages, queue_size)
+    # songs that failed before separation are still one state, report them once per voice like the others
+    states = [split_state for state in states for split_state in (split_voices(state) if 'voice_models' in state['params'] else [state])]
+    return states, stats, wall_time
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Generate a AI cover song in the song_output/id directory.', add_help=True)
-    parser.add_argument('-i', '--song-input', type=str, required=True, help='Link to a YouTube video or the filepath to a local mp3/wav file to create an AI cover of')
-    parser.add_argument('-dir', '--rvc-dirname', type=str, required=True, help='Name of the folder in the rvc_models directory containing the RVC model file and optional index file to use')
+    parser.add_argument('-i', '--song-input', type=str, required=True, help='Link to a YouTube video or the filepath to a local mp3/wav file to create an AI cover of. A YouTube playlist or a directory of audio files makes covers of all of its songs in batch mode')
+    parser.add_argument('-dir', '--rvc-dirname', type=str, nargs='+', required=True, help='Name of the folder in the rvc_models directory containing the RVC model file and optional index file to use. Give several to render the song with each voice, separating it only once')
     parser.add_argument('-p', '--pitch-change', type=int, required=True, help='Change the pitch of AI Vocals only. Generally, use 1 for male to female and -1 for vice-versa. (Octaves)')
     parser.add_argument('-k', '--keep-files', action=argparse.BooleanOptionalAction, help='Whether to keep all intermediate audio files generated in the song_output/id directory, e.g. Isolated Vocals/Instrumentals')
     parser.add_argument('-ir', '--index-rate', type=float, default=0.5, help='A decimal number e.g. 0.5, used to reduce/resolve the timbre leakage problem. If set to 1, more biased towards the timbre quality of the training dataset')
@@ -337,19 +738,88 @@ if __name__ == '__main__':
     parser.add_argument('-rdry', '--reverb-dryness', type=float, default=0.8, help='Reverb dry level between 0 and 1')
     parser.add_argument('-rdamp', '--reverb-damping', type=float, default=0.7, help='Reverb damping between 0 and 1')
     parser.add_argument('-oformat', '--output-format', type=str, default='mp3', help='Output format of audio file. mp3 for smaller file size, wav for best quality')
+    parser.add_argument('-mdxbs', '--mdx-batch-size', type=int, default=0, help='Number of audio chunks sent to the MDX-Net separation models at once. 0 picks it from the available GPU memory, or the CPU default of the execution profile')
+    parser.add_argument('-sgraph', '--separation-graph', action=argparse.BooleanOptionalAction, default=True, help='Decode the song once and keep intermediate stems in memory between the separation models instead of writing and re-reading them')
+    parser.add_argument('-stream', '--stream-separation', action=argparse.BooleanOptionalAction, default=False, help='Separate the song a few seconds at a time so memory use stays the same for any length, e.g. for hour long mixes')
+    parser.add_argument('-dn', '--denoise', type=str, default='batched', choices=['average', 'batched', 'gate', 'none'], help='How the separation models are denoised. average: two passes on the song and its negation, batched: same as average in a single batched pass, gate: one pass and a spectral noise gate (fastest), none: no denoising')
+    parser.add_argument('-scache', '--stem-cache-gb', type=float, default=20, help='Size limit in GB of the cache of separated stems shared by all songs, 0 to disable it')
+    parser.add_argument('-f0cache', '--f0-cache-gb', type=float, default=1, help='Size limit in GB of the cache of pitch curves, reused when converting the same vocals again, 0 to disable it')
+    parser.add_argument('-fcache', '--feature-cache-gb', type=float, default=4, help='Size limit in GB of the cache of HuBERT features, reused when converting the same vocals with other voice models, 0 to disable it')
+    parser.add_argument('-mcache', '--model-cache-mb', type=int, default=4096, help='Memory budget in MB for keeping HuBERT, RMVPE and voice models loaded between conversions')
+    parser.add_argument('-mixw', '--mix-workers', type=int, default=1, help='With several RVC models, number of covers mixed in the background while the next voice is converted')
+    parser.add_argument('-device', '--device', type=str, default=None, help='Torch device to run on, e.g. cuda:0 or cpu. Defaults to the first GPU if there is one')
+    parser.add_argument('-precision', '--precision', type=str, choices=precisions, default=None, help='Numeric precision, fp16 needs a GPU and bf16 suits CPUs with AVX512-BF16/AMX. Defaults to fp16 on GPU and fp32 on CPU')
+    parser.add_argument('-threads', '--threads', type=int, default=0, help='Threads used inside each torch/ONNX Runtime operator on CPU. 0 uses one per physical core')
+    parser.add_argument('-interop', '--interop-threads', type=int, default=0, help='Threads running independent operators concurrently on CPU. 0 keeps the library default')
+    parser.add_argument('-backend', '--rvc-backend', type=str, choices=rvc_backends, default='torch', help='Runtime of the voice models. onnx exports each model once next to its .pth and runs it with ONNX Runtime. On CPU it measured only 1.05-1.33x faster than torch, check with src/benchmarks/bench_synthesizer.py before switching')
+    parser.add_argument('-rmvpebackend', '--rmvpe-backend', type=str, choices=rmvpe_backends, default='torch', help='Runtime of the RMVPE pitch model. onnx and onnx-int8 export it once next to rmvpe.pt and run it with ONNX Runtime')
+    parser.add_argument('-rmvpechunk', '--rmvpe-chunk-frames', type=int, default=0, help='Run RMVPE on batched, crossfaded windows of this many frames (100 per second) so its memory does not grow with the song length. 0 processes the song in one pass')
+    parser.add_argument('-summary', '--summary-json', type=str, default=None, help='In batch mode, where to write the JSON summary with the result and stage timings of each song. Defaults to song_output/batch_<date>_<time>.json')
+    parser.add_argument('-qsize', '--batch-queue-size', type=int, default=1, help='In batch mode, number of songs waiting between two stages. Larger values let downloads and separation run further ahead of conversion')
+    parser.add_argument('-profile', '--profile-json', type=str, default=None, help='Write the wall time, CPU time, peak RSS and peak GPU memory of every pipeline stage to this JSON file')
+    parser.add_argument('-ctrace', '--chrome-trace', type=str, default=None, help='Also write the stages as a Chrome trace to this file, to open in chrome://tracing or ui.perfetto.dev')
+    parser.add_argument('-psegs', '--parallel-segments', type=int, default=1, help='Number of vocal segments converted concurrently. Output is the same for any value, higher values use more memory')
     args = parser.parse_args()
 
-    rvc_dirname = args.rvc_dirname
-    if not os.path.exists(os.path.join(rvc_models_dir, rvc_dirname)):
-        raise Exception(f'The folder {os.path.join(rvc_models_dir, rvc_dirname)} does not exist.')
-
-    cover_path = song_cover_pipeline(args.song_input, rvc_dirname, args.pitch_change, args.keep_files,
-                                     main_gain=args.main_vol, backup_gain=args.backup_vol, inst_gain=args.inst_vol,
-                                     index_rate=args.index_rate, filter_radius=args.filter_radius,
-                                     rms_mix_rate=args.rms_mix_rate, f0_method=args.pitch_detection_algo,
-                                     crepe_hop_length=args.crepe_hop_length, protect=args.protect,
-                                     pitch_change_all=args.pitch_change_all,
-                                     reverb_rm_size=args.reverb_size, reverb_wet=args.reverb_wetness,
-                                     reverb_dry=args.reverb_dryness, reverb_damping=args.reverb_damping,
-                                     output_format=args.output_format)
-    print(f'[+] Cover generated at {cover_path}')
+    execution_profile.configure(args.device, args.precision, args.threads, args.interop_threads, args.rvc_backend, args.rmvpe_backend,
+                                args.rmvpe_chunk_frames, args.parallel_segments)
+
+    model_registry.set_memory_budget(args.model_cache_mb)
+    stem_cache.set_max_size(args.stem_cache_gb)
+    f0_cache.set_max_size(args.f0_cache_gb)
+    feature_cache.set_max_size(args.feature_cache_gb)
+    if args.profile_json or args.chrome_trace:
+        profiler.enable()
+
+    for rvc_dirname in args.rvc_dirname:
+        if not os.path.exists(os.path.join(rvc_models_dir, rvc_dirname)):
+            raise Exception(f'The folder {os.path.join(rvc_models_dir, rvc_dirname)} does not exist.')
+
+    pipeline_kwargs = dict(main_gain=args.main_vol, backup_gain=args.backup_vol, inst_gain=args.inst_vol,
+                           index_rate=args.index_rate, filter_radius=args.filter_radius,
+                           rms_mix_rate=args.rms_mix_rate, f0_method=args.pitch_detection_algo,
+                           crepe_hop_length=args.crepe_hop_length, protect=args.protect,
+                           pitch_change_all=args.pitch_change_all,
+                           reverb_rm_size=args.reverb_size, reverb_wet=args.reverb_wetness,
+                           reverb_dry=args.reverb_dryness, reverb_damping=args.reverb_damping,
+                           output_format=args.output_format, mdx_batch_size=args.mdx_batch_size,
+                           separation_graph=args.separation_graph, denoise=args.denoise,
+                           stream_separation=args.stream_separation)
+
+    batch_inputs = get_batch_inputs(args.song_input)
+    if batch_inputs is not None:
+        song_inputs, skipped = dedupe_song_inputs(batch_inputs)
+        for skip in skipped:
+            print(f'[~] Skipping {skip["song_input"]}: {skip["reason"]}')
+        if not song_inputs:
+            raise Exception(f'No songs found in {args.song_input}.')
+        # one process for the whole batch, so the separation and voice models stay resident in the model registry
+        print(f'[~] Making covers of {len(song_inputs)} songs with {len(args.rvc_dirname)} voices')
+        states, stage_stats, wall_time = batch_cover_pipeline(song_inputs, args.rvc_dirname, args.pitch_change, args.keep_files,
+                                                              args.batch_queue_size, **pipeline_kwargs)
+        for state in states:
+            if 'error' in state:
+                print(f'[!] {state["params"]["song_input"]} ({state["params"]["voice_model"]}) failed at {state["error"]}')
+            else:
+                print(f'[+] Cover generated at {state["result"]}')
+        print_utilization(stage_stats, wall_time)
+        summary_path = args.summary_json or os.path.join(output_dir, f'batch_{time.strftime("%Y%m%d_%H%M%S")}.json')
+        write_summary(summary_path, states, stage_stats, wall_time, skipped)
+        print(f'[+] Batch summary written to {summary_path}')
+    elif len(args.rvc_dirname) > 1:
+        cover_paths = multi_voice_cover_pipeline(args.song_input, args.rvc_dirname, args.pitch_change, args.keep_files,
+                                                 mix_workers=args.mix_workers, **pipeline_kwargs)
+        for rvc_dirname, cover_path in zip(args.rvc_dirname, cover_paths):
+            print(f'[+] Cover generated at {cover_path} ({rvc_dirname})')
+    else:
+        cover_path = song_cover_pipeline(args.song_input, args.rvc_dirname[0], args.pitch_change, args.keep_files, **pipeline_kwargs)
+        print(f'[+] Cover generated at {cover_path}')
+
+    if profiler.enabled:
+        profiler.print_summary()
+        if args.profile_json:
+            profiler.write_json(args.profile_json)
+            print(f'[+] Stage profile written to {args.profile_json}')
+        if args.chrome_trace:
+            profiler.write_chrome_trace(args.chrome_trace)
+            print(f'[+] Chrome trace written to {args.chrome_trace}')
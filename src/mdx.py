@@ -2,18 +2,38 @@ import gc
 import hashlib
 import os
 import queue
+import subprocess
 import threading
 import warnings
 
 import librosa
 import numpy as np
-import onnxruntime as ort
 import soundfile as sf
 import torch
 from tqdm import tqdm
 
+from execution import execution_profile
+from profiling import profiler
+
 warnings.filterwarnings("ignore")
 stem_naming = {'Vocals': 'Instrumental', 'Other': 'Instruments', 'Instrumental': 'Vocals', 'Drums': 'Drumless', 'Bass': 'Bassless'}
+# average: process the wave and its negation in two full passes and average them
+# batched: same result, but both signs go through STFT/ONNX/ISTFT together in one batch
+# gate: single pass followed by a spectral noise gate on the model output
+denoise_strategies = ['average', 'batched', 'gate']
+
+
+def get_denoise_strategy(denoise):
+    """
+    Map the denoise argument of run_mdx to a strategy name, True meaning the original two pass average
+    """
+    if denoise is True:
+        return 'average'
+    if not denoise or denoise == 'none':
+        return None
+    if denoise not in denoise_strategies:
+        raise ValueError(f'Unknown denoise strategy {denoise}, use one of {", ".join(denoise_strategies)}')
+    return denoise
 
 
 class MDXModel:
@@ -62,22 +82,72 @@ class MDX:
 
     DEFAULT_PROCESSOR = 0
 
-    def __init__(self, model_path: str, params: MDXModel, processor=DEFAULT_PROCESSOR):
+    # Number of chunks held in memory at a time by process_wave_stream
+    DEFAULT_WINDOW_CHUNKS = 16
+
+    # Number of chunks stacked into one ONNX call, 0 picks it from the available memory
+    DEFAULT_BATCH_SIZE = 0
+    MAX_BATCH_SIZE = 16
+    # Fraction of the free memory a batch is allowed to use when sizing it automatically
+    MEMORY_FRACTION = 0.5
+
+    # Spectral gate: bins quieter than the given percentile of their frequency row, raised by the threshold, are attenuated
+    GATE_PERCENTILE = 0.1
+    GATE_THRESHOLD_DB = 6
+
+    def __init__(self, model_path: str, params: MDXModel, processor=DEFAULT_PROCESSOR, batch_size=DEFAULT_BATCH_SIZE, denoise=None):
 
         # Set the device and the provider (CPU or CUDA)
         self.device = torch.device(f'cuda:{processor}') if processor >= 0 else torch.device('cpu')
         self.provider = ['CUDAExecutionProvider'] if processor >= 0 else ['CPUExecutionProvider']
 
         self.model = params
+        self.denoise = get_denoise_strategy(denoise)
+
+        # the session stays resident in the model registry, so each song doesn't create and warm it up again
+        from model_registry import model_registry
 
-        # Load the ONNX model using ONNX Runtime
-        self.ort = ort.InferenceSession(model_path, providers=self.provider)
-        # Preload the model for faster performance
-        self.ort.run(None, {'input': torch.rand(1, 4, params.dim_f, params.dim_t).numpy()})
+        self.ort = model_registry.get_mdx_session(model_path, self.provider, (1, 4, params.dim_f, params.dim_t))
         self.process = lambda spec: self.ort.run(None, {'input': spec.cpu().numpy()})[0]
 
+        # Models exported with a fixed batch dimension can't take more than that many chunks at once
+        input_batch_dim = self.ort.get_inputs()[0].shape[0]
+        self.max_batch_size = input_batch_dim if isinstance(input_batch_dim, int) else self.MAX_BATCH_SIZE
+        self.auto_batch_size = batch_size <= 0
+        self.batch_size = self.get_auto_batch_size() if self.auto_batch_size else min(batch_size, self.max_batch_size)
+
         self.prog = None
 
+    def get_free_memory(self):
+        """
+        Get the free memory of the processing device in bytes, or None if it can't be determined
+        """
+        try:
+            if self.device.type == 'cuda':
+                return torch.cuda.mem_get_info(self.device)[0]
+            return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+        except (AttributeError, ValueError, OSError, RuntimeError):
+            return None
+
+    def get_chunk_memory(self):
+        """
+        Rough estimate of the peak memory in bytes needed to process one chunk,
+        covering the STFT, the model input/output and the model activations
+        """
+        spec_bytes = 4 * self.model.n_bins * self.model.dim_t * 4
+        # batched denoising runs every chunk twice
+        return spec_bytes * 16 * (2 if self.denoise == 'batched' else 1)
+
+    def get_auto_batch_size(self):
+        """
+        Pick the number of chunks per ONNX call that fits in the currently free memory
+        """
+        free_memory = self.get_free_memory()
+        if free_memory is None:
+            return 1
+        batch_size = int(free_memory * self.MEMORY_FRACTION // self.get_chunk_memory())
+        return max(1, min(batch_size, self.max_batch_size))
+
     @staticmethod
     def get_hash(model_path):
         try:
@@ -105,16 +175,20 @@ class MDX:
         """
 
         if combine:
-            processed_wave = None  # Initializing as None instead of [] for later numpy array concatenation
+            cuts = []
             for segment_count, segment in enumerate(wave):
                 start = 0 if segment_count == 0 else margin_size
                 end = None if segment_count == len(wave) - 1 else -margin_size
                 if margin_size == 0:
                     end = None
-                if processed_wave is None:  # Create array for first segment
-                    processed_wave = segment[:, start:end]
-                else:  # Concatenate to existing array for subsequent segments
-                    processed_wave = np.concatenate((processed_wave, segment[:, start:end]), axis=-1)
+                cuts.append(segment[:, start:end])
+
+            # Copy every segment once into a preallocated array instead of growing it by concatenation
+            processed_wave = np.empty((cuts[0].shape[0], sum(cut.shape[-1] for cut in cuts)), dtype=cuts[0].dtype)
+            offset = 0
+            for cut in cuts:
+                processed_wave[:, offset:offset + cut.shape[-1]] = cut
+                offset += cut.shape[-1]
 
         else:
             processed_wave = []
@@ -159,17 +233,114 @@ class MDX:
         pad = gen_size - n_sample % gen_size
 
         # Padded wave
-        wave_p = np.concatenate((np.zeros((2, trim)), wave, np.zeros((2, pad)), np.zeros((2, trim))), 1)
-
-        mix_waves = []
-        for i in range(0, n_sample + pad, gen_size):
-            waves = np.array(wave_p[:, i:i + self.model.chunk_size])
-            mix_waves.append(waves)
+        wave_p = np.concatenate((np.zeros((2, trim), np.float32), wave, np.zeros((2, pad + trim), np.float32)), 1)
 
-        mix_waves = torch.tensor(mix_waves, dtype=torch.float32).to(self.device)
+        mix_waves = torch.from_numpy(self.get_chunks(wave_p, gen_size)).to(self.device)
 
         return mix_waves, pad, trim
 
+    def get_chunks(self, wave_p, gen_size):
+        """
+        Cut a padded wave into overlapping chunks of the model's chunk size, gen_size samples apart
+
+        Returns:
+            numpy array: Chunks of shape [n_chunks, 2, chunk_size]
+        """
+        windows = np.lib.stride_tricks.sliding_window_view(wave_p, self.model.chunk_size, axis=1)[:, ::gen_size]
+        return np.ascontiguousarray(windows.transpose(1, 0, 2), dtype=np.float32)
+
+    @staticmethod
+    def is_out_of_memory(error):
+        if isinstance(error, MemoryError):
+            return True
+        message = str(error).lower()
+        return 'out of memory' in message or 'alloc' in message
+
+    def process_batch(self, mix_wave, trim):
+        """
+        Run STFT, the ONNX model and ISTFT on a batch of chunks at once
+
+        Args:
+            mix_wave: (torch.Tensor) Chunks of shape [N, 2, chunk_size]
+            trim: (int) Number of samples to trim from both ends of each chunk
+
+        Returns:
+            numpy array: Processed chunks joined into one wave of shape [2, N * (chunk_size - 2 * trim)]
+        """
+        spec = self.model.stft(mix_wave)
+        if self.denoise == 'batched':
+            # STFT and ISTFT are linear, so averaging the model output for spec and -spec
+            # in the spectral domain gives the same result as averaging the two waves
+            n = spec.shape[0]
+            processed_spec = torch.tensor(self.process(torch.cat([spec, -spec])))
+            processed_spec = (processed_spec[:n] - processed_spec[n:]) * 0.5
+        else:
+            processed_spec = torch.tensor(self.process(spec))
+            if self.denoise == 'gate':
+                processed_spec = self.spectral_gate(processed_spec)
+        processed_wav = self.model.istft(processed_spec.to(self.device))
+        return processed_wav[:, :, trim:-trim].transpose(0, 1).reshape(2, -1).cpu().numpy()
+
+    def spectral_gate(self, spec):
+        """
+        Attenuate the low level noise the model leaves in its output, a cheaper stand-in for the two pass average
+
+        Args:
+            spec: (torch.Tensor) Model output of shape [N, 4, dim_f, dim_t], real and imaginary parts of both channels
+
+        Returns:
+            torch.Tensor: Gated spectrogram of the same shape
+        """
+        n, _, dim_f, dim_t = spec.shape
+        spec = spec.reshape([n, 2, 2, dim_f, dim_t])
+        power = spec.pow(2).sum(2, keepdim=True)
+        # per chunk, channel and frequency noise floor
+        noise_floor = torch.quantile(power, self.GATE_PERCENTILE, dim=-1, keepdim=True)
+        threshold = noise_floor * 10 ** (self.GATE_THRESHOLD_DB / 10)
+        mask = power / (power + threshold + 1e-12)
+        return (spec * mask).reshape([n, 4, dim_f, dim_t])
+
+    def _process_chunks(self, mix_waves, trim):
+        """
+        Run the model on chunks and join the results
+
+        Chunks are sent to the model self.batch_size at a time. The batch is halved when it runs
+        out of memory. When the batch size is picked automatically, it is doubled again once
+        enough memory frees up, up to the largest size that hasn't failed yet.
+
+        Args:
+            mix_waves: (torch.Tensor) Chunks of shape [n_chunks, 2, chunk_size]
+            trim: (int) Number of samples trimmed from both ends of each chunk
+
+        Returns:
+            numpy array: Processed wave of shape [2, n_chunks * (chunk_size - 2 * trim)]
+        """
+        with torch.no_grad():
+            pw = []
+            i = 0
+            while i < len(mix_waves):
+                batch_size = self.batch_size
+                try:
+                    processed_wav = self.process_batch(mix_waves[i:i + batch_size], trim)
+                except Exception as e:
+                    if batch_size == 1 or not self.is_out_of_memory(e):
+                        raise
+                    # never grow back to a size that didn't fit
+                    self.max_batch_size = min(self.max_batch_size, batch_size - 1)
+                    self.batch_size = max(1, batch_size // 2)
+                    gc.collect()
+                    if self.device.type == 'cuda':
+                        torch.cuda.empty_cache()
+                    continue
+
+                pw.append(processed_wav)
+                self.prog.update(min(batch_size, len(mix_waves) - i))
+                i += batch_size
+
+                if self.auto_batch_size and batch_size * 2 <= self.max_batch_size and self.get_auto_batch_size() >= batch_size * 2:
+                    self.batch_size = batch_size * 2
+        return np.concatenate(pw, axis=-1)
+
     def _process_wave(self, mix_waves, trim, pad, q: queue.Queue, _id: int):
         """
         Process each wave segment in a multi-threaded environment
@@ -184,17 +355,7 @@ class MDX:
         Returns:
             numpy array: Processed wave segment
         """
-        mix_waves = mix_waves.split(1)
-        with torch.no_grad():
-            pw = []
-            for mix_wave in mix_waves:
-                self.prog.update()
-                spec = self.model.stft(mix_wave)
-                processed_spec = torch.tensor(self.process(spec))
-                processed_wav = self.model.istft(processed_spec.to(self.device))
-                processed_wav = processed_wav[:, :, trim:-trim].transpose(0, 1).reshape(2, -1).cpu().numpy()
-                pw.append(processed_wav)
-        processed_signal = np.concatenate(pw, axis=-1)[:, :-pad]
+        processed_signal = self._process_chunks(mix_waves, trim)[:, :-pad]
         q.put({_id: processed_signal})
         return processed_signal
 
@@ -235,13 +396,58 @@ class MDX:
         return self.segment(processed_batches, True, chunk)
 
 
-def run_mdx(model_params, output_dir, model_path, filename, exclude_main=False, exclude_inversion=False, suffix=None, invert_suffix=None, denoise=False, keep_orig=True, m_threads=2):
-    device = torch.device('cuda:0') if torch.cuda.is_available() else torch.device('cpu')
+    def process_wave_stream(self, read_block, n_sample, out, out_scale=1.0, window_chunks=DEFAULT_WINDOW_CHUNKS):
+        """
+        Process a wave a few chunks at a time, so that memory use doesn't depend on its length
 
+        Gives the same result as process_wave with a single thread.
+
+        Args:
+            read_block: (callable) read_block(start, stop) returns the input samples in [start, stop)
+                as an array of shape [2, stop - start], with zeros outside of the wave
+            n_sample: (int) Length of the wave in samples
+            out: (np.array) Preallocated array or memory-mapped file of shape [2, n_sample],
+                the processed wave multiplied by out_scale is added to it
+            out_scale: (float) Scale applied to the processed wave before adding it to out
+            window_chunks: (int) Number of chunks read and processed at a time
+
+        Returns:
+            np.array: out
+        """
+        trim = self.model.n_fft // 2
+        gen_size = self.model.chunk_size - 2 * trim
+        # same chunk count as pad_wave, which always pads at least one sample
+        n_chunks = n_sample // gen_size + 1
+
+        self.prog = tqdm(total=n_chunks)
+        for first in range(0, n_chunks, window_chunks):
+            last = min(first + window_chunks, n_chunks)
+            # chunk i covers samples [i * gen_size - trim, i * gen_size - trim + chunk_size) of the wave
+            block = read_block(first * gen_size - trim, (last - 1) * gen_size - trim + self.model.chunk_size)
+            mix_waves = torch.from_numpy(self.get_chunks(block, gen_size)).to(self.device)
+            processed = self._process_chunks(mix_waves, trim)
+
+            start = first * gen_size
+            stop = min(start + processed.shape[-1], n_sample)
+            out[:, start:stop] += out_scale * processed[:, :stop - start]
+        self.prog.close()
+        return out
+
+
+def get_mdx_device():
+    processor = execution_profile.mdx_processor
+    if processor < 0:
+        # ONNX Runtime already spreads each call over its intra-op threads, splitting the wave only costs memory
+        return torch.device('cpu'), 1
+
+    device = torch.device(f'cuda:{processor}')
     device_properties = torch.cuda.get_device_properties(device)
     vram_gb = device_properties.total_memory / 1024**3
     m_threads = 1 if vram_gb < 8 else 2
+    return device, m_threads
+
 
+def load_mdx(model_params, model_path, device, batch_size=MDX.DEFAULT_BATCH_SIZE, denoise=None):
     model_hash = MDX.get_hash(model_path)
     mp = model_params.get(model_hash)
     model = MDXModel(
@@ -253,35 +459,234 @@ def run_mdx(model_params, output_dir, model_path, filename, exclude_main=False,
         compensation=mp["compensate"]
     )
 
-    mdx_sess = MDX(model_path, model)
-    wave, sr = librosa.load(filename, mono=False, sr=44100)
+    if batch_size <= 0:
+        batch_size = execution_profile.mdx_batch_size
+    processor = (device.index or 0) if device.type == 'cuda' else -1
+    mdx_sess = MDX(model_path, model, processor=processor, batch_size=batch_size, denoise=denoise)
+    return mdx_sess, model
+
+
+def separate_wave(mdx_sess, wave, m_threads=2):
+    """
+    Run an MDX model on a wave array, denoising it with the strategy the model was loaded with
+
+    Args:
+        mdx_sess: (MDX) Loaded model
+        wave: (np.array) Stereo wave array of shape [2, n_samples], left untouched
+        m_threads: (int) Number of threads to be used for processing
+
+    Returns:
+        tuple: (wave_processed, wave_normalized)
+            - wave_processed: Primary stem at the input's level
+            - wave_normalized: Input normalized to its peak, used to compute the inverted stem
+    """
     # normalizing input wave gives better output
     peak = max(np.max(wave), abs(np.min(wave)))
-    wave /= peak
-    if denoise:
+    wave = wave / peak
+    if mdx_sess.denoise == 'average':
         wave_processed = -(mdx_sess.process_wave(-wave, m_threads)) + (mdx_sess.process_wave(wave, m_threads))
         wave_processed *= 0.5
     else:
         wave_processed = mdx_sess.process_wave(wave, m_threads)
     # return to previous peak
     wave_processed *= peak
-    stem_name = model.stem_name if suffix is None else suffix
+    return wave_processed, wave
 
-    main_filepath = None
-    if not exclude_main:
-        main_filepath = os.path.join(output_dir, f"{os.path.basename(os.path.splitext(filename)[0])}_{stem_name}.wav")
-        sf.write(main_filepath, wave_processed.T, sr)
 
-    invert_filepath = None
-    if not exclude_inversion:
-        diff_stem_name = stem_naming.get(stem_name) if invert_suffix is None else invert_suffix
-        stem_name = f"{stem_name}_diff" if diff_stem_name is None else diff_stem_name
-        invert_filepath = os.path.join(output_dir, f"{os.path.basename(os.path.splitext(filename)[0])}_{stem_name}.wav")
-        sf.write(invert_filepath, (-wave_processed.T * model.compensation) + wave.T, sr)
+def get_stem_names(model, suffix=None, invert_suffix=None):
+    stem_name = model.stem_name if suffix is None else suffix
+    diff_stem_name = stem_naming.get(stem_name) if invert_suffix is None else invert_suffix
+    diff_stem_name = f"{stem_name}_diff" if diff_stem_name is None else diff_stem_name
+    return stem_name, diff_stem_name
+
+
+def can_stream(filename):
+    try:
+        info = sf.info(filename)
+    except RuntimeError:
+        return False
+    return info.samplerate == MDX.DEFAULT_SR and info.channels == 2
+
+
+def transcode_for_stream(filename, output_dir):
+    """
+    Decode an audio file run_mdx_stream can't read directly (another sample rate, mono, mp3 and other formats
+    libsndfile doesn't support) to a temporary 44.1 kHz stereo float WAV next to the outputs. ffmpeg resamples
+    and upmixes as it decodes, so this takes constant memory too.
+
+    Returns:
+        str: Path of the temporary file, for the caller to delete
+    """
+    wav_path = os.path.join(output_dir, f'.{os.path.basename(os.path.splitext(filename)[0])}.stream.wav')
+    command = ['ffmpeg', '-y', '-loglevel', 'error', '-i', filename, '-ac', '2', '-ar', str(MDX.DEFAULT_SR),
+               '-c:a', 'pcm_f32le', '-rf64', 'auto', wav_path]
+    subprocess.run(command, check=True)
+    return wav_path
+
+
+def run_mdx_stream(mdx_sess, model, filename, main_filepath, invert_filepath, block_size=MDX.DEFAULT_SR * 30):
+    """
+    Separate a 44.1 kHz stereo audio file while keeping memory use independent of its length.
+    The file is read in blocks, the processed wave goes to a memory-mapped file next to the
+    outputs and the stems are written block by block.
+    """
+    with sf.SoundFile(filename) as f:
+        n_sample = f.frames
+
+        # normalizing input wave gives better output
+        peak = 0
+        for block in f.blocks(blocksize=block_size, dtype='float32', always_2d=True):
+            peak = max(peak, np.max(np.abs(block)))
+
+        def read_block(start, stop, sign=1):
+            block = np.zeros((2, stop - start), dtype=np.float32)
+            a, b = max(start, 0), min(stop, n_sample)
+            if a < b:
+                f.seek(a)
+                block[:, a - start:b - start] = f.read(b - a, dtype='float32', always_2d=True).T
+            block *= sign / peak
+            return block
+
+        buffer_path = os.path.join(os.path.dirname(main_filepath or invert_filepath), f'.{os.path.basename(filename)}.mdx.npy')
+        out = np.lib.format.open_memmap(buffer_path, mode='w+', dtype=np.float32, shape=(2, n_sample))
+        try:
+            if mdx_sess.denoise == 'average':
+                mdx_sess.process_wave_stream(lambda start, stop: read_block(start, stop, -1), n_sample, out, -0.5)
+                mdx_sess.process_wave_stream(read_block, n_sample, out, 0.5)
+            else:
+                mdx_sess.process_wave_stream(read_block, n_sample, out)
+
+            outputs = []
+            if main_filepath is not None:
+                outputs.append(sf.SoundFile(main_filepath, 'w', f.samplerate, 2))
+            if invert_filepath is not None:
+                outputs.append(sf.SoundFile(invert_filepath, 'w', f.samplerate, 2))
+            for start in range(0, n_sample, block_size):
+                stop = min(start + block_size, n_sample)
+                # return to previous peak
+                wave_processed = out[:, start:stop] * peak
+                if main_filepath is not None:
+                    outputs[0].write(wave_processed.T)
+                if invert_filepath is not None:
+                    outputs[-1].write((-wave_processed * model.compensation + read_block(start, stop)).T)
+            for o in outputs:
+                o.close()
+        finally:
+            del out
+            os.remove(buffer_path)
+
+
+def run_mdx(model_params, output_dir, model_path, filename, exclude_main=False, exclude_inversion=False, suffix=None, invert_suffix=None, denoise=False, keep_orig=True, m_threads=2, batch_size=MDX.DEFAULT_BATCH_SIZE, stream=False):
+    with profiler.stage('separation', model=os.path.basename(model_path), stream=stream):
+        device, m_threads = get_mdx_device()
+        mdx_sess, model = load_mdx(model_params, model_path, device, batch_size, denoise)
+
+        stream_filename = filename
+        if stream and not can_stream(filename):
+            try:
+                stream_filename = transcode_for_stream(filename, output_dir)
+            except (OSError, subprocess.CalledProcessError) as e:
+                print(f'[~] Could not convert {filename} to 44.1 kHz stereo with ffmpeg ({e}), separating it in memory instead...')
+                stream = False
+
+        if stream:
+            stem_name, diff_stem_name = get_stem_names(model, suffix, invert_suffix)
+            base_filepath = os.path.join(output_dir, os.path.basename(os.path.splitext(filename)[0]))
+            main_filepath = None if exclude_main else f"{base_filepath}_{stem_name}.wav"
+            invert_filepath = None if exclude_inversion else f"{base_filepath}_{diff_stem_name}.wav"
+            try:
+                run_mdx_stream(mdx_sess, model, stream_filename, main_filepath, invert_filepath)
+            finally:
+                if stream_filename != filename:
+                    os.remove(stream_filename)
+            if not keep_orig:
+                os.remove(filename)
+            del mdx_sess
+            gc.collect()
+            return main_filepath, invert_filepath
+
+        wave, sr = librosa.load(filename, mono=False, sr=44100)
+        wave_processed, wave = separate_wave(mdx_sess, wave, m_threads)
+        stem_name, diff_stem_name = get_stem_names(model, suffix, invert_suffix)
+
+        main_filepath = None
+        if not exclude_main:
+            main_filepath = os.path.join(output_dir, f"{os.path.basename(os.path.splitext(filename)[0])}_{stem_name}.wav")
+            sf.write(main_filepath, wave_processed.T, sr)
+
+        invert_filepath = None
+        if not exclude_inversion:
+            invert_filepath = os.path.join(output_dir, f"{os.path.basename(os.path.splitext(filename)[0])}_{diff_stem_name}.wav")
+            sf.write(invert_filepath, (-wave_processed.T * model.compensation) + wave.T, sr)
+
+        if not keep_orig:
+            os.remove(filename)
+
+        del mdx_sess, wave_processed, wave
+        gc.collect()
+        return main_filepath, invert_filepath
+
+
+def run_mdx_graph(model_params, output_dir, filename, stages, write_stems, keep_orig=True, batch_size=MDX.DEFAULT_BATCH_SIZE, on_stage=None):
+    """
+    Run a chain of MDX models on a song, decoding it once and passing the stems between
+    models in memory instead of through WAV files
+
+    Args:
+        model_params: (dict) Contents of model_data.json
+        output_dir: (str) Directory the written stems are saved in
+        filename: (str) Path of the song to separate
+        stages: (list) One dict per model with the keys
+            - model_path: Path of the ONNX model
+            - input: Stem name to run the model on, None for the song itself
+            - suffix, invert_suffix, exclude_main, exclude_inversion, denoise: as in run_mdx
+        write_stems: (set) Stem names to save as WAV files, the others only stay in memory
+        keep_orig: (bool) If False, deletes the input song afterwards
+        batch_size: (int) Number of chunks per ONNX call, see MDX
+        on_stage: (callable) Called with each stage dict before it runs
+
+    Returns:
+        dict: Stem name to written file path, or None for stems that were not written
+    """
+    device, m_threads = get_mdx_device()
+    wave, sr = librosa.load(filename, mono=False, sr=44100)
+    # stem name -> (filename stem, wave), the song itself is stored under None
+    stems = {None: (os.path.basename(os.path.splitext(filename)[0]), wave)}
+    stem_paths = {}
+
+    for i, stage in enumerate(stages):
+        if on_stage is not None:
+            on_stage(stage)
+
+        with profiler.stage('separation', model=os.path.basename(stage['model_path'])):
+            input_name, input_wave = stems[stage.get('input')]
+            mdx_sess, model = load_mdx(model_params, stage['model_path'], device, batch_size, stage.get('denoise', False))
+            wave_processed, input_wave = separate_wave(mdx_sess, input_wave, m_threads)
+            stem_name, diff_stem_name = get_stem_names(model, stage.get('suffix'), stage.get('invert_suffix'))
+
+            outputs = []
+            if not stage.get('exclude_main', False):
+                outputs.append((stem_name, wave_processed))
+            if not stage.get('exclude_inversion', False):
+                outputs.append((diff_stem_name, (-wave_processed * model.compensation) + input_wave))
+
+            for name, stem_wave in outputs:
+                stems[name] = (f"{input_name}_{name}", stem_wave.astype(np.float32, copy=False))
+                stem_paths[name] = None
+                if name in write_stems:
+                    stem_paths[name] = os.path.join(output_dir, f"{input_name}_{name}.wav")
+                    sf.write(stem_paths[name], stem_wave.T, sr)
+
+        # only keep the stems that later stages still read from
+        needed = {later.get('input') for later in stages[i + 1:]}
+        for name in list(stems):
+            if name not in needed:
+                del stems[name]
+
+        del mdx_sess, wave_processed, input_wave, outputs
+        gc.collect()
 
     if not keep_orig:
         os.remove(filename)
 
-    del mdx_sess, wave_processed, wave
-    gc.collect()
-    return main_filepath, invert_filepath
+    return stem_paths
@@ -0,0 +1,218 @@
+import gc
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from caches import replace_file
+from rvc import Config, load_hubert, get_vc
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+rvc_models_dir = os.path.join(BASE_DIR, 'rvc_models')
+
+DEFAULT_MEMORY_BUDGET_MB = 4096
+
+
+def get_model_size(*objs):
+    """
+    Estimate the memory held by torch modules/tensors in bytes
+
+    Args:
+        objs: torch.nn.Module, torch.Tensor or any object exposing them as attributes
+
+    Returns:
+        int: Total number of bytes of all parameters and buffers
+    """
+    size = 0
+    seen = set()
+    for obj in objs:
+        if isinstance(obj, torch.nn.Module):
+            tensors = list(obj.parameters()) + list(obj.buffers())
+        elif isinstance(obj, torch.Tensor):
+            tensors = [obj]
+        else:
+            # non-torch backends report their own footprint
+            size += getattr(obj, 'nbytes', 0)
+            continue
+        for t in tensors:
+            if t.data_ptr() in seen:
+                continue
+            seen.add(t.data_ptr())
+            size += t.numel() * t.element_size()
+    return size
+
+
+class ModelRegistry:
+    """
+    Long-lived cache of the models used by voice_change, so that HuBERT, RMVPE and
+    the RVC synthesizers are loaded once and reused across songs and web UI requests.
+
+    Entries are evicted least recently used first once the total size goes over the memory budget.
+    The entry that was just requested is never evicted, even if it alone is over budget.
+    """
+
+    def __init__(self, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB):
+        self.memory_budget = int(memory_budget_mb * 1024 ** 2)
+        self.entries = OrderedDict()
+        self.lock = threading.RLock()
+        # key being loaded: [lock, callers holding or waiting for it], so a slow load only blocks the callers waiting
+        # for the same model, and the lock is kept until the last of them is done, even if a load failed
+        self.loading = {}
+
+    @property
+    def memory_used(self):
+        return sum(size for _, size in self.entries.values())
+
+    def set_memory_budget(self, memory_budget_mb):
+        with self.lock:
+            self.memory_budget = int(memory_budget_mb * 1024 ** 2)
+            self._evict()
+
+    def get(self, key, loader, size_fn=get_model_size):
+        """
+        Return the cached value for key, loading it with loader() on a miss.
+        The registry isn't locked during the load, other models can be looked up and loaded meanwhile.
+
+        Args:
+            key: (tuple) Hashable identifier of the model
+            loader: (callable) Returns the value to cache
+            size_fn: (callable) Returns the size in bytes of the loaded value
+
+        Returns:
+            Cached or freshly loaded value
+        """
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key][0]
+            loading = self.loading.setdefault(key, [threading.Lock(), 0])
+            loading[1] += 1
+
+        try:
+            with loading[0]:
+                # another caller may have loaded it while this one waited
+                with self.lock:
+                    if key in self.entries:
+                        self.entries.move_to_end(key)
+                        return self.entries[key][0]
+                value = loader()
+                size = size_fn(*value) if isinstance(value, tuple) else size_fn(value)
+                with self.lock:
+                    self.entries[key] = (value, size)
+                    self._evict()
+                return value
+        finally:
+            with self.lock:
+                loading[1] -= 1
+                if not loading[1]:
+                    del self.loading[key]
+
+    def _evict(self):
+        evicted = False
+        while len(self.entries) > 1 and self.memory_used > self.memory_budget:
+            key, _ = self.entries.popitem(last=False)
+            print(f'[~] Evicting {key[0]} model from memory...')
+            evicted = True
+        if evicted:
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+    def evict(self, key=None):
+        """Remove one entry, or every entry if key is None"""
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+    def get_config(self, device, is_half):
+        # Config is cheap in memory but its device_config() probes the GPU and may rewrite config files
+        return self.get(('config', device, is_half), lambda: Config(device, is_half), lambda _: 0)
+
+    def get_hubert(self, device, is_half, model_path=os.path.join(rvc_models_dir, 'hubert_base.pt')):
+        return self.get(('hubert', device, is_half, model_path), lambda: load_hubert(device, is_half, model_path))
+
+    def get_rmvpe(self, device, is_half, model_path=os.path.join(rvc_models_dir, 'rmvpe.pt'), backend='torch'):
+        from rmvpe import RMVPE
+
+        return self.get(('rmvpe', device, is_half, backend, model_path), lambda: RMVPE(model_path, is_half=is_half, device=device, backend=backend),
+                        lambda rmvpe: get_model_size(rmvpe.model, rmvpe.mel_extractor))
+
+    def get_vc(self, device, is_half, config, model_path, backend='torch'):
+        def loader():
+            if backend == 'onnx':
+                from rvc_onnx import get_onnx_vc
+
+                cpt, version, net_g, tgt_sr, vc = get_onnx_vc(device, is_half, config, model_path)
+            else:
+                cpt, version, net_g, tgt_sr, vc = get_vc(device, is_half, config, model_path)
+            # the weights now live in net_g, don't keep a second copy of them resident
+            cpt = {k: v for k, v in cpt.items() if k != 'weight'}
+            return cpt, version, net_g, tgt_sr, vc
+
+        # keyed on mtime as well so that re-uploading a model under the same name reloads it
+        key = ('net_g', device, is_half, backend, model_path, os.path.getmtime(model_path))
+        return self.get(key, loader)
+
+    def get_mdx_session(self, model_path, providers, input_shape):
+        """
+        ONNX Runtime session of an MDX separation model, warmed up with one run on an input of input_shape.
+        Sessions are thread-safe, so every MDX wrapper of a model shares one whatever its batch size.
+        """
+        from execution import execution_profile
+
+        def loader():
+            import onnxruntime as ort
+
+            session = ort.InferenceSession(model_path, sess_options=execution_profile.get_ort_session_options(), providers=providers)
+            # the first run allocates buffers and picks kernels
+            session.run(None, {'input': np.random.rand(*input_shape).astype(np.float32)})
+            return session
+
+        # the session options depend on the thread settings of the execution profile
+        key = ('mdx', model_path, os.path.getmtime(model_path), tuple(providers), execution_profile.num_threads, execution_profile.inter_op_threads)
+        # ONNX Runtime holds about one copy of the weights
+        return self.get(key, loader, lambda _: os.path.getsize(model_path))
+
+    def get_index(self, file_index):
+        """
+        Load a faiss index once, along with the matrix of all its vectors (big_npy).
+
+        big_npy is reconstructed only the first time and saved next to the index as a .big.npy file,
+        later loads memory-map it read-only so every conversion shares the same pages.
+
+        Returns:
+            tuple: (faiss index, big_npy)
+        """
+        def loader():
+            import faiss
+
+            index = faiss.read_index(file_index)
+            big_npy_path = f'{os.path.splitext(file_index)[0]}.big.npy'
+            big_npy = None
+            if os.path.exists(big_npy_path) and os.path.getmtime(big_npy_path) >= os.path.getmtime(file_index):
+                big_npy = np.load(big_npy_path, mmap_mode='r')
+                if big_npy.shape != (index.ntotal, index.d):
+                    big_npy = None
+
+            if big_npy is None:
+                def write(tmp_path):
+                    with open(tmp_path, 'wb') as f:
+                        np.save(f, index.reconstruct_n(0, index.ntotal))
+
+                replace_file(big_npy_path, write)
+                big_npy = np.load(big_npy_path, mmap_mode='r')
+            return index, big_npy
+
+        # big_npy is a file mapping and doesn't count, the index holds about one float32 copy of the vectors
+        key = ('index', file_index, os.path.getmtime(file_index))
+        return self.get(key, loader, lambda index, _: index.ntotal * index.d * 4)
+
+
+model_registry = ModelRegistry()
@@ -0,0 +1,203 @@
+"""
+Per-stage timing and resource instrumentation of the cover pipeline.
+
+Stages are marked with `with profiler.stage('name', **args):`, which costs nothing while the profiler is disabled.
+Once enabled, every stage records its wall time, CPU time, peak RSS and peak GPU memory, and the events can be
+written as a JSON trace or as a Chrome trace (chrome://tracing, https://ui.perfetto.dev).
+"""
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+
+def get_rss():
+    """Resident set size of this process in bytes"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import psutil
+
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        # the lifetime peak, in KB on Linux and bytes on macOS, is the best left without /proc or psutil
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if peak > 2 ** 32 else peak * 1024
+
+
+def get_device_memory():
+    """
+    Peak bytes allocated by torch on the current CUDA device since its peak stats were last reset, 0 without CUDA.
+    The allocator tracks the peak itself, so unlike sampling it sees every spike.
+    """
+    return torch.cuda.max_memory_allocated() if torch.cuda.is_available() else 0
+
+
+def get_device_used():
+    """
+    Bytes in use on the whole current CUDA device, 0 without CUDA. Includes what torch doesn't allocate, such as
+    ONNX Runtime's CUDA arena used by MDX separation and RMVPE, as well as other processes on the same GPU.
+    """
+    if not torch.cuda.is_available():
+        return 0
+    free, total = torch.cuda.mem_get_info()
+    return total - free
+
+
+class Profiler:
+    """
+    Collects one event per stage run. RSS and the memory used on the GPU are sampled by a background thread
+    every sample_interval seconds while any stage is running, plus once at the start and end of each stage, so
+    spikes shorter than the interval can be missed. peak_device_memory is exact for torch allocations: the
+    allocator's peak is read before being reset at every stage entry and credited to all running stages, while
+    peak_device_used also covers ONNX Runtime but is sampled. CPU time is the whole process', which includes the
+    threads torch and ONNX Runtime run operators on, and thread_cpu_time only the calling thread's.
+    """
+
+    def __init__(self, sample_interval=0.02):
+        self.enabled = False
+        self.sample_interval = sample_interval
+        self.events = []
+        self.active = []
+        self.lock = threading.Lock()
+        self.sampler = None
+        self.origin = time.perf_counter()
+        self.metadata = {}
+
+    def enable(self, sample_interval=None):
+        self.enabled = True
+        if sample_interval is not None:
+            self.sample_interval = sample_interval
+        self.reset()
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self.lock:
+            self.events = []
+            self.origin = time.perf_counter()
+            self.metadata = {'pid': os.getpid(), 'started': time.time(), 'cuda': torch.cuda.is_available()}
+
+    def stage(self, name, **args):
+        """Context manager timing one run of a stage, args are saved with its event, e.g. the model name"""
+        if not self.enabled:
+            return nullcontext()
+        return self._stage(name, args)
+
+    @contextmanager
+    def _stage(self, name, args):
+        event = {
+            'name': name,
+            'args': args,
+            'thread': threading.current_thread().name,
+            'tid': threading.get_ident(),
+            'start': time.perf_counter() - self.origin,
+            'peak_rss': get_rss(),
+            'peak_device_memory': 0,
+            'peak_device_used': get_device_used(),
+        }
+        cpu_start = time.process_time()
+        thread_cpu_start = time.thread_time()
+        with self.lock:
+            if torch.cuda.is_available():
+                # the running stages get the peak so far before it is reset, then every stage sees peaks from here on
+                self.update_peaks(self.active)
+                torch.cuda.reset_peak_memory_stats()
+                event['peak_device_memory'] = torch.cuda.memory_allocated()
+            self.active.append(event)
+            if self.sampler is None or not self.sampler.is_alive():
+                self.sampler = threading.Thread(target=self.sample, name='profiler-sampler', daemon=True)
+                self.sampler.start()
+        try:
+            yield event
+        finally:
+            event['wall_time'] = time.perf_counter() - self.origin - event['start']
+            event['cpu_time'] = time.process_time() - cpu_start
+            event['thread_cpu_time'] = time.thread_time() - thread_cpu_start
+            with self.lock:
+                self.update_peaks(self.active)
+                self.active.remove(event)
+                self.events.append(event)
+
+    def update_peaks(self, events):
+        rss = get_rss()
+        device_memory = get_device_memory()
+        device_used = get_device_used()
+        for event in events:
+            event['peak_rss'] = max(event['peak_rss'], rss)
+            event['peak_device_memory'] = max(event['peak_device_memory'], device_memory)
+            event['peak_device_used'] = max(event['peak_device_used'], device_used)
+
+    def sample(self):
+        while True:
+            with self.lock:
+                if not self.active:
+                    # the next stage starts a new sampler
+                    self.sampler = None
+                    return
+                self.update_peaks(self.active)
+            time.sleep(self.sample_interval)
+
+    def summarize(self):
+        """Totals per stage name: runs, wall time, CPU time and the highest memory peaks"""
+        summary = {}
+        for event in self.events:
+            stage = summary.setdefault(event['name'], {'runs': 0, 'wall_time': 0.0, 'cpu_time': 0.0, 'peak_rss': 0, 'peak_device_memory': 0,
+                                                       'peak_device_used': 0})
+            stage['runs'] += 1
+            stage['wall_time'] += event['wall_time']
+            stage['cpu_time'] += event['cpu_time']
+            stage['peak_rss'] = max(stage['peak_rss'], event['peak_rss'])
+            stage['peak_device_memory'] = max(stage['peak_device_memory'], event['peak_device_memory'])
+            stage['peak_device_used'] = max(stage['peak_device_used'], event['peak_device_used'])
+        return summary
+
+    def write_json(self, path):
+        """Every stage event, in seconds and bytes, with the per-stage totals of summarize"""
+        with self.lock:
+            events = sorted(self.events, key=lambda event: event['start'])
+        trace = {'metadata': self.metadata, 'stages': self.summarize(), 'events': events}
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w', encoding='utf8') as outfile:
+            json.dump(trace, outfile, indent=2, default=str)
+
+    def write_chrome_trace(self, path):
+        """Stage events in the Chrome trace event format, with memory peaks as counter tracks"""
+        pid = self.metadata.get('pid', os.getpid())
+        trace_events = []
+        threads = {}
+        with self.lock:
+            events = sorted(self.events, key=lambda event: event['start'])
+        for event in events:
+            threads.setdefault(event['tid'], event['thread'])
+            trace_events.append({
+                'name': event['name'], 'cat': 'stage', 'ph': 'X', 'pid': pid, 'tid': event['tid'],
+                'ts': event['start'] * 1e6, 'dur': event['wall_time'] * 1e6,
+                'args': {**event['args'], 'cpu_time': event['cpu_time'], 'peak_rss_mb': event['peak_rss'] / 2 ** 20,
+                         'peak_device_memory_mb': event['peak_device_memory'] / 2 ** 20, 'peak_device_used_mb': event['peak_device_used'] / 2 ** 20},
+            })
+            trace_events.append({'name': 'memory (MB)', 'ph': 'C', 'pid': pid, 'ts': event['start'] * 1e6,
+                                 'args': {'rss': event['peak_rss'] / 2 ** 20, 'device': event['peak_device_memory'] / 2 ** 20,
+                                          'device_used': event['peak_device_used'] / 2 ** 20}})
+        for tid, name in threads.items():
+            trace_events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}})
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w', encoding='utf8') as outfile:
+            json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms', 'otherData': self.metadata}, outfile, default=str)
+
+    def print_summary(self):
+        print(f'{"stage":<14}{"runs":>6}{"wall (s)":>10}{"cpu (s)":>10}{"peak rss (MB)":>15}{"peak torch (MB)":>17}{"peak gpu used (MB)":>20}')
+        for name, stage in self.summarize().items():
+            print(f'{name:<14}{stage["runs"]:>6}{stage["wall_time"]:>10.2f}{stage["cpu_time"]:>10.2f}'
+                  f'{stage["peak_rss"] / 2 ** 20:>15.0f}{stage["peak_device_memory"] / 2 ** 20:>17.0f}{stage["peak_device_used"] / 2 ** 20:>20.0f}')
+
+
+profiler = Profiler()
@@ -0,0 +1,315 @@
+"""
+Streaming voice conversion: converts 16 kHz audio block by block with a rolling context, for live use
+
+    python src/realtime.py -i vocals.wav -m rvc_models/Voice/voice.pth -o converted.wav -b 0.25
+
+Fed from a file, blocks are timed as if they arrived in real time, one every block_seconds, so a conversion slower
+than real time shows up as a growing queueing delay like it would on a live input.
+"""
+import argparse
+import asyncio
+import os
+from time import perf_counter
+
+import numpy as np
+import torch
+from scipy import signal
+
+from execution import execution_profile
+from model_registry import model_registry
+from vc_infer_pipeline import ah, bh, get_f0_coarse
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+rvc_models_dir = os.path.join(BASE_DIR, 'rvc_models')
+
+sr = 16000
+
+
+class BlockStats:
+    """Timings of one converted block, in seconds"""
+
+    def __init__(self, index, block_seconds, holdback_seconds, f0_time, convert_time, queue_time=0.0):
+        self.index = index
+        self.block_seconds = block_seconds
+        self.f0_time = f0_time
+        self.convert_time = convert_time
+        self.compute_time = f0_time + convert_time
+        # time between the block arriving and its conversion starting, grows while conversions are slower than real time
+        self.queue_time = queue_time
+        # a sample waits for the rest of its block, then for the crossfade holdback, then for earlier blocks and the conversion
+        self.latency = block_seconds + holdback_seconds + queue_time + self.compute_time
+        self.realtime_factor = self.compute_time / block_seconds
+
+    def to_dict(self):
+        return dict(vars(self))
+
+
+class StreamingConverter:
+    """
+    Converts fixed-size blocks of 16 kHz mono audio with VC.vc as they arrive.
+
+    Every block is converted together with the last context_seconds of input before it, so HuBERT and the
+    pitch extractor see enough audio, and the end of the input is reflect padded like VC.t_pad pads whole songs.
+    The output of each block is held back by crossfade_seconds and faded into the start of the next block,
+    which hides the seams between conversions. The output therefore lags the input by crossfade_seconds, starting
+    with that much silence, and flush returns the end of the stream. The last block may be shorter, its zero padding
+    is trimmed so the stream is the input plus that silence.
+    """
+
+    def __init__(self, vc, hubert_model, net_g, cpt, version, tgt_sr, pitch_change=0, f0_method='rmvpe', index_path='',
+                 index_rate=0.5, protect=0.33, filter_radius=3, crepe_hop_length=128, block_seconds=0.5,
+                 context_seconds=1.5, crossfade_seconds=0.05, pad_seconds=0.1, sid=0, seed=0):
+        """
+        Args:
+            vc, hubert_model, net_g, cpt, version, tgt_sr: as returned by model_registry.get_hubert and get_vc
+            pitch_change: (int) Transposition in semitones
+            block_seconds: (float) Audio per block, rounded to whole 10 ms frames
+            context_seconds: (float) Past input converted along with each block
+            crossfade_seconds: (float) Overlap between consecutive outputs, adds to the latency
+            pad_seconds: (float) Reflect padding after the newest input, only costs compute
+            seed: (int) Seed of the synthesizer noise, so offline runs are reproducible
+        """
+        self.vc = vc
+        self.hubert_model = hubert_model
+        self.net_g = net_g
+        self.version = version
+        self.tgt_sr = tgt_sr
+        self.pitch_change = pitch_change
+        self.f0_method = f0_method
+        self.index_rate = index_rate
+        self.protect = protect
+        self.filter_radius = filter_radius
+        self.crepe_hop_length = crepe_hop_length
+        self.if_f0 = cpt.get('f0', 1)
+        self.sid = torch.tensor([sid], device=vc.device).long()
+        self.index = self.big_npy = None
+        if index_path and os.path.exists(index_path) and index_rate != 0:
+            self.index, self.big_npy = model_registry.get_index(index_path)
+
+        window = vc.window
+        self.block = max(1, round(block_seconds * sr / window)) * window
+        self.crossfade = max(1, round(crossfade_seconds * sr / window)) * window
+        self.context = round(context_seconds * sr / window) * window
+        # the synthesizer needs a few frames past the crossfade, since HuBERT returns slightly fewer frames than p_len
+        self.pad = max(4 * window, round(pad_seconds * sr / window) * window)
+        # output samples per 10 ms frame
+        self.hop_tgt = tgt_sr // (sr // window)
+        self.generator = torch.Generator(device=vc.device).manual_seed(seed)
+        self.reset()
+
+    @property
+    def block_seconds(self):
+        return self.block / sr
+
+    @property
+    def holdback_seconds(self):
+        return self.crossfade / sr
+
+    @property
+    def lead_in(self):
+        """Samples of silence at tgt_sr the output starts with"""
+        return self.crossfade // self.vc.window * self.hop_tgt
+
+    def reset(self):
+        """Forget the previous input, to start a new stream"""
+        self.input = np.zeros(self.context + self.crossfade + self.block, dtype=np.float32)
+        self.zi = signal.lfilter_zi(bh, ah) * 0
+        crossfade_tgt = self.crossfade // self.vc.window * self.hop_tgt
+        self.fade_buffer = np.zeros(crossfade_tgt, dtype=np.float32)
+        # equal power, so the two uncorrelated conversions don't dip in loudness halfway through
+        self.fade_in = np.sin(0.5 * np.pi * np.linspace(0, 1, crossfade_tgt, dtype=np.float32)) ** 2
+        self.fade_out = 1 - self.fade_in
+        self.blocks = 0
+        self.held_back = False
+        # input received and output returned so far, for trimming the padding of a short last block
+        self.samples_in = 0
+        self.samples_out = 0
+        self.times = [0, 0, 0]
+
+    def get_pitch(self, audio_pad):
+        p_len = audio_pad.shape[0] // self.vc.window
+        # compute_f0 rather than get_f0, a block's pitch is never looked up again so it's not worth caching
+        f0 = self.vc.compute_f0(None, audio_pad, p_len, self.f0_method, self.filter_radius, self.crepe_hop_length)
+        f0 = np.pad(f0[:p_len], (0, max(0, p_len - len(f0))))
+        f0 = f0 * pow(2, self.pitch_change / 12)
+        pitch = torch.tensor(get_f0_coarse(f0), device=self.vc.device).unsqueeze(0).long()
+        pitchf = torch.tensor(f0, device=self.vc.device).unsqueeze(0).float()
+        return pitch, pitchf
+
+    def process(self, block, arrival=None):
+        """
+        Convert the next block of input. The last crossfade of the output is held back until the next block
+        or flush.
+
+        Args:
+            block: (np.ndarray) 16 kHz mono audio, a shorter last block is zero padded to the block size
+            arrival: (float) time.perf_counter() at which the block was complete, for its queueing delay
+
+        Returns:
+            tuple: (converted audio at tgt_sr, float32, BlockStats)
+        """
+        block = np.asarray(block, dtype=np.float32)
+        if block.shape[0] > self.block:
+            raise ValueError(f'Blocks are {self.block} samples long, got {block.shape[0]}')
+        self.samples_in += block.shape[0]
+        block = np.pad(block, (0, self.block - block.shape[0]))
+        # a causal filter with carried state, filtfilt needs the whole song
+        block, self.zi = signal.lfilter(bh, ah, block, zi=self.zi)
+        self.input = np.concatenate((self.input[self.block:], block.astype(np.float32)))
+
+        t0 = perf_counter()
+        queue_time = max(0.0, t0 - arrival) if arrival is not None else 0.0
+        audio_pad = np.pad(self.input, (0, self.pad), mode='reflect')
+        pitch = pitchf = None
+        if self.if_f0 == 1:
+            pitch, pitchf = self.get_pitch(audio_pad)
+        t1 = perf_counter()
+        audio1 = self.vc.vc(self.hubert_model, self.net_g, self.sid, audio_pad, pitch, pitchf, self.times, self.index,
+                            self.big_npy, self.index_rate, self.version, self.protect, self.generator,
+                            use_feature_cache=False)
+        t2 = perf_counter()
+
+        # output of the crossfade before the block and of the block itself, the last crossfade is held back
+        start = self.context // self.vc.window * self.hop_tgt
+        length = (self.crossfade + self.block) // self.vc.window * self.hop_tgt
+        output = audio1[start:start + length].astype(np.float32)
+        output = np.pad(output, (0, length - output.shape[0]))
+        crossfade_tgt = self.fade_buffer.shape[0]
+        output[:crossfade_tgt] = output[:crossfade_tgt] * self.fade_in + self.fade_buffer * self.fade_out
+        self.fade_buffer = output[-crossfade_tgt:].copy()
+        self.held_back = True
+
+        stats = BlockStats(self.blocks, self.block_seconds, self.holdback_seconds, t1 - t0, t2 - t1, queue_time)
+        self.blocks += 1
+        return self.trim(output[:-crossfade_tgt]), stats
+
+    def trim(self, output):
+        # nothing past the lead-in and the input received so far, which only cuts the padding of a short last block
+        output = output[:max(0, self.lead_in + self.samples_in * self.hop_tgt // self.vc.window - self.samples_out)]
+        self.samples_out += output.shape[0]
+        return output
+
+    def flush(self):
+        """Output held back after the last block, to emit once the input has ended"""
+        if not self.held_back:
+            return np.zeros(0, dtype=np.float32)
+        self.held_back = False
+        tail = self.fade_buffer
+        self.fade_buffer = np.zeros_like(tail)
+        return self.trim(tail)
+
+    def get_arrival(self, first_arrival, index):
+        # a live input delivers one block every block_seconds after the first
+        return first_arrival + index * self.block_seconds
+
+    def stream(self, blocks):
+        """
+        Generator of (converted audio, BlockStats) for an iterable of input blocks, taken to arrive in real time from
+        the first one on, then of (held back output, None) once the blocks run out
+        """
+        first_arrival = None
+        for i, block in enumerate(blocks):
+            first_arrival = perf_counter() if first_arrival is None else first_arrival
+            yield self.process(block, self.get_arrival(first_arrival, i))
+        yield self.flush(), None
+
+    async def astream(self, blocks):
+        """
+        Async generator of (converted audio, BlockStats) for an async iterable of input blocks, such as a queue fed
+        by an audio callback, then of (held back output, None) once the blocks run out. Blocks are taken to arrive in
+        real time from the first one on. Conversions run on the default executor so the event loop keeps receiving input.
+        """
+        loop = asyncio.get_running_loop()
+        first_arrival = None
+        i = 0
+        async for block in blocks:
+            first_arrival = perf_counter() if first_arrival is None else first_arrival
+            yield await loop.run_in_executor(None, self.process, block, self.get_arrival(first_arrival, i))
+            i += 1
+        yield self.flush(), None
+
+
+def get_streaming_converter(model_path, index_path='', device=None, **kwargs):
+    """
+    StreamingConverter of a voice model, with the models loaded from the resident model registry
+
+    Args:
+        model_path: (str) Path of the .pth voice model
+        index_path: (str) Path of its .index file, '' to skip feature retrieval
+        device: (str) torch device, defaults to the execution profile's
+        kwargs: StreamingConverter options
+    """
+    device = device or execution_profile.device
+    config = model_registry.get_config(device, execution_profile.is_half)
+    hubert_model = model_registry.get_hubert(device, config.is_half, os.path.join(rvc_models_dir, 'hubert_base.pt'))
+    cpt, version, net_g, tgt_sr, vc = model_registry.get_vc(device, config.is_half, config, model_path, execution_profile.rvc_backend)
+    return StreamingConverter(vc, hubert_model, net_g, cpt, version, tgt_sr, index_path=index_path, **kwargs)
+
+
+def iter_blocks(audio, block_size):
+    """Split audio into blocks of block_size samples, the way an audio callback would deliver it"""
+    for start in range(0, audio.shape[0], block_size):
+        yield audio[start:start + block_size]
+
+
+def summarize(stats):
+    """Latency percentiles and the real-time factor over a stream, in milliseconds"""
+    latencies = np.array([s.latency for s in stats]) * 1000
+    compute = np.array([s.compute_time for s in stats]) * 1000
+    return {
+        'blocks': len(stats),
+        'block_ms': stats[0].block_seconds * 1000 if stats else 0,
+        'latency_ms_p50': float(np.percentile(latencies, 50)) if stats else 0,
+        'latency_ms_p95': float(np.percentile(latencies, 95)) if stats else 0,
+        'latency_ms_max': float(latencies.max()) if stats else 0,
+        'queue_ms_max': float(np.max([s.queue_time for s in stats]) * 1000) if stats else 0,
+        'compute_ms_mean': float(compute.mean()) if stats else 0,
+        'realtime_factor': float(np.mean([s.realtime_factor for s in stats])) if stats else 0,
+    }
+
+
+def main():
+    from scipy.io import wavfile
+
+    from my_utils import load_audio
+
+    parser = argparse.ArgumentParser(description='Convert an audio file block by block like a live stream, and report the latency.')
+    parser.add_argument('-i', '--input', type=str, required=True, help='Input audio file')
+    parser.add_argument('-m', '--model', type=str, required=True, help='Path of the .pth voice model')
+    parser.add_argument('-idx', '--index', type=str, default='', help='Path of the .index file of the voice model')
+    parser.add_argument('-o', '--output', type=str, default='', help='Write the converted stream to this wav file')
+    parser.add_argument('-p', '--pitch-change', type=int, default=0, help='Transposition in semitones')
+    parser.add_argument('-ir', '--index-rate', type=float, default=0.5, help='Feature retrieval ratio')
+    parser.add_argument('-palgo', '--pitch-detection-algo', type=str, default='rmvpe', help='Pitch detection algorithm')
+    parser.add_argument('-pro', '--protect', type=float, default=0.33, help='Protection of voiceless consonants')
+    parser.add_argument('-b', '--block-seconds', type=float, default=0.5, help='Audio per block')
+    parser.add_argument('-ctx', '--context-seconds', type=float, default=1.5, help='Past input converted with each block')
+    parser.add_argument('-xf', '--crossfade-seconds', type=float, default=0.05, help='Crossfade between blocks')
+    parser.add_argument('-device', '--device', type=str, default=None, help='torch device, defaults to cuda:0, then mps, then cpu')
+    parser.add_argument('-precision', '--precision', type=str, default=None, help='fp32, fp16 or bf16')
+    parser.add_argument('-threads', '--threads', type=int, default=0, help='Intra-op threads, 0 for one per physical core')
+    args = parser.parse_args()
+
+    execution_profile.configure(args.device, args.precision, args.threads)
+    converter = get_streaming_converter(
+        args.model, args.index, pitch_change=args.pitch_change, f0_method=args.pitch_detection_algo, index_rate=args.index_rate,
+        protect=args.protect, block_seconds=args.block_seconds, context_seconds=args.context_seconds,
+        crossfade_seconds=args.crossfade_seconds,
+    )
+    audio = load_audio(args.input, sr)
+    outputs = []
+    stats = []
+    for output, block_stats in converter.stream(iter_blocks(audio, converter.block)):
+        outputs.append(output)
+        if block_stats is not None:
+            stats.append(block_stats)
+
+    if args.output:
+        # without the lead-in the file lines up with the input
+        wavfile.write(args.output, converter.tgt_sr, np.concatenate(outputs)[converter.lead_in:])
+    for name, value in summarize(stats).items():
+        print(f'{name}: {value:.2f}' if isinstance(value, float) else f'{name}: {value}')
+
+
+if __name__ == '__main__':
+    main()
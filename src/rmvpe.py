@@ -1,9 +1,13 @@
+import os
+
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from librosa.filters import mel
 
+from execution import execution_profile, rmvpe_backends
+
 
 class BiGRU(nn.Module):
     def __init__(self, input_features, hidden_features, num_layers):
@@ -325,16 +329,103 @@ class MelSpectrogram(torch.nn.Module):
         return log_mel_spec
 
 
+# bump when the exported graph changes so that older exports are redone
+RMVPE_EXPORT_VERSION = 2
+
+
+def load_e2e(model_path):
+    model = E2E(4, 1, (2, 2))
+    ckpt = torch.load(model_path, map_location="cpu")
+    model.load_state_dict(ckpt)
+    model.eval()
+    return model
+
+
+def export_onnx(model_path, quantize=False):
+    """
+    Export the RMVPE E2E model next to its checkpoint as rmvpe.onnx, with dynamic batch and frame axes,
+    and optionally as rmvpe.int8.onnx with int8 BiGRU and dense weights (dynamic quantization)
+
+    Returns:
+        str: Path of the requested export, reused if already up to date
+    """
+    from caches import replace_file
+    from rvc_onnx import get_export_kwargs, is_up_to_date, set_source
+
+    onnx_path = f"{os.path.splitext(model_path)[0]}.onnx"
+    if not is_up_to_date(model_path, onnx_path, RMVPE_EXPORT_VERSION):
+        print("[~] Exporting RMVPE to ONNX...")
+
+        def write(tmp_path):
+            with torch.no_grad():
+                torch.onnx.export(
+                    load_e2e(model_path),
+                    torch.randn(1, 128, 64),
+                    tmp_path,
+                    input_names=["mel"],
+                    output_names=["hidden"],
+                    dynamic_axes={"mel": [0, 2], "hidden": [0, 1]},
+                    do_constant_folding=True,
+                    opset_version=17,
+                    **get_export_kwargs(),
+                )
+            set_source(tmp_path, model_path, RMVPE_EXPORT_VERSION)
+
+        replace_file(onnx_path, write)
+    if not quantize:
+        return onnx_path
+
+    int8_path = f"{os.path.splitext(model_path)[0]}.int8.onnx"
+    if not is_up_to_date(model_path, int8_path, RMVPE_EXPORT_VERSION):
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        print("[~] Quantizing RMVPE to int8...")
+
+        def write(tmp_path):
+            # dynamically quantized convolutions (ConvInteger) run several times slower than float ones on CPU,
+            # so only the BiGRU and the dense layers get int8 weights
+            quantize_dynamic(onnx_path, tmp_path, op_types_to_quantize=["MatMul", "Gemm", "GRU"], weight_type=QuantType.QInt8)
+            set_source(tmp_path, model_path, RMVPE_EXPORT_VERSION)
+
+        replace_file(int8_path, write)
+    return int8_path
+
+
+class OnnxE2E:
+    """ONNX Runtime session standing in for the E2E module in RMVPE.mel2hidden"""
+
+    def __init__(self, onnx_path):
+        import onnxruntime as ort
+
+        self.ort = ort.InferenceSession(onnx_path, sess_options=execution_profile.get_ort_session_options(),
+                                        providers=execution_profile.get_ort_providers())
+        # read by get_model_size
+        self.nbytes = os.path.getsize(onnx_path)
+
+    def __call__(self, mel):
+        hidden = self.ort.run(None, {"mel": mel.float().cpu().numpy()})[0]
+        return torch.from_numpy(hidden).to(mel.device)
+
+
 class RMVPE:
-    def __init__(self, model_path, is_half, device=None):
+    # chunked mode: overlap between consecutive windows and number of windows per E2E call
+    CHUNK_OVERLAP_FRAMES = 128
+    CHUNK_BATCH_SIZE = 4
+
+    def __init__(self, model_path, is_half, device=None, backend="torch"):
         self.resample_kernel = {}
-        model = E2E(4, 1, (2, 2))
-        ckpt = torch.load(model_path, map_location="cpu")
-        model.load_state_dict(ckpt)
-        model.eval()
-        if is_half == True:
-            model = model.half()
+        if backend == "torch":
+            model = load_e2e(model_path)
+            if is_half == True:
+                model = model.half()
+        elif backend in rmvpe_backends:
+            model = OnnxE2E(export_onnx(model_path, quantize=backend == "onnx-int8"))
+            # the exported graph is float32
+            is_half = False
+        else:
+            raise ValueError(f"Unknown RMVPE backend {backend}, use one of {', '.join(rmvpe_backends)}")
         self.model = model
+        self.backend = backend
         self.resample_kernel = {}
         self.is_half = is_half
         if device is None:
@@ -343,9 +434,11 @@ class RMVPE:
         self.mel_extractor = MelSpectrogram(
             is_half, 128, 16000, 1024, 160, None, 30, 8000
         ).to(device)
-        self.model = self.model.to(device)
+        if backend == "torch":
+            self.model = self.model.to(device)
         cents_mapping = 20 * np.arange(360) + 1997.3794084376191
         self.cents_mapping = np.pad(cents_mapping, (4, 4))  # 368
+        self.cents_mapping_torch = {}
 
     def mel2hidden(self, mel):
         with torch.no_grad():
@@ -356,54 +449,114 @@ class RMVPE:
             hidden = self.model(mel)
             return hidden[:, :n_frames]
 
+    def mel2hidden_chunked(self, mel, chunk_frames, overlap_frames=CHUNK_OVERLAP_FRAMES, batch_size=CHUNK_BATCH_SIZE):
+        """
+        Same as mel2hidden, with memory bounded by the chunk size instead of the song length.
+
+        The mel is split into overlapping windows of chunk_frames, which go through E2E batch_size at a time.
+        The salience of overlapping windows is crossfaded linearly. The last window is aligned on the end of
+        the mel, so every window has the full length and none needs padding.
+
+        Args:
+            mel: (torch.Tensor) Mel spectrogram of shape (1, 128, frames)
+            chunk_frames: (int) Frames per window, rounded up to a multiple of 32
+            overlap_frames: (int) Frames shared by consecutive windows
+            batch_size: (int) Windows per E2E call
+        """
+        chunk_frames = 32 * ((chunk_frames - 1) // 32 + 1)
+        n_frames = mel.shape[-1]
+        if n_frames <= chunk_frames:
+            return self.mel2hidden(mel)
+
+        overlap_frames = min(overlap_frames, chunk_frames // 2)
+        step = chunk_frames - overlap_frames
+        starts = list(range(0, n_frames - chunk_frames, step)) + [n_frames - chunk_frames]
+
+        # linear fades over the overlaps, never exactly 0 so that every frame has some weight
+        fade = torch.linspace(0, 1, overlap_frames + 2, device=mel.device)[1:-1]
+        hidden = torch.zeros(n_frames, 360, device=mel.device)
+        weight_sum = torch.zeros(n_frames, 1, device=mel.device)
+        with torch.no_grad():
+            for i in range(0, len(starts), batch_size):
+                batch_starts = starts[i:i + batch_size]
+                batch = torch.cat([mel[..., start:start + chunk_frames] for start in batch_starts])
+                batch_hidden = self.model(batch).float()
+                for j, start in enumerate(batch_starts):
+                    weight = torch.ones(chunk_frames, 1, device=mel.device)
+                    if start > 0:
+                        weight[:overlap_frames, 0] = fade
+                    if start + chunk_frames < n_frames:
+                        weight[-overlap_frames:, 0] = fade.flip(0)
+                    hidden[start:start + chunk_frames] += batch_hidden[j] * weight
+                    weight_sum[start:start + chunk_frames] += weight
+        return (hidden / weight_sum).unsqueeze(0)
+
     def decode(self, hidden, thred=0.03):
+        """
+        Args:
+            hidden: (np.ndarray or torch.Tensor) Salience of shape (frames, 360), a tensor is decoded on its own device
+
+        Returns:
+            np.ndarray: f0 in Hz of each frame, 0 where unvoiced
+        """
+        if isinstance(hidden, torch.Tensor):
+            cents_pred = self.to_local_average_cents_torch(hidden, thred=thred)
+            f0 = 10 * (2 ** (cents_pred / 1200))
+            f0[f0 == 10] = 0
+            return f0.cpu().numpy().astype(np.float64)
+
         cents_pred = self.to_local_average_cents(hidden, thred=thred)
         f0 = 10 * (2 ** (cents_pred / 1200))
         f0[f0 == 10] = 0
-        # f0 = np.array([10 * (2 ** (cent_pred / 1200)) if cent_pred else 0 for cent_pred in cents_pred])
         return f0
 
-    def infer_from_audio(self, audio, thred=0.03):
+    def infer_from_audio(self, audio, thred=0.03, decode_on_device=None, chunk_frames=0):
+        """
+        Args:
+            decode_on_device: (bool) Decode the salience where it was computed instead of copying it to numpy first,
+                defaults to True on GPU
+            chunk_frames: (int) Run E2E on overlapping windows of this many frames (100 per second), 0 for one pass
+        """
+        if decode_on_device is None:
+            decode_on_device = str(self.device) != "cpu"
         audio = torch.from_numpy(audio).float().to(self.device).unsqueeze(0)
-        # torch.cuda.synchronize()
-        # t0=ttime()
         mel = self.mel_extractor(audio, center=True)
-        # torch.cuda.synchronize()
-        # t1=ttime()
-        hidden = self.mel2hidden(mel)
-        # torch.cuda.synchronize()
-        # t2=ttime()
+        hidden = self.mel2hidden_chunked(mel, chunk_frames) if chunk_frames > 0 else self.mel2hidden(mel)
+        if decode_on_device:
+            return self.decode(hidden.squeeze(0).float(), thred=thred)
+
         hidden = hidden.squeeze(0).cpu().numpy()
         if self.is_half == True:
             hidden = hidden.astype("float32")
-        f0 = self.decode(hidden, thred=thred)
-        # torch.cuda.synchronize()
-        # t3=ttime()
-        # print("hmvpe:%s\t%s\t%s\t%s"%(t1-t0,t2-t1,t3-t2,t3-t0))
-        return f0
+        return self.decode(hidden, thred=thred)
 
     def to_local_average_cents(self, salience, thred=0.05):
-        # t0 = ttime()
+        """
+        Salience-weighted average of the cents in a 9 bin window around the peak of each frame, 0 where the peak is under thred
+        """
         center = np.argmax(salience, axis=1)  # 帧长#index
-        salience = np.pad(salience, ((0, 0), (4, 4)))  # 帧长,368
-        # t1 = ttime()
-        center += 4
-        todo_salience = []
-        todo_cents_mapping = []
-        starts = center - 4
-        ends = center + 5
-        for idx in range(salience.shape[0]):
-            todo_salience.append(salience[:, starts[idx] : ends[idx]][idx])
-            todo_cents_mapping.append(self.cents_mapping[starts[idx] : ends[idx]])
-        # t2 = ttime()
-        todo_salience = np.array(todo_salience)  # 帧长，9
-        todo_cents_mapping = np.array(todo_cents_mapping)  # 帧长，9
+        # window of 9 bins centered on the peak, bins past either edge weigh 0 as if the salience was zero padded
+        window = center[:, None] + np.arange(-4, 5)
+        todo_salience = np.take_along_axis(salience, np.clip(window, 0, salience.shape[1] - 1), axis=1)  # 帧长，9
+        todo_salience[(window < 0) | (window >= salience.shape[1])] = 0
+        todo_cents_mapping = self.cents_mapping[window + 4]  # 帧长，9
         product_sum = np.sum(todo_salience * todo_cents_mapping, 1)
         weight_sum = np.sum(todo_salience, 1)  # 帧长
         devided = product_sum / weight_sum  # 帧长
-        # t3 = ttime()
-        maxx = np.max(salience, axis=1)  # 帧长
+        maxx = np.take_along_axis(salience, center[:, None], axis=1)[:, 0]  # 帧长
+        devided[maxx <= thred] = 0
+        return devided
+
+    def to_local_average_cents_torch(self, salience, thred=0.05):
+        """Same as to_local_average_cents on a tensor, on its device"""
+        cents_mapping = self.cents_mapping_torch.get(salience.device)
+        if cents_mapping is None:
+            cents_mapping = torch.from_numpy(self.cents_mapping).float().to(salience.device)
+            self.cents_mapping_torch[salience.device] = cents_mapping
+        maxx, center = torch.max(salience, dim=1)
+        window = center[:, None] + torch.arange(-4, 5, device=salience.device)
+        todo_salience = torch.gather(salience, 1, window.clamp(0, salience.shape[1] - 1))
+        todo_salience[(window < 0) | (window >= salience.shape[1])] = 0
+        devided = torch.sum(todo_salience * cents_mapping[window + 4], 1) / torch.sum(todo_salience, 1)
         devided[maxx <= thred] = 0
-        # t4 = ttime()
-        # print("decode:%s\t%s\t%s\t%s" % (t1 - t0, t2 - t1, t3 - t2, t4 - t3))
         return devided
@@ -1,3 +1,4 @@
+import os
 from multiprocessing import cpu_count
 from pathlib import Path
 
@@ -5,6 +6,7 @@ import torch
 from fairseq import checkpoint_utils
 from scipy.io import wavfile
 
+from caches import get_file_hash, replace_file
 from infer_pack.models import (
     SynthesizerTrnMs256NSFsid,
     SynthesizerTrnMs256NSFsid_nono,
@@ -16,6 +18,9 @@ from vc_infer_pipeline import VC
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 
+# bump when prepare_for_inference changes so that older .infer.pt files are rebuilt
+INFERENCE_CHECKPOINT_VERSION = 1
+
 
 class Config:
     def __init__(self, device, is_half):
@@ -27,7 +32,7 @@ class Config:
         self.x_pad, self.x_query, self.x_center, self.x_max = self.device_config()
 
     def device_config(self) -> tuple:
-        if torch.cuda.is_available():
+        if self.device.startswith("cuda") and torch.cuda.is_available():
             i_device = int(self.device.split(":")[-1])
             self.gpu_name = torch.cuda.get_device_name(i_device)
             if (
@@ -62,13 +67,16 @@ class Config:
                     strr = f.read().replace("3.7", "3.0")
                 with open(BASE_DIR / "src" / "trainset_preprocess_pipeline_print.py", "w") as f:
                     f.write(strr)
-        elif torch.backends.mps.is_available():
-            print("No supported N-card found, use MPS for inference")
+        elif self.device != "cpu" and torch.backends.mps.is_available():
+            if self.device != "mps":
+                print("No supported N-card found, use MPS for inference")
             self.device = "mps"
         else:
-            print("No supported N-card found, use CPU for inference")
+            if self.device != "cpu":
+                print("No supported N-card found, use CPU for inference")
             self.device = "cpu"
-            self.is_half = True
+            # fp16 kernels on CPU are emulated and slower than fp32
+            self.is_half = False
 
         if self.n_cpu == 0:
             self.n_cpu = cpu_count()
@@ -106,16 +114,12 @@ def load_hubert(device, is_half, model_path):
         hubert = hubert.float()
 
     hubert.eval()
+    # cached features are keyed on the checkpoint they were extracted with
+    hubert.checkpoint_hash = get_file_hash(model_path)
     return hubert
 
 
-def get_vc(device, is_half, config, model_path):
-    cpt = torch.load(model_path, map_location='cpu')
-    if "config" not in cpt or "weight" not in cpt:
-        raise ValueError(f'Incorrect format for {model_path}. Use a voice model trained using RVC v2 instead.')
-
-    tgt_sr = cpt["config"][-1]
-    cpt["config"][-3] = cpt["weight"]["emb_g.weight"].shape[0]
+def get_synthesizer(cpt, is_half):
     if_f0 = cpt.get("f0", 1)
     version = cpt.get("version", "v1")
 
@@ -131,7 +135,77 @@ def get_vc(device, is_half, config, model_path):
             net_g = SynthesizerTrnMs768NSFsid_nono(*cpt["config"])
 
     del net_g.enc_q
-    print(net_g.load_state_dict(cpt["weight"], strict=False))
+    return version, net_g
+
+
+def prepare_for_inference(net_g):
+    """
+    Fold weight norm into the conv weights and replace dropout with identity, so that
+    each forward pass no longer recomputes its kernels. The synthesizer can't be trained afterwards.
+    """
+    net_g.dec.remove_weight_norm()
+    net_g.flow.remove_weight_norm()
+    for module in list(net_g.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, torch.nn.Dropout):
+                setattr(module, name, torch.nn.Identity())
+    return net_g
+
+
+def get_inference_checkpoint_path(model_path):
+    return str(Path(model_path).with_suffix(".infer.pt"))
+
+
+def load_inference_checkpoint(model_path):
+    """
+    Returns:
+        dict: Checkpoint with already folded weights saved by save_inference_checkpoint, or None if missing or out of date
+    """
+    infer_path = get_inference_checkpoint_path(model_path)
+    if not os.path.exists(infer_path):
+        return None
+    try:
+        cpt = torch.load(infer_path, map_location='cpu')
+    except Exception:
+        return None
+    if cpt.get("source_mtime") != os.path.getmtime(model_path) or cpt.get("inference_version") != INFERENCE_CHECKPOINT_VERSION:
+        return None
+    return cpt
+
+
+def save_inference_checkpoint(model_path, cpt, net_g):
+    infer_cpt = {k: v for k, v in cpt.items() if k != "weight"}
+    infer_cpt["weight"] = {k: v.detach().cpu() for k, v in net_g.state_dict().items()}
+    infer_cpt["source_mtime"] = os.path.getmtime(model_path)
+    infer_cpt["inference_version"] = INFERENCE_CHECKPOINT_VERSION
+    try:
+        replace_file(get_inference_checkpoint_path(model_path), lambda tmp_path: torch.save(infer_cpt, tmp_path))
+    except OSError as e:
+        # read-only model folders still work, they just prepare the model on every load
+        print(f'[~] Could not save inference checkpoint for {model_path}: {e}')
+
+
+def get_vc(device, is_half, config, model_path):
+    cpt = load_inference_checkpoint(model_path)
+    if cpt is not None:
+        version, net_g = get_synthesizer(cpt, is_half)
+        # fold the freshly initialized weight norm so the module layout matches the saved weights
+        prepare_for_inference(net_g)
+        net_g.load_state_dict(cpt["weight"])
+
+    else:
+        cpt = torch.load(model_path, map_location='cpu')
+        if "config" not in cpt or "weight" not in cpt:
+            raise ValueError(f'Incorrect format for {model_path}. Use a voice model trained using RVC v2 instead.')
+
+        cpt["config"][-3] = cpt["weight"]["emb_g.weight"].shape[0]
+        version, net_g = get_synthesizer(cpt, is_half)
+        print(net_g.load_state_dict(cpt["weight"], strict=False))
+        # weights are folded in float32, before any conversion to half
+        prepare_for_inference(net_g)
+        save_inference_checkpoint(model_path, cpt, net_g)
+
+    tgt_sr = cpt["config"][-1]
     net_g.eval().to(device)
 
     if is_half:
@@ -0,0 +1,166 @@
+import inspect
+import os
+
+import torch
+
+from caches import replace_file
+from execution import execution_profile
+from infer_pack.models_onnx import SynthesizerTrnMsNSFsidM
+
+# bump when the exported graph changes so that older .onnx files are exported again
+ONNX_EXPORT_VERSION = 1
+ONNX_OPSET = 17
+
+
+def get_onnx_path(model_path):
+    return f'{os.path.splitext(model_path)[0]}.onnx'
+
+
+def can_export(cpt):
+    """Only models trained with pitch have an export-friendly synthesizer"""
+    return cpt.get('f0', 1) == 1
+
+
+def export_onnx(model_path, onnx_path=None, cpt=None):
+    """
+    Export an RVC voice model to ONNX, with dynamic time axes and weight norm folded into the convolutions
+
+    Args:
+        model_path: (str) Path of the .pth voice model
+        onnx_path: (str) Output path, defaults to the .pth path with an .onnx extension
+        cpt: (dict) Already loaded checkpoint of model_path
+
+    Returns:
+        str: Path of the exported model
+    """
+    from rvc import prepare_for_inference
+
+    onnx_path = onnx_path or get_onnx_path(model_path)
+    if cpt is None:
+        cpt = torch.load(model_path, map_location='cpu')
+    if not can_export(cpt):
+        raise ValueError(f'{model_path} was trained without pitch guidance and can\'t be exported to ONNX.')
+
+    config = list(cpt['config'])
+    config[-3] = cpt['weight']['emb_g.weight'].shape[0]
+    version = cpt.get('version', 'v1')
+    net_g = SynthesizerTrnMsNSFsidM(*config, is_half=False, version=version)
+    net_g.load_state_dict(cpt['weight'], strict=False)
+    del net_g.enc_q
+    prepare_for_inference(net_g.eval())
+
+    frames = 200
+    phone = torch.rand(1, frames, 256 if version == 'v1' else 768)
+    phone_lengths = torch.tensor([frames]).long()
+    pitch = torch.randint(size=(1, frames), low=5, high=255)
+    pitchf = torch.rand(1, frames) * 400 + 50
+    sid = torch.LongTensor([0])
+    rnd = torch.rand(1, net_g.inter_channels, frames)
+
+    def write(tmp_path):
+        torch.onnx.export(
+            net_g,
+            (phone, phone_lengths, pitch, pitchf, sid, rnd),
+            tmp_path,
+            input_names=['phone', 'phone_lengths', 'pitch', 'pitchf', 'sid', 'rnd'],
+            output_names=['audio'],
+            dynamic_axes={'phone': [1], 'pitch': [1], 'pitchf': [1], 'rnd': [2], 'audio': [2]},
+            do_constant_folding=True,
+            opset_version=ONNX_OPSET,
+            **get_export_kwargs(),
+        )
+        set_source(tmp_path, model_path, ONNX_EXPORT_VERSION)
+
+    with torch.no_grad():
+        replace_file(onnx_path, write)
+    return onnx_path
+
+
+def get_export_kwargs():
+    # newer torch defaults to the dynamo exporter, the TorchScript one handles these models' control flow
+    return {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+
+
+def set_source(onnx_path, model_path, export_version):
+    """Record what an ONNX file was exported from, so that a re-trained model is exported again"""
+    import onnx
+
+    model = onnx.load(onnx_path)
+    onnx.helper.set_model_props(model, {'source_mtime': str(os.path.getmtime(model_path)), 'export_version': str(export_version)})
+    onnx.save(model, onnx_path)
+
+
+def is_up_to_date(model_path, onnx_path, export_version=ONNX_EXPORT_VERSION):
+    if not os.path.exists(onnx_path):
+        return False
+    import onnx
+
+    try:
+        model = onnx.load(onnx_path, load_external_data=False)
+    except Exception:
+        return False
+    props = {prop.key: prop.value for prop in model.metadata_props}
+    return props.get('source_mtime') == str(os.path.getmtime(model_path)) and props.get('export_version') == str(export_version)
+
+
+def get_onnx_model(model_path, cpt=None):
+    """
+    Path of the cached ONNX export of a voice model, exporting it first if missing or out of date
+    """
+    onnx_path = get_onnx_path(model_path)
+    if not is_up_to_date(model_path, onnx_path):
+        print(f'[~] Exporting {os.path.basename(model_path)} to ONNX...')
+        export_onnx(model_path, onnx_path, cpt)
+    return onnx_path
+
+
+class OnnxSynthesizer:
+    """
+    ONNX Runtime backend for the RVC synthesizer, a drop-in replacement of net_g in VC.vc
+
+    Only the pitch-guided infer() signature is supported, see can_export.
+    """
+
+    def __init__(self, onnx_path, inter_channels=192):
+        import onnxruntime as ort
+
+        self.ort = ort.InferenceSession(onnx_path, sess_options=execution_profile.get_ort_session_options(),
+                                        providers=execution_profile.get_ort_providers())
+        self.inter_channels = inter_channels
+        # read by get_model_size, the session holds about one copy of the weights
+        self.nbytes = os.path.getsize(onnx_path)
+
+    def infer(self, phone, phone_lengths, pitch, nsff0, sid, generator=None):
+        # same noise scale as SynthesizerTrnMs*NSFsid.infer, the sine source noise is drawn inside the graph
+        rnd = torch.randn((1, self.inter_channels, phone.shape[1]), generator=generator, device=generator.device if generator else 'cpu')
+        rnd = rnd.cpu().numpy() * 0.66666
+        audio = self.ort.run(None, {
+            'phone': phone.float().cpu().numpy(),
+            'phone_lengths': phone_lengths.cpu().numpy(),
+            'pitch': pitch.cpu().numpy(),
+            'pitchf': nsff0.float().cpu().numpy(),
+            'sid': sid.cpu().numpy(),
+            'rnd': rnd,
+        })[0]
+        return torch.from_numpy(audio), None, None
+
+
+def get_onnx_vc(device, is_half, config, model_path):
+    """
+    Same as rvc.get_vc, with net_g running the cached ONNX export of the model.
+    Models trained without pitch guidance fall back to the torch synthesizer.
+    """
+    from rvc import get_vc
+    from vc_infer_pipeline import VC
+
+    cpt = torch.load(model_path, map_location='cpu')
+    if "config" not in cpt or "weight" not in cpt:
+        raise ValueError(f'Incorrect format for {model_path}. Use a voice model trained using RVC v2 instead.')
+    if not can_export(cpt):
+        print(f'[~] {os.path.basename(model_path)} has no pitch guidance, using the torch synthesizer')
+        return get_vc(device, is_half, config, model_path)
+
+    cpt["config"][-3] = cpt["weight"]["emb_g.weight"].shape[0]
+    net_g = OnnxSynthesizer(get_onnx_model(model_path, cpt), inter_channels=cpt["config"][2])
+    tgt_sr = cpt["config"][-1]
+    return cpt, cpt.get("version", "v1"), net_g, tgt_sr, VC(tgt_sr, config)
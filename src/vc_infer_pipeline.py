@@ -1,7 +1,5 @@
-from functools import lru_cache
 from time import time as ttime
 
-import faiss
 import librosa
 import numpy as np
 import os
@@ -12,21 +10,29 @@ import torch
 import torch.nn.functional as F
 import torchcrepe
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from scipy import signal
 from torch import Tensor
 
+from caches import f0_cache, feature_cache, get_array_hash, get_key
+from execution import execution_profile
+from profiling import profiler
+
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 now_dir = os.path.join(BASE_DIR, 'src')
 sys.path.append(now_dir)
 
 bh, ah = signal.butter(N=5, Wn=48, btype="high", fs=16000)
 
-input_audio_path2wav = {}
+# pitch search range and voicing thresholds, part of the f0 cache key
+f0_min = 50
+f0_max = 1100
+pm_voicing_threshold = 0.6
+rmvpe_threshold = 0.03
 
 
-@lru_cache
-def cache_harvest_f0(input_audio_path, fs, f0max, f0min, frame_period):
-    audio = input_audio_path2wav[input_audio_path]
+def harvest_f0(audio, fs, f0max, f0min, frame_period):
     f0, t = pyworld.harvest(
         audio,
         fs=fs,
@@ -38,25 +44,84 @@ def cache_harvest_f0(input_audio_path, fs, f0max, f0min, frame_period):
     return f0
 
 
+def get_split_points(audio, window, t_center, t_query):
+    """
+    Where to cut audio into segments of about t_center samples: the quietest sample, by the summed
+    amplitude of the window around it, within t_query samples of every multiple of t_center
+
+    Args:
+        audio: (np.ndarray) Mono audio
+        window: (int) Samples summed around each candidate
+        t_center: (int) Target segment length
+        t_query: (int) How far a split point can move from its target, less than t_center
+
+    Returns:
+        list: Split points in samples, ascending
+    """
+    if t_center >= audio.shape[0]:
+        return []
+    audio_pad = np.pad(audio, (window // 2, window // 2), mode="reflect")
+    # moving sum of window samples, the same as summing window shifted copies. A difference of running
+    # totals would be cheaper but its rounding error swamps the near-silence the search is looking for
+    audio_sum = np.abs(np.convolve(audio_pad, np.ones(window), mode="valid")[: audio.shape[0]])
+    # query windows past the end are cut short, padding them with inf keeps them out of the argmin
+    audio_sum = np.pad(audio_sum, (0, t_query), constant_values=np.inf)
+    targets = np.arange(t_center, audio.shape[0], t_center)
+    queries = np.lib.stride_tricks.sliding_window_view(audio_sum, 2 * t_query)[targets - t_query]
+    return (targets - t_query + np.argmin(queries, axis=1)).tolist()
+
+
+def get_f0_coarse(f0):
+    """Pitch in Hz to the 1-255 mel bins of the synthesizer's pitch embedding, 1 for unvoiced frames"""
+    f0_mel_min = 1127 * np.log(1 + f0_min / 700)
+    f0_mel_max = 1127 * np.log(1 + f0_max / 700)
+    f0_mel = 1127 * np.log(1 + f0 / 700)
+    f0_mel[f0_mel > 0] = (f0_mel[f0_mel > 0] - f0_mel_min) * 254 / (
+        f0_mel_max - f0_mel_min
+    ) + 1
+    f0_mel[f0_mel <= 1] = 1
+    f0_mel[f0_mel > 255] = 255
+    return np.rint(f0_mel).astype(np.int)
+
+
+# samples of gain interpolated at once by change_rms
+rms_gain_block = 65536
+
+
+def get_frame_rms(data, hop):
+    """
+    RMS of frames of 2 * hop samples every hop samples, centered and zero padded like librosa.feature.rms,
+    from the energy of each hop so that no framed copy of the audio is made
+    """
+    n_hops = data.shape[0] // hop
+    # energy of hop-long slices of the padded audio: the left pad, the audio, its remainder and the right pad
+    hop_energy = np.zeros(n_hops + 2)
+    full_hops = data[: n_hops * hop].reshape(n_hops, hop)
+    hop_energy[1 : n_hops + 1] = np.einsum("ij,ij->i", full_hops, full_hops, dtype=np.float64)
+    rest = data[n_hops * hop :].astype(np.float64)
+    hop_energy[n_hops + 1] = np.dot(rest, rest)
+    return np.sqrt((hop_energy[:-1] + hop_energy[1:]) / (2 * hop))
+
+
+def interpolate_frames(frames, start, stop, length):
+    """Samples start to stop of frames linearly stretched to length samples, like F.interpolate with align_corners=False"""
+    positions = (np.arange(start, stop) + 0.5) * (frames.shape[0] / length) - 0.5
+    return np.interp(positions, np.arange(frames.shape[0]), frames)
+
+
 def change_rms(data1, sr1, data2, sr2, rate):  # 1是输入音频，2是输出音频,rate是2的占比
-    # print(data1.max(),data2.max())
-    rms1 = librosa.feature.rms(
-        y=data1, frame_length=sr1 // 2 * 2, hop_length=sr1 // 2
-    )  # 每半秒一个点
-    rms2 = librosa.feature.rms(y=data2, frame_length=sr2 // 2 * 2, hop_length=sr2 // 2)
-    rms1 = torch.from_numpy(rms1)
-    rms1 = F.interpolate(
-        rms1.unsqueeze(0), size=data2.shape[0], mode="linear"
-    ).squeeze()
-    rms2 = torch.from_numpy(rms2)
-    rms2 = F.interpolate(
-        rms2.unsqueeze(0), size=data2.shape[0], mode="linear"
-    ).squeeze()
-    rms2 = torch.max(rms2, torch.zeros_like(rms2) + 1e-6)
-    data2 *= (
-        torch.pow(rms1, torch.tensor(1 - rate))
-        * torch.pow(rms2, torch.tensor(rate - 1))
-    ).numpy()
+    """
+    Blend the loudness envelope of data2 towards that of data1, in place. The half-second RMS envelopes are
+    stretched to the length of data2 a block at a time, so memory grows with the number of frames, not samples.
+    """
+    rms1 = get_frame_rms(data1, sr1 // 2)  # 每半秒一个点
+    rms2 = get_frame_rms(data2, sr2 // 2)
+    length = data2.shape[0]
+    for start in range(0, length, rms_gain_block):
+        stop = min(start + rms_gain_block, length)
+        gain1 = interpolate_frames(rms1, start, stop, length)
+        gain2 = np.maximum(interpolate_frames(rms2, start, stop, length), 1e-6)
+        data2[start:stop] *= gain1 ** (1 - rate) * gain2 ** (rate - 1)
     return data2
 
 
@@ -192,6 +257,7 @@ class VC(object):
         f0_computation_stack = []
 
         print("Calculating f0 pitch estimations for methods: %s" % str(methods))
+        harvest_audio = x.astype(np.double)
         x = x.astype(np.float32)
         x /= np.quantile(np.abs(x), 0.999)
         # Get f0 calculations for all methods specified
@@ -202,7 +268,7 @@ class VC(object):
                     parselmouth.Sound(x, self.sr)
                     .to_pitch_ac(
                         time_step=time_step / 1000,
-                        voicing_threshold=0.6,
+                        voicing_threshold=pm_voicing_threshold,
                         pitch_floor=f0_min,
                         pitch_ceiling=f0_max,
                     )
@@ -228,7 +294,7 @@ class VC(object):
                     x, f0_min, f0_max, p_len, crepe_hop_length, "tiny"
                 )
             elif method == "harvest":
-                f0 = cache_harvest_f0(input_audio_path, self.sr, f0_max, f0_min, 10)
+                f0 = harvest_f0(harvest_audio, self.sr, f0_max, f0_min, 10)
                 if filter_radius > 2:
                     f0 = signal.medfilt(f0, 3)
                 f0 = f0[1:]  # Get rid of first frame.
@@ -259,29 +325,35 @@ class VC(object):
             f0_median_hybrid = np.nanmedian(f0_computation_stack, axis=0)
         return f0_median_hybrid
 
-    def get_f0(
+    def get_f0_cache_key(self, x, p_len, f0_method, filter_radius, crepe_hop_length):
+        key_parts = [get_array_hash(x), f0_method, p_len, self.sr, self.window, f0_min, f0_max]
+        if "pm" in f0_method:
+            key_parts.append(pm_voicing_threshold)
+        if "harvest" in f0_method:
+            key_parts.append(filter_radius > 2)
+        if "mangio-crepe" in f0_method:
+            key_parts.append(crepe_hop_length)
+        if f0_method == "rmvpe":
+            key_parts += [rmvpe_threshold, self.is_half, execution_profile.rmvpe_backend, execution_profile.rmvpe_chunk_frames]
+        return get_key(*key_parts)
+
+    def compute_f0(
         self,
         input_audio_path,
         x,
         p_len,
-        f0_up_key,
         f0_method,
         filter_radius,
         crepe_hop_length,
-        inp_f0=None,
     ):
-        global input_audio_path2wav
+        """Pitch curve of x in Hz, before any transposition"""
         time_step = self.window / self.sr * 1000
-        f0_min = 50
-        f0_max = 1100
-        f0_mel_min = 1127 * np.log(1 + f0_min / 700)
-        f0_mel_max = 1127 * np.log(1 + f0_max / 700)
         if f0_method == "pm":
             f0 = (
                 parselmouth.Sound(x, self.sr)
                 .to_pitch_ac(
                     time_step=time_step / 1000,
-                    voicing_threshold=0.6,
+                    voicing_threshold=pm_voicing_threshold,
                     pitch_floor=f0_min,
                     pitch_ceiling=f0_max,
                 )
@@ -293,8 +365,7 @@ class VC(object):
                     f0, [[pad_size, p_len - len(f0) - pad_size]], mode="constant"
                 )
         elif f0_method == "harvest":
-            input_audio_path2wav[input_audio_path] = x.astype(np.double)
-            f0 = cache_harvest_f0(input_audio_path, self.sr, f0_max, f0_min, 10)
+            f0 = harvest_f0(x.astype(np.double), self.sr, f0_max, f0_min, 10)
             if filter_radius > 2:
                 f0 = signal.medfilt(f0, 3)
         elif f0_method == "dio":  # Potentially Buggy?
@@ -320,17 +391,16 @@ class VC(object):
                 x, f0_min, f0_max, p_len, crepe_hop_length, "tiny"
             )
         elif f0_method == "rmvpe":
-            if hasattr(self, "model_rmvpe") == False:
-                from rmvpe import RMVPE
+            from model_registry import model_registry
 
-                self.model_rmvpe = RMVPE(
-                    os.path.join(BASE_DIR, 'rvc_models', 'rmvpe.pt'), is_half=self.is_half, device=self.device
-                )
-            f0 = self.model_rmvpe.infer_from_audio(x, thred=0.03)
+            model_rmvpe = model_registry.get_rmvpe(
+                self.device, self.is_half, os.path.join(BASE_DIR, 'rvc_models', 'rmvpe.pt'),
+                execution_profile.rmvpe_backend,
+            )
+            f0 = model_rmvpe.infer_from_audio(x, thred=rmvpe_threshold, chunk_frames=execution_profile.rmvpe_chunk_frames)
 
         elif "hybrid" in f0_method:
             # Perform hybrid median pitch estimation
-            input_audio_path2wav[input_audio_path] = x.astype(np.double)
             f0 = self.get_f0_hybrid_computation(
                 f0_method,
                 input_audio_path,
@@ -342,8 +412,35 @@ class VC(object):
                 crepe_hop_length,
                 time_step,
             )
+        return f0
 
-        f0 *= pow(2, f0_up_key / 12)
+    def get_f0(
+        self,
+        input_audio_path,
+        x,
+        p_len,
+        f0_up_key,
+        f0_method,
+        filter_radius,
+        crepe_hop_length,
+        inp_f0=None,
+    ):
+        # the cached curve is untransposed, so converting the same vocals with another pitch change reuses it
+        f0 = None
+        if f0_cache.enabled:
+            cache_key = self.get_f0_cache_key(x, p_len, f0_method, filter_radius, crepe_hop_length)
+            cached = f0_cache.load(cache_key)
+            if cached is not None:
+                f0 = cached["f0"]
+        if f0 is None:
+            with profiler.stage("f0", method=f0_method):
+                f0 = self.compute_f0(
+                    input_audio_path, x, p_len, f0_method, filter_radius, crepe_hop_length
+                )
+            if f0_cache.enabled:
+                f0_cache.save(cache_key, f0=f0)
+
+        f0 = f0 * pow(2, f0_up_key / 12)
         # with open("test.txt","w")as f:f.write("\n".join([str(i)for i in f0.tolist()]))
         tf0 = self.sr // self.window  # 每秒f0点数
         if inp_f0 is not None:
@@ -358,32 +455,17 @@ class VC(object):
                 :shape
             ]
         # with open("test_opt.txt","w")as f:f.write("\n".join([str(i)for i in f0.tolist()]))
-        f0bak = f0.copy()
-        f0_mel = 1127 * np.log(1 + f0 / 700)
-        f0_mel[f0_mel > 0] = (f0_mel[f0_mel > 0] - f0_mel_min) * 254 / (
-            f0_mel_max - f0_mel_min
-        ) + 1
-        f0_mel[f0_mel <= 1] = 1
-        f0_mel[f0_mel > 255] = 255
-        f0_coarse = np.rint(f0_mel).astype(np.int)
+        return get_f0_coarse(f0), f0.copy()  # 1-0
 
-        return f0_coarse, f0bak  # 1-0
+    def extract_features(self, model, audio0, version, use_cache=True):
+        """
+        HuBERT features of a segment: layer 9 through final_proj for v1 models, layer 12 for v2 models.
 
-    def vc(
-        self,
-        model,
-        net_g,
-        sid,
-        audio0,
-        pitch,
-        pitchf,
-        times,
-        index,
-        big_npy,
-        index_rate,
-        version,
-        protect,
-    ):  # ,file_index,file_big_npy
+        With the feature cache enabled they are saved at float32, since they only depend on the audio,
+        the HuBERT checkpoint and the model version, so converting the same vocals with other voice models
+        of the same version skips HuBERT and gives the same output as a miss. use_cache=False bypasses it
+        for audio that is never converted again, such as the blocks of a live stream.
+        """
         feats = torch.from_numpy(audio0)
         if self.is_half:
             feats = feats.half()
@@ -394,16 +476,50 @@ class VC(object):
         assert feats.dim() == 1, feats.dim()
         feats = feats.view(1, -1)
         padding_mask = torch.BoolTensor(feats.shape).to(self.device).fill_(False)
+        dtype = feats.dtype
+
+        # set by rvc.load_hubert, models loaded any other way are not cached
+        checkpoint_hash = getattr(model, "checkpoint_hash", None)
+        use_cache = use_cache and feature_cache.enabled and checkpoint_hash is not None
+        if use_cache:
+            cache_key = get_key(get_array_hash(audio0), checkpoint_hash, version, self.t_pad, self.window, self.is_half, execution_profile.precision)
+            cached = feature_cache.load(cache_key)
+            if cached is not None:
+                return torch.from_numpy(cached["feats"]).to(self.device, dtype)
 
         inputs = {
             "source": feats.to(self.device),
             "padding_mask": padding_mask,
             "output_layer": 9 if version == "v1" else 12,
         }
-        t0 = ttime()
-        with torch.no_grad():
+        with torch.no_grad(), execution_profile.autocast(), profiler.stage("hubert"):
             logits = model.extract_features(**inputs)
             feats = model.final_proj(logits[0]) if version == "v1" else logits[0]
+
+        if use_cache:
+            feature_cache.save(cache_key, feats=feats.float().cpu().numpy())
+        # bf16 autocast outputs are brought back to the model dtype
+        return feats.to(dtype)
+
+    def vc(
+        self,
+        model,
+        net_g,
+        sid,
+        audio0,
+        pitch,
+        pitchf,
+        times,
+        index,
+        big_npy,
+        index_rate,
+        version,
+        protect,
+        generator=None,
+        use_feature_cache=True,
+    ):  # ,file_index,file_big_npy
+        t0 = ttime()
+        feats = self.extract_features(model, audio0, version, use_feature_cache)
         if protect < 0.5 and pitch != None and pitchf != None:
             feats0 = feats.clone()
         if (
@@ -418,10 +534,11 @@ class VC(object):
             # _, I = index.search(npy, 1)
             # npy = big_npy[I.squeeze()]
 
-            score, ix = index.search(npy, k=8)
-            weight = np.square(1 / score)
-            weight /= weight.sum(axis=1, keepdims=True)
-            npy = np.sum(big_npy[ix] * np.expand_dims(weight, axis=2), axis=1)
+            with profiler.stage("index"):
+                score, ix = index.search(npy, k=8)
+                weight = np.square(1 / score)
+                weight /= weight.sum(axis=1, keepdims=True)
+                npy = np.sum(big_npy[ix] * np.expand_dims(weight, axis=2), axis=1)
 
             if self.is_half:
                 npy = npy.astype("float16")
@@ -451,19 +568,19 @@ class VC(object):
             feats = feats * pitchff + feats0 * (1 - pitchff)
             feats = feats.to(feats0.dtype)
         p_len = torch.tensor([p_len], device=self.device).long()
-        with torch.no_grad():
+        with torch.no_grad(), execution_profile.autocast(), profiler.stage("net_g", frames=int(p_len[0])):
             if pitch != None and pitchf != None:
                 audio1 = (
-                    (net_g.infer(feats, p_len, pitch, pitchf, sid)[0][0, 0])
+                    (net_g.infer(feats, p_len, pitch, pitchf, sid, generator=generator)[0][0, 0])
                     .data.cpu()
                     .float()
                     .numpy()
                 )
             else:
                 audio1 = (
-                    (net_g.infer(feats, p_len, sid)[0][0, 0]).data.cpu().float().numpy()
+                    (net_g.infer(feats, p_len, sid, generator=generator)[0][0, 0]).data.cpu().float().numpy()
                 )
-        del feats, p_len, padding_mask
+        del feats, p_len
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
         t2 = ttime()
@@ -471,6 +588,68 @@ class VC(object):
         times[2] += t2 - t1
         return audio1
 
+    def convert_segments(
+        self,
+        model,
+        net_g,
+        sid,
+        audio_pad,
+        pitch,
+        pitchf,
+        segments,
+        times,
+        index,
+        big_npy,
+        index_rate,
+        version,
+        protect,
+    ):
+        """
+        Convert every (start, end) sample range of audio_pad with self.vc, up to execution_profile.max_parallel_segments
+        at a time on a worker pool. On GPU every worker queues its kernels on its own CUDA stream.
+
+        Each segment draws its noise from its own generator, seeded from the global RNG once per song,
+        so the output is the same whatever the number of workers and the order segments finish in.
+
+        Returns:
+            list: Converted audio of each segment, trimmed of its padding
+        """
+        base_seed = int(torch.randint(0, 2**31 - len(segments), (1,)).item())
+        is_cuda = str(self.device).startswith("cuda")
+
+        def convert(i):
+            start, end = segments[i]
+            frames = slice(
+                start // self.window if start is not None else None,
+                (end - self.window) // self.window if end is not None else None,
+            )
+            generator = torch.Generator(device=self.device).manual_seed(base_seed + i)
+            with torch.cuda.stream(torch.cuda.Stream(self.device)) if workers > 1 and is_cuda else nullcontext():
+                audio1 = self.vc(
+                    model,
+                    net_g,
+                    sid,
+                    audio_pad[start:end],
+                    pitch[:, frames] if pitch is not None else None,
+                    pitchf[:, frames] if pitchf is not None else None,
+                    times,
+                    index,
+                    big_npy,
+                    index_rate,
+                    version,
+                    protect,
+                    generator,
+                )
+                if workers > 1 and is_cuda:
+                    torch.cuda.current_stream(self.device).synchronize()
+            return audio1[self.t_pad_tgt : -self.t_pad_tgt]
+
+        workers = min(execution_profile.max_parallel_segments, len(segments))
+        if workers <= 1:
+            return [convert(i) for i in range(len(segments))]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(convert, range(len(segments))))
+
     def pipeline(
         self,
         model,
@@ -502,32 +681,19 @@ class VC(object):
             and index_rate != 0
         ):
             try:
-                index = faiss.read_index(file_index)
-                # big_npy = np.load(file_big_npy)
-                big_npy = index.reconstruct_n(0, index.ntotal)
+                from model_registry import model_registry
+
+                index, big_npy = model_registry.get_index(file_index)
             except:
                 traceback.print_exc()
                 index = big_npy = None
         else:
             index = big_npy = None
         audio = signal.filtfilt(bh, ah, audio)
-        audio_pad = np.pad(audio, (self.window // 2, self.window // 2), mode="reflect")
         opt_ts = []
-        if audio_pad.shape[0] > self.t_max:
-            audio_sum = np.zeros_like(audio)
-            for i in range(self.window):
-                audio_sum += audio_pad[i : i - self.window]
-            for t in range(self.t_center, audio.shape[0], self.t_center):
-                opt_ts.append(
-                    t
-                    - self.t_query
-                    + np.where(
-                        np.abs(audio_sum[t - self.t_query : t + self.t_query])
-                        == np.abs(audio_sum[t - self.t_query : t + self.t_query]).min()
-                    )[0][0]
-                )
+        if audio.shape[0] + self.window // 2 * 2 > self.t_max:
+            opt_ts = get_split_points(audio, self.window, self.t_center, self.t_query)
         s = 0
-        audio_opt = []
         t = None
         t1 = ttime()
         audio_pad = np.pad(audio, (self.t_pad, self.t_pad), mode="reflect")
@@ -564,77 +730,15 @@ class VC(object):
             pitchf = torch.tensor(pitchf, device=self.device).unsqueeze(0).float()
         t2 = ttime()
         times[1] += t2 - t1
+        segments = []
         for t in opt_ts:
             t = t // self.window * self.window
-            if if_f0 == 1:
-                audio_opt.append(
-                    self.vc(
-                        model,
-                        net_g,
-                        sid,
-                        audio_pad[s : t + self.t_pad2 + self.window],
-                        pitch[:, s // self.window : (t + self.t_pad2) // self.window],
-                        pitchf[:, s // self.window : (t + self.t_pad2) // self.window],
-                        times,
-                        index,
-                        big_npy,
-                        index_rate,
-                        version,
-                        protect,
-                    )[self.t_pad_tgt : -self.t_pad_tgt]
-                )
-            else:
-                audio_opt.append(
-                    self.vc(
-                        model,
-                        net_g,
-                        sid,
-                        audio_pad[s : t + self.t_pad2 + self.window],
-                        None,
-                        None,
-                        times,
-                        index,
-                        big_npy,
-                        index_rate,
-                        version,
-                        protect,
-                    )[self.t_pad_tgt : -self.t_pad_tgt]
-                )
+            segments.append((s, t + self.t_pad2 + self.window))
             s = t
-        if if_f0 == 1:
-            audio_opt.append(
-                self.vc(
-                    model,
-                    net_g,
-                    sid,
-                    audio_pad[t:],
-                    pitch[:, t // self.window :] if t is not None else pitch,
-                    pitchf[:, t // self.window :] if t is not None else pitchf,
-                    times,
-                    index,
-                    big_npy,
-                    index_rate,
-                    version,
-                    protect,
-                )[self.t_pad_tgt : -self.t_pad_tgt]
-            )
-        else:
-            audio_opt.append(
-                self.vc(
-                    model,
-                    net_g,
-                    sid,
-                    audio_pad[t:],
-                    None,
-                    None,
-                    times,
-                    index,
-                    big_npy,
-                    index_rate,
-                    version,
-                    protect,
-                )[self.t_pad_tgt : -self.t_pad_tgt]
-            )
+        segments.append((t, None))
+        audio_opt = self.convert_segments(
+            model, net_g, sid, audio_pad, pitch, pitchf, segments, times, index, big_npy, index_rate, version, protect
+        )
         audio_opt = np.concatenate(audio_opt)
         if rms_mix_rate != 1:
             audio_opt = change_rms(audio, 16000, audio_opt, tgt_sr, rms_mix_rate)
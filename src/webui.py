@@ -7,7 +7,8 @@ from argparse import ArgumentParser
 
 import gradio as gr
 
-from main import song_cover_pipeline
+from job_queue import JobService
+from main import cover_stages, song_cover_pipeline
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
@@ -147,6 +148,31 @@ def process_file_upload(file):
     return file.name, gr.update(value=file.name)
 
 
+def queued_song_cover_pipeline(song_input, voice_model, pitch_change, keep_files, is_webui=1, main_gain=0, backup_gain=0, inst_gain=0,
+                               index_rate=0.5, filter_radius=3, rms_mix_rate=0.25, f0_method='rmvpe', crepe_hop_length=128, protect=0.33,
+                               pitch_change_all=0, reverb_rm_size=0.15, reverb_wet=0.2, reverb_dry=0.8, reverb_damping=0.7,
+                               output_format='mp3', progress=gr.Progress()):
+    """Same as song_cover_pipeline, but the cover is made by the job queue workers"""
+    if not song_input or not voice_model:
+        raise gr.Error('Ensure that the song input field and voice model field is filled.')
+
+    params = dict(song_input=song_input, voice_model=voice_model, pitch_change=pitch_change, keep_files=bool(keep_files), main_gain=main_gain,
+                  backup_gain=backup_gain, inst_gain=inst_gain, index_rate=index_rate, filter_radius=filter_radius, rms_mix_rate=rms_mix_rate,
+                  f0_method=f0_method, crepe_hop_length=crepe_hop_length, protect=protect, pitch_change_all=pitch_change_all,
+                  reverb_rm_size=reverb_rm_size, reverb_wet=reverb_wet, reverb_dry=reverb_dry, reverb_damping=reverb_damping,
+                  output_format=output_format)
+    stage_names = [name for name, _ in cover_stages]
+
+    def on_update(job):
+        progress(stage_names.index(job['stage']) / len(stage_names), desc=f'[~] {job["stage"].capitalize()}: {job["status"]}...')
+
+    try:
+        job_id = job_service.submit(params)
+        return job_service.wait(job_id, on_update=on_update)
+    except Exception as e:
+        raise gr.Error(str(e))
+
+
 def show_hop_slider(pitch_detection_algo):
     if pitch_detection_algo == 'mangio-crepe':
         return gr.update(visible=True)
@@ -160,8 +186,12 @@ if __name__ == '__main__':
     parser.add_argument("--listen", action="store_true", default=False, help="Make the WebUI reachable from your local network.")
     parser.add_argument('--listen-host', type=str, help='The hostname that the server will use.')
     parser.add_argument('--listen-port', type=int, help='The listening port that the server will use.')
+    parser.add_argument('--job-queue', action='store_true', default=False, help='Make covers on a job queue with separate download, separation, conversion and mixing workers, so requests of several users run concurrently')
+    parser.add_argument('--ui-concurrency', type=int, default=8, help='With --job-queue, requests the UI passes to the job queue at once')
     args = parser.parse_args()
 
+    job_service = JobService().start() if args.job_queue else None
+
     voice_models = get_current_models(rvc_models_dir)
     with open(os.path.join(rvc_models_dir, 'public_models.json'), encoding='utf8') as infile:
         public_models = json.load(infile)
@@ -231,7 +261,7 @@ if __name__ == '__main__':
 
             ref_btn.click(update_models_list, None, outputs=rvc_model)
             is_webui = gr.Number(value=1, visible=False)
-            generate_btn.click(song_cover_pipeline,
+            generate_btn.click(queued_song_cover_pipeline if args.job_queue else song_cover_pipeline,
                                inputs=[song_input, rvc_model, pitch, keep_files, is_webui, main_gain, backup_gain,
                                        inst_gain, index_rate, filter_radius, rms_mix_rate, f0_method, crepe_hop_length,
                                        protect, pitch_all, reverb_rm_size, reverb_wet, reverb_dry, reverb_damping,
@@ -314,6 +344,9 @@ if __name__ == '__main__':
                 local_upload_output_message = gr.Text(label='Оповещение', interactive=False, scale=20)
                 model_upload_button.click(upload_local_model, inputs=[zip_file, local_model_name], outputs=local_upload_output_message)
 
+    if args.job_queue:
+        # requests only wait on the job queue, which does the actual work
+        app.queue(concurrency_count=args.ui_concurrency)
     app.launch(
         share=args.share_enabled,
         enable_queue=True,